@@ -23,6 +23,7 @@ from utils import (
 from struct import unpack_from
 import can
 import sys
+import threading
 import time
 
 class Deye_Can(Battery):
@@ -34,7 +35,7 @@ class Deye_Can(Battery):
         self.intercan_bus = False                    # INTERCAN bus
         self.intercan_timeout = False                # Timeout occurred on INTERCAN bus
         self.intercan_timeout_count = 0              # Counter for achieved timeouts on INTERCAN bus 
-        self.intercan_port = ""                      # INTERCAN bus interface
+        self.intercan_port = self.intercan_port_of(port) # INTERCAN bus interface, automatic detection if empty
         self.cell_count = 1                          # initial number of cells
         self.poll_interval = 1000                    # polling interval to read CAN messages in milliseconds
         self.type = self.BATTERYTYPE                 # battery type
@@ -56,8 +57,57 @@ class Deye_Can(Battery):
         self.cell_mid_voltage = FLOAT_CELL_VOLTAGE   # mean cell voltage
         self.init_check = 0                          # collected value to check if all initialisation steps are done 
         self.init_done = False                       # init done flag
+        self.ingest = None                           # separate ingestion process, if DEYE_CAN_INGEST_PROCESS is enabled
+        self.state_writers = []                      # writers for the binary state record (shared memory, exported state file)
+        self.frame_data = {}                         # last received payload for each CAN message id
+        self.dirty = self.DIRTY_ALL                  # bitwise groups of values changed since the last publishing
+        self.frame_time = {}                         # receive time (kernel timestamp) of the last CAN message for each value group
+        self.bms_check = 0                           # value to check if all needed BMS data received over PCSCAN is available
+        self.bat_check = 0                           # value to check if all needed BATTERY data received over PCSCAN is available
+        self.intercan_check = 0                      # value to check if all needed data received over INTERCAN is available
+        self.malformed_frames = {}                   # number of dropped malformed CAN messages for each message id
+        self.frame_errors = {}                       # number of decoding errors for each message id
+        self.frame_fault_log_time = {}               # time of the last log entry about faulty CAN messages for each message id
+        self.journal = None                          # event journal of alarm and MOSFET transitions, if DEYE_CAN_JOURNAL is enabled
+        self.journal_levels = None                   # alarm levels and MOSFET states of the last recorded transition
+        self.parameter_query = None                  # read requests of the BMS parameters over INTERCAN, if DEYE_CAN_PARAMETER_QUERY is enabled
+        self.parameters = {}                         # BMS parameters read over INTERCAN, by parameter name
+        self.balancing = None                        # balancing time, events and duty cycles of the cells, if DEYE_CAN_BALANCING is enabled
+        self.bms_charge_enable = None                # charging enabled by the BMS (BMS_STAT)
+        self.bms_discharge_enable = None             # discharging enabled by the BMS (BMS_STAT)
+        self.bms_request_heating = None              # heating requested by the BMS (BMS_STAT)
+        self.bms_request_full_charge = None          # full charge requested by the BMS (BMS_STAT)
+        self.bms_request_force_charge = None         # force charge level 1 or 2 requested by the BMS (BMS_STAT)
+        self.battery_voltage = None                  # voltage of the individual battery (BAT_VOLT_CURR_SOC_SOH)
+        self.battery_current = None                  # current of the individual battery, positive = charging (BAT_VOLT_CURR_SOC_SOH)
+        self.battery_soc = None                      # SOC of the individual battery (BAT_VOLT_CURR_SOC_SOH)
+        self.battery_soh = None                      # SOH of the individual battery (BAT_VOLT_CURR_SOC_SOH)
+        self.battery_cell_max_voltage = None         # maximal cell voltage of the individual battery (BAT_MIN_MAX_CELL_DATA)
+        self.battery_cell_min_voltage = None         # minimal cell voltage of the individual battery (BAT_MIN_MAX_CELL_DATA)
+        self.battery_temperature_max = None          # maximal cell temperature of the individual battery (BAT_MIN_MAX_CELL_DATA)
+        self.battery_temperature_min = None          # minimal cell temperature of the individual battery (BAT_MIN_MAX_CELL_DATA)
 
     def __del__(self):
+        if self.ingest is not None:
+            self.ingest.stop()
+            self.ingest = None
+        self.close_outputs()
+        self.shutdown_buses()
+
+    def close_outputs(self):
+        # write the buffered journal records and archive buckets, e.g. before the exit
+        for state_writer in self.state_writers:
+            if hasattr(state_writer, "close"):
+                state_writer.close()
+        self.state_writers = []
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.balancing is not None:
+            self.balancing.close()
+
+    def shutdown_buses(self):
+        # shutdown PCSCAN and INTERCAN bus. Both buses will be initialised again with the next call of read_data_deye_CAN()
         if self.pcscan_bus:
             self.pcscan_bus.shutdown()
             self.pcscan_bus = False
@@ -67,6 +117,78 @@ class Deye_Can(Battery):
             self.intercan_bus = False
             logger.debug("INTERCAN bus shutdown")
 
+    def handoff_state(self):
+        # decoded state for another process: a new driver process (get_handoff()) or the ingestion process
+        from bms.deye_can_state import pack_battery
+
+        return {
+            "state": pack_battery(self),
+            "intercan_port": self.intercan_port,
+            "intercan_available": self.intercan_available,
+            "high_low_intercan": self.high_low_intercan,
+            "cell_voltages_intercan": self.cell_voltages_intercan,
+        }
+
+    def get_handoff(self):
+        # CAN sockets and decoded state for the handoff to a new driver process (utils_handoff.py)
+        # not possible with the ingestion process, which owns the CAN sockets
+        if self.ingest is not None or not self.pcscan_bus:
+            return None
+        fds = {"pcscan": self.pcscan_bus.socket.fileno()}
+        if self.intercan_bus:
+            fds["intercan"] = self.intercan_bus.socket.fileno()
+        return dict(self.handoff_state(), fds=fds)
+
+    def adopt_state(self, handoff):
+        # take over the decoded state returned by handoff_state() instead of test_connection()
+        from bms.deye_can_state import apply_state, unpack_state
+
+        self.intercan_port = handoff["intercan_port"]
+        self.intercan_available = handoff["intercan_available"]
+        self.high_low_intercan = handoff["high_low_intercan"]
+        self.cell_voltages_intercan = handoff["cell_voltages_intercan"]
+        self.high_low_intercan_time = self.cell_voltages_time = time.time()
+        self.get_settings()
+        apply_state(self, unpack_state(handoff["state"]), Cell)
+        if self.init_done is True:
+            self.init_check = 255
+        self.dirty = self.DIRTY_ALL
+
+    def adopt_handoff(self, handoff, fds):
+        # take over the CAN sockets and the decoded state of the old driver process instead of test_connection()
+        try:
+            self.pcscan_bus = self.adopt_bus(self.port, fds["pcscan"])
+            if "intercan" in fds:
+                self.intercan_bus = self.adopt_bus(handoff["intercan_port"], fds["intercan"])
+        except (OSError, can.CanError) as e:
+            logger.error(f"Error while adopting the CAN sockets: {e}")
+            self.shutdown_buses()
+            return False
+        self.adopt_state(handoff)
+        # the outputs are opened by the driver after the old driver closed them, see Handoff.release()
+        logger.info(f"Adopted CAN sockets and decoded values of {self.connection_name()} from the old driver")
+        return True
+
+    def adopt_bus(self, channel, fd):
+        # python-can bus on a duplicate of a received CAN socket, the socket bound by python-can is replaced
+        import os
+        import socket
+
+        bus = can.interface.Bus(bustype=self.CAN_BUS_TYPE, channel=channel)
+        bus.socket.close()
+        bus.socket = socket.socket(fileno=os.dup(fd))
+        return bus
+
+    @staticmethod
+    def intercan_port_of(port):
+        # configured INTERCAN interface for a PCSCAN interface from DEYE_CAN_INTERCAN_PORTS, e.g. "can0:can2,can1:can3"
+        from utils_ext import DEYE_CAN_INTERCAN_PORTS
+
+        for item in DEYE_CAN_INTERCAN_PORTS.split(","):
+            if item.split(":")[0].strip() == port and ":" in item:
+                return item.split(":", 1)[1].strip()
+        return ""
+
     BATTERYTYPE = "DEYE CAN"
     CAN_BUS_TYPE = "socketcan"
     BMS_LIM_VOLT_CURR = "BMS_LIM_VOLT_CURR"          # BMS limits: Maximal and minimal charge and discharge voltages, maximal charge and discharge currents
@@ -94,11 +216,38 @@ class Deye_Can(Battery):
     INTER_CELL_VOLTAGES1 = "INTER_CELL_VOLTAGES1"    # Cell voltages 5-8
     INTER_CELL_VOLTAGES2 = "INTER_CELL_VOLTAGES2"    # Cell voltages 9-12
     INTER_CELL_VOLTAGES3 = "INTER_CELL_VOLTAGES3"    # Cell voltages 13-16
+    INTER_PARAMETER = "INTER_PARAMETER"              # Response to a parameter read request
     MESSAGES_TO_READ = 25                            # Number of CAN messages, to be received during a function call
     ERROR_STATUS_TIMEOUT = 120                       # Timeout for errors and status bits
     INTERCAN_VALUES_TIMEOUT = 120                    # Timeout for INTERCAN values
     INTERCAN_TIMEOUT = 1000                          # Number of timeouts on INTERCAN until the interface will no loger be polled for new messages 
     INTERCAN_SKIPED_RECVS = 10                       # Skiped recv calls for INTERCAN after timeout
+    BATCH_LIMIT = 5000                               # Maximal number of queued CAN messages decoded as one batch
+    pcscan_ports = []                                # CAN interfaces served as PCSCAN by this process (multi-port mode), not used as INTERCAN
+    intercan_lock = threading.Lock()                 # serialises the INTERCAN setup of the ports probed concurrently in multi-port mode
+    FRAME_FAULT_LOG_INTERVAL = 60                    # Minimal interval in seconds between log entries about faulty CAN messages with the same id
+    dbc_decoders = {}                                # decoder functions compiled from deye_can.dbc by message id, loaded once per process (see deye_can_dbc.py)
+
+    # groups of values for change tracking, one bit per group
+    DIRTY_MEASUREMENT = 1                            # voltage, current, SOC and SOH
+    DIRTY_TEMPERATURE = 2                            # temperatures
+    DIRTY_CELLS = 4                                  # cell voltages, minimal and maximal cell voltages, cell balancing
+    DIRTY_ALARMS = 8                                 # protection bits
+    DIRTY_FET = 16                                   # MOSFET and balancing status
+    DIRTY_LIMITS = 32                                # charge and discharge limits
+    DIRTY_IDENTITY = 64                              # battery type, capacity, versions and serial numbers
+    DIRTY_HISTORY = 128                              # charge cycles, energy and alarm counters
+    DIRTY_ALL = 255
+    DIRTY_GROUP_NAMES = {
+        DIRTY_MEASUREMENT: "measurement",
+        DIRTY_TEMPERATURE: "temperature",
+        DIRTY_CELLS: "cells",
+        DIRTY_ALARMS: "alarms",
+        DIRTY_FET: "fet",
+        DIRTY_LIMITS: "limits",
+        DIRTY_IDENTITY: "identity",
+        DIRTY_HISTORY: "history",
+    }
     
     CAN_FRAMES = {
         BMS_LIM_VOLT_CURR: [0x351],          # BMS limits: Maximal and minimal charge and discharge voltages, maximal charge and discharge currents
@@ -126,6 +275,77 @@ class Deye_Can(Battery):
         INTER_CELL_VOLTAGES1: [0x4018001],   # Cell voltages 5-8
         INTER_CELL_VOLTAGES2: [0x4028001],   # Cell voltages 9-12
         INTER_CELL_VOLTAGES3: [0x4038001],   # Cell voltages 13-16
+        INTER_PARAMETER: [0x18F18001],       # Response to a parameter read request
+    }
+
+    # minimal number of data bytes for each decoded CAN message id
+    FRAME_DLC = {
+        CAN_FRAMES[BMS_LIM_VOLT_CURR][0]: 8,
+        CAN_FRAMES[BMS_SOC_SOH][0]: 4,
+        CAN_FRAMES[BMS_VOLT_CURR_TEMP][0]: 6,
+        CAN_FRAMES[BMS_ERR_WARN_ALM][0]: 8,
+        CAN_FRAMES[BMS_BAT_DATA][0]: 8,
+        CAN_FRAMES[BMS_MIN_MAX_CELL_DATA][0]: 8,
+        CAN_FRAMES[BMS_SW_HW][0]: 4,
+        CAN_FRAMES[BMS_MODULE_STAT][0]: 5,
+        CAN_FRAMES[BAT_ERR_WARN_ALM_STAT][0]: 8,
+        CAN_FRAMES[BAT_TEMP_MAX_CURR][0]: 4,
+        CAN_FRAMES[BAT_SYS_STAT][0]: 7,
+        CAN_FRAMES[BAT_SW_DATA][0]: 8,
+        CAN_FRAMES[BAT_ENERGY][0]: 8,
+        CAN_FRAMES[BAT_SERIAL1][0]: 8,
+        CAN_FRAMES[BAT_SERIAL2][0]: 8,
+        CAN_FRAMES[BAT_NUMBER_OF_FAULTS1][0]: 4,
+        CAN_FRAMES[BMS_STAT][0]: 1,
+        CAN_FRAMES[BAT_VOLT_CURR_SOC_SOH][0]: 8,
+        CAN_FRAMES[BAT_MIN_MAX_CELL_DATA][0]: 8,
+        CAN_FRAMES[BAT_NUMBER_OF_FAULTS2][0]: 8,
+        CAN_FRAMES[INTER_HIGH_LOW][0]: 6,
+        CAN_FRAMES[INTER_CELL_VOLTAGES0][0]: 8,
+        CAN_FRAMES[INTER_CELL_VOLTAGES1][0]: 8,
+        CAN_FRAMES[INTER_CELL_VOLTAGES2][0]: 8,
+        CAN_FRAMES[INTER_CELL_VOLTAGES3][0]: 8,
+        CAN_FRAMES[INTER_PARAMETER][0]: 5,
+    }
+
+    # messages with alarm and MOSFET status and parameter responses, which are decoded on each change also in a batch (see deye_can_batch.py)
+    TRANSITION_FRAMES = (
+        CAN_FRAMES[BMS_ERR_WARN_ALM][0],
+        CAN_FRAMES[BAT_ERR_WARN_ALM_STAT][0],
+        CAN_FRAMES[BAT_SYS_STAT][0],
+        CAN_FRAMES[INTER_PARAMETER][0],
+    )
+
+    # index of the first cell in the INTERCAN cell voltage messages
+    INTER_CELL_VOLTAGES_FIRST_CELL = {
+        CAN_FRAMES[INTER_CELL_VOLTAGES0][0]: 0,
+        CAN_FRAMES[INTER_CELL_VOLTAGES1][0]: 4,
+        CAN_FRAMES[INTER_CELL_VOLTAGES2][0]: 8,
+        CAN_FRAMES[INTER_CELL_VOLTAGES3][0]: 12,
+    }
+
+    # changed value groups for each CAN message id
+    DIRTY_GROUPS = {
+        CAN_FRAMES[BMS_LIM_VOLT_CURR][0]: DIRTY_LIMITS,
+        CAN_FRAMES[BMS_SOC_SOH][0]: DIRTY_MEASUREMENT,
+        CAN_FRAMES[BMS_VOLT_CURR_TEMP][0]: DIRTY_MEASUREMENT | DIRTY_TEMPERATURE,
+        CAN_FRAMES[BMS_ERR_WARN_ALM][0]: DIRTY_ALARMS,
+        CAN_FRAMES[BMS_BAT_DATA][0]: DIRTY_IDENTITY,
+        CAN_FRAMES[BMS_MIN_MAX_CELL_DATA][0]: DIRTY_CELLS | DIRTY_TEMPERATURE,
+        CAN_FRAMES[BMS_SW_HW][0]: DIRTY_IDENTITY,
+        CAN_FRAMES[BAT_ERR_WARN_ALM_STAT][0]: DIRTY_ALARMS,
+        CAN_FRAMES[BAT_TEMP_MAX_CURR][0]: DIRTY_TEMPERATURE,
+        CAN_FRAMES[BAT_SYS_STAT][0]: DIRTY_FET | DIRTY_CELLS | DIRTY_HISTORY,
+        CAN_FRAMES[BAT_SW_DATA][0]: DIRTY_IDENTITY,
+        CAN_FRAMES[BAT_ENERGY][0]: DIRTY_HISTORY,
+        CAN_FRAMES[BAT_SERIAL1][0]: DIRTY_IDENTITY,
+        CAN_FRAMES[BAT_SERIAL2][0]: DIRTY_IDENTITY,
+        CAN_FRAMES[BAT_NUMBER_OF_FAULTS1][0]: DIRTY_HISTORY,
+        CAN_FRAMES[INTER_HIGH_LOW][0]: DIRTY_CELLS,
+        CAN_FRAMES[INTER_CELL_VOLTAGES0][0]: DIRTY_CELLS,
+        CAN_FRAMES[INTER_CELL_VOLTAGES1][0]: DIRTY_CELLS,
+        CAN_FRAMES[INTER_CELL_VOLTAGES2][0]: DIRTY_CELLS,
+        CAN_FRAMES[INTER_CELL_VOLTAGES3][0]: DIRTY_CELLS,
     }
 
     # bitmask helpers
@@ -159,6 +379,7 @@ class Deye_Can(Battery):
         """
         result = False
         try:
+            # the outputs are opened by the driver after the detection, see init_state_writers()
             # Detection and initialisation of second INTERCAN bus interface
             result = self.init_intercan()
             if result is False:
@@ -201,12 +422,22 @@ class Deye_Can(Battery):
         return self.battery_serial_number1 + self.battery_serial_number2
 
     def init_intercan(self):
+        # the ports are probed concurrently in multi-port mode, so only one battery at a time detects and sets up its
+        # INTERCAN interface (bitrate detection, CanReceiverThread)
+        with self.intercan_lock:
+            return self.setup_intercan()
+
+    def setup_intercan(self):
         # Detection and initialisation of second INTERCAN bus interface with cell voltages and settings
 
         from utils_can import CanReceiverThread, CanTransportInterface
         import subprocess
 
         self.intercan_available = False
+        if self.intercan_port == "" and len(self.pcscan_ports) > 1:
+            # with several battery stacks the free interfaces cannot be assigned to a stack automatically
+            logger.error(f"No INTERCAN interface for {self.port} in DEYE_CAN_INTERCAN_PORTS, which is needed with more than one CAN port")
+            return False
         if self.intercan_port == "":
             # Automatic detection for a second CAN interface, if no port for INTERCAN was defined
             ip_out = subprocess.run(["ip", "link", "show", "type", "can"], capture_output=True, text=True, check=True)
@@ -218,12 +449,22 @@ class Deye_Can(Battery):
                     ip_out_row = ip_out_row.split(': <')[0] # cut the string after canX
                     begin_can_str=ip_out_row.find('can') # first position for canX in the string
                     ip_out_row = ip_out_row[begin_can_str:] # cut the string before canX
-                    if ip_out_row != self.port:
+                    if ip_out_row != self.port and ip_out_row not in self.pcscan_ports:
                         self.intercan_port = ip_out_row
                         logger.info(f"Use automatic detected {self.intercan_port} as INTERCAN interface")
                         break
             if self.intercan_port == "":
                 return False
+
+        # detect the bitrate in listen-only mode before the CanReceiverThread opens the interface
+        from utils_ext import CAN_AUTOBAUD, CAN_AUTOBAUD_BITRATES, CAN_AUTOBAUD_SAMPLE_TIME
+
+        detected_baudrate = None
+        if CAN_AUTOBAUD:
+            from utils_autobaud import detect_bitrate
+
+            detected_baudrate = detect_bitrate(self.intercan_port, CAN_AUTOBAUD_BITRATES, CAN_AUTOBAUD_SAMPLE_TIME)
+
         try:
             logger.info(f"Initialisation of second INTERCAN interface on {self.intercan_port}")
             can_thread = CanReceiverThread.get_instance(bustype="socketcan", channel=self.intercan_port)
@@ -239,11 +480,14 @@ class Deye_Can(Battery):
             return False
 
         try:
-            baudrate = round(can_thread.get_bitrate(self.intercan_port) / 1000)
             can_transport_interface = CanTransportInterface()
             can_transport_interface.can_message_cache_callback = can_thread.get_message_cache
             can_transport_interface.can_bus = can_thread.can_bus
-            can_thread.setup_can(channel=self.intercan_port, bitrate=baudrate, force=True)
+            if detected_baudrate is None:
+                baudrate = round(can_thread.get_bitrate(self.intercan_port) / 1000)
+                can_thread.setup_can(channel=self.intercan_port, bitrate=baudrate, force=True)
+            else:
+                baudrate = detected_baudrate # interface is already configured with the detected bitrate
         except Exception as e:
             logger.error(f"Error while accessing INTERCAN interface: {e}")
             self.intercan_port = ""
@@ -259,21 +503,221 @@ class Deye_Can(Battery):
         # Set the current limits, populate cell count, etc
         # Return True if success, False for failure
 
+        return self.load_dbc_decoders()
+
+    def load_dbc_decoders(self):
+        # the CAN messages are decoded with the decoder functions compiled from deye_can.dbc, the compiled module is
+        # cached in DEYE_CAN_DBC_CACHE_PATH and compiled again only if the DBC file changed
+        if len(Deye_Can.dbc_decoders) > 0:
+            return True
+
+        from bms.deye_can_dbc import load_decoders
+        from utils_ext import DEYE_CAN_DBC_CACHE_PATH
+        import os
+
+        try:
+            Deye_Can.dbc_decoders = load_decoders(os.path.join(os.path.dirname(os.path.abspath(__file__)), "deye_can.dbc"), cache_path=DEYE_CAN_DBC_CACHE_PATH).DECODERS
+        except (OSError, ValueError, SyntaxError) as e:
+            logger.error(f"Error while loading the decoders of deye_can.dbc: {e}")
+            return False
         return True
 
     def refresh_data(self):
         # call all functions that will refresh the battery data.
         # This will be called for every iteration (1 second)
         # Return True if success, False for failure
+        if self.ingest is not None:
+            return self.read_ingest_data()
         return self.read_status_data()
 
+    def start_ingest_process(self):
+        # Move the decoding of CAN messages to a separate process, which writes the decoded values to shared memory
+        from bms.deye_can_ingest import DeyeCanIngestProcess
+
+        ingest = DeyeCanIngestProcess(self)
+        # the ingestion process opens the outputs again, after they were flushed and closed here
+        # the balancing counters stay readable, they are accounted and saved by the ingestion process and loaded from its file
+        self.close_outputs()
+        if ingest.start() is False:
+            logger.warning("DEYE CAN ingestion process could not be started. CAN messages are decoded in the main process")
+            self.balancing = None
+            self.init_state_writers()
+            return False
+        self.ingest = ingest
+        logger.info("CAN messages are decoded in a separate DEYE CAN ingestion process")
+        return True
+
+    def read_ingest_data(self):
+        # read the last consistent snapshot written by the ingestion process
+        from bms.deye_can_state import apply_state
+        from utils_ext import DEYE_CAN_INGEST_MAX_AGE
+
+        state = self.ingest.read_state(DEYE_CAN_INGEST_MAX_AGE)
+        if state is None:
+            return False
+        if self.ingest.changed is True:
+            self.dirty = self.DIRTY_ALL
+        # the receive times of the CAN messages stay in the ingestion process, the age is measured from the snapshot
+        self.frame_time = dict.fromkeys(self.DIRTY_GROUP_NAMES, state["timestamp"])
+        apply_state(self, state, Cell)
+        if self.balancing is not None:
+            self.balancing.reload_if_changed()
+        self.pcscan_timeout = state["pcscan_online"] == 0
+        self.intercan_timeout = state["intercan_online"] == 0
+        if self.pcscan_timeout is True and self.intercan_timeout is True:
+            return False
+        return True
+
     def read_status_data(self):
         status_data = self.read_data_deye_CAN()
+        # write decoded values also on failure, so that readers of the state see the timeout
+        self.write_state()
+        if self.journal is not None:
+            self.journal.flush_if_due()
+        if self.balancing is not None:
+            self.balancing.save_if_due()
         # check if connection success
         if status_data is False:
             return False
         return True
 
+    def init_state_writers(self):
+        # init the outputs for the decoded values, which are enabled in the config
+        # called once for the detected battery, a probe must not open (and reset) the files of a running battery
+        if len(self.state_writers) > 0 or self.journal is not None or self.balancing is not None:
+            return
+        from utils_ext import DEYE_CAN_ARCHIVE, DEYE_CAN_BALANCING, DEYE_CAN_JOURNAL, DEYE_CAN_STATE_EXPORT, MQTT_PUBLISH
+
+        if DEYE_CAN_STATE_EXPORT:
+            self.init_state_export()
+        if MQTT_PUBLISH:
+            self.init_mqtt()
+        if DEYE_CAN_JOURNAL:
+            self.init_journal()
+        if DEYE_CAN_ARCHIVE:
+            self.init_archive()
+        if DEYE_CAN_BALANCING:
+            self.init_balancing()
+
+    def init_state_export(self):
+        # export the decoded values to a memory-mapped state file for local consumers
+        from bms.deye_can_state import create_state_file
+        from utils_ext import DEYE_CAN_STATE_EXPORT_PATH
+        import os
+
+        path = os.path.join(DEYE_CAN_STATE_EXPORT_PATH, "deye_can_" + self.port + ".state")
+        try:
+            self.state_writers.append(create_state_file(path))
+        except OSError as e:
+            logger.error(f"Error while creating state file {path}: {e}")
+            return False
+        logger.info(f"Decoded values are exported to {path}")
+        return True
+
+    def init_mqtt(self):
+        # publish changed decoded values to a local MQTT broker
+        from utils_mqtt import MqttStateWriter, parse_deadbands
+        from utils_ext import MQTT_HOST, MQTT_PORT, MQTT_TOPIC_PREFIX, MQTT_DEADBANDS, MQTT_MAX_RATE
+
+        self.state_writers.append(
+            MqttStateWriter(MQTT_TOPIC_PREFIX + "/" + self.port, parse_deadbands(MQTT_DEADBANDS), MQTT_MAX_RATE, MQTT_HOST, MQTT_PORT)
+        )
+        logger.info(f"Decoded values are published to MQTT broker {MQTT_HOST}:{MQTT_PORT} under {MQTT_TOPIC_PREFIX}/{self.port}")
+        return True
+
+    def init_journal(self):
+        # record the alarm and MOSFET transitions in an append-only event journal
+        from bms.deye_can_journal import JournalWriter
+        from utils_ext import DEYE_CAN_JOURNAL_PATH, DEYE_CAN_JOURNAL_FLUSH_INTERVAL, DEYE_CAN_JOURNAL_MAX_SEGMENTS
+        import os
+
+        path = os.path.join(DEYE_CAN_JOURNAL_PATH, self.port)
+        try:
+            self.journal = JournalWriter(path, DEYE_CAN_JOURNAL_FLUSH_INTERVAL, max_segments=DEYE_CAN_JOURNAL_MAX_SEGMENTS)
+        except OSError as e:
+            logger.error(f"Error while opening event journal {path}: {e}")
+            return False
+        logger.info(f"Alarm and MOSFET transitions are recorded in {path}")
+        return True
+
+    def init_archive(self):
+        # archive the decoded values with several resolutions in a round-robin file
+        from bms.deye_can_archive import ArchiveWriter, parse_resolutions
+        from utils_ext import DEYE_CAN_ARCHIVE_PATH, DEYE_CAN_ARCHIVE_RESOLUTIONS, DEYE_CAN_ARCHIVE_FLUSH_INTERVAL
+        import os
+
+        path = os.path.join(DEYE_CAN_ARCHIVE_PATH, "deye_can_" + self.port + ".archive")
+        try:
+            self.state_writers.append(ArchiveWriter(path, parse_resolutions(DEYE_CAN_ARCHIVE_RESOLUTIONS), DEYE_CAN_ARCHIVE_FLUSH_INTERVAL))
+        except (OSError, ValueError) as e:
+            logger.error(f"Error while opening archive {path}: {e}")
+            return False
+        logger.info(f"Decoded values are archived in {path}")
+        return True
+
+    def init_balancing(self):
+        # account the balancing time, events and duty cycles of each cell, saved across restarts
+        from bms.deye_can_balancing import BalancingCounters
+        from utils_ext import DEYE_CAN_BALANCING_PATH, DEYE_CAN_BALANCING_SAVE_INTERVAL
+        import os
+
+        path = os.path.join(DEYE_CAN_BALANCING_PATH, "deye_can_" + self.port + ".balancing")
+        try:
+            self.balancing = BalancingCounters(path, DEYE_CAN_BALANCING_SAVE_INTERVAL)
+        except OSError as e:
+            logger.error(f"Error while loading balancing counters {path}: {e}")
+            return False
+        logger.info(f"Cell balancing is accounted in {path}")
+        return True
+
+    def record_transitions(self):
+        # append the changed alarm levels and MOSFET states to the event journal
+        if self.journal is None:
+            return
+        from bms.deye_can_journal import FET_EVENTS, PROTECTION_EVENTS
+
+        levels = tuple(
+            255 if level is None else level
+            for level in [getattr(self.protection, name, None) for name in PROTECTION_EVENTS] + [getattr(self, name) for name in FET_EVENTS]
+        )
+        if levels == self.journal_levels:
+            return
+        pack = int.from_bytes(self.address, "big") & 0xFFFF if self.address else 0
+        # unknown levels before the first decoded message are recorded as 255
+        last_levels = self.journal_levels or (255,) * len(levels)
+        for event, (old, new) in enumerate(zip(last_levels, levels)):
+            if old != new:
+                self.journal.append(pack, event, old, new)
+        self.journal_levels = levels
+
+    def mark_dirty(self, msg):
+        # mark the value groups of a CAN message as changed, if the payload differs from the last received one
+        group = self.DIRTY_GROUPS.get(msg.arbitration_id, 0)
+        if self.frame_data.get(msg.arbitration_id) != msg.data:
+            self.frame_data[msg.arbitration_id] = bytes(msg.data)
+            self.dirty |= group
+        # the values of the groups are confirmed by this message, also if they did not change
+        if msg.timestamp:
+            for bit in self.DIRTY_GROUP_NAMES:
+                if group & bit:
+                    self.frame_time[bit] = msg.timestamp
+
+    def pop_dirty(self):
+        # return the groups of values changed since the last call and reset them
+        dirty = self.dirty
+        self.dirty = 0
+        return dirty
+
+    def write_state(self):
+        # pack the decoded values once and write them to all state writers
+        if len(self.state_writers) == 0:
+            return
+        from bms.deye_can_state import pack_battery
+
+        record = pack_battery(self)
+        for state_writer in self.state_writers:
+            state_writer.write(record)
+
     def init_battery_cell_settings(self):
         # init battery cell settings
         if self.cell_count == 1:
@@ -317,9 +761,11 @@ class Deye_Can(Battery):
             for ii in range(self.cell_count):
                 # set cell balancing status. True, if cell is balancing
                 self.cells[ii].balance = False if bat_balance_data & self.BITMASK[ii] == 0 else True
+        self.record_transitions()
 
-    def reset_fet_bits(self, byte_data):
+    def reset_fet_bits(self):
         # resset fet and balancing bits
+        self.dirty |= self.DIRTY_FET | self.DIRTY_CELLS
         self.charge_fet = 0
         self.discharge_fet = 0
         self.balance_fet = 0
@@ -328,6 +774,7 @@ class Deye_Can(Battery):
             for ii in range(self.cell_count):
                 # reset cell balancing status
                 self.cells[ii].balance = False
+        self.record_transitions()
 
     def to_protection_bits(self, bms_stat_data, bat_stat_data):
         # set protection bits
@@ -464,9 +911,11 @@ class Deye_Can(Battery):
             self.protection.internal_failure = 2
         else:
             self.protection.internal_failure = 0
+        self.record_transitions()
 
     def reset_protection_bits(self):
         # reset protection bits
+        self.dirty |= self.DIRTY_ALARMS
         self.protection.high_cell_voltage = 0
         self.protection.low_cell_voltage = 0
         self.protection.high_voltage = 0
@@ -481,21 +930,372 @@ class Deye_Can(Battery):
         self.protection.high_internal_temperature = 0
         self.protection.fuse_blown = 0
         self.protection.internal_failure = 0
+        self.record_transitions()
 
     def simulate_cell_voltages(self):
         # fetch data from min/max values if no InterCAN available
-        self.cells = [Cell(False) for _ in range(self.cell_count)]
+        # the changes of the messages are tracked by mark_dirty(), the cells are only marked, if they changed here
+        # the cell instances are only created again, if the number of cells changed
+        if len(self.cells) != self.cell_count:
+            self.cells = [Cell(False) for _ in range(self.cell_count)]
+            self.dirty |= self.DIRTY_CELLS
+
+        cell_voltage = round(self.cell_mid_voltage, 3)
+        if any(cell.voltage != cell_voltage for cell in self.cells):
+            self.dirty |= self.DIRTY_CELLS
+            for cell in self.cells:
+                # loop through all cells and set the mean voltage
+                cell.voltage = cell_voltage
+
+    def update_custom_field(self):
+        # rebuild the custom field only, if a version changed
+        self.custom_field = "BMS: " + self.bms_software_version + " Firmware: " + self.battery_software_version + " BOOT: " + self.battery_boot_version
+
+    def frame_is_valid(self, msg):
+        # check the data length of a CAN message before decoding, count and drop malformed messages
+        if msg.is_error_frame is False and len(msg.data) >= self.FRAME_DLC.get(msg.arbitration_id, 0):
+            return True
+        self.malformed_frames[msg.arbitration_id] = self.malformed_frames.get(msg.arbitration_id, 0) + 1
+        self.log_frame_fault(msg.arbitration_id, f"Malformed CAN message 0x{msg.arbitration_id:X} with {len(msg.data)} data bytes dropped")
+        return False
+
+    def frame_error(self, msg, exception):
+        # count and log errors during the decoding of a single CAN message, the remaining messages are still decoded
+        self.frame_errors[msg.arbitration_id] = self.frame_errors.get(msg.arbitration_id, 0) + 1
+        self.log_frame_fault(msg.arbitration_id, f"Error while decoding CAN message 0x{msg.arbitration_id:X} {msg.data.hex()}: {repr(exception)}")
+
+    def log_frame_fault(self, arbitration_id, text):
+        # log faulty CAN messages only once per FRAME_FAULT_LOG_INTERVAL for each message id
+        now = time.time()
+        if now - self.frame_fault_log_time.get(arbitration_id, 0) < self.FRAME_FAULT_LOG_INTERVAL:
+            return
+        self.frame_fault_log_time[arbitration_id] = now
+        logger.warning(
+            text
+            + f" (malformed: {self.malformed_frames.get(arbitration_id, 0)}, decoding errors: {self.frame_errors.get(arbitration_id, 0)},"
+            + f" further messages suppressed for {self.FRAME_FAULT_LOG_INTERVAL} s)"
+        )
+
+    def decode_pcscan_frame(self, msg):
+        # translate/convert one PCSCAN message to according values
+        # the signals are decoded with the decoders compiled from deye_can.dbc, ASCII texts and alarm bits from the raw data
+        decoder = self.dbc_decoders.get(msg.arbitration_id)
+        if decoder is None:
+            return
+        data = msg.data
+        values = decoder(data)
+        if msg.arbitration_id in self.CAN_FRAMES[self.BMS_LIM_VOLT_CURR]:
+            # BMS limits: Maximal and minimal charge and discharge voltages, maximal charge and discharge currents
+            self.max_battery_voltage = values["charge_voltage_limit"]
+            self.max_battery_charge_current = values["charge_current_limit"]
+            self.max_battery_discharge_current = values["discharge_current_limit"]
+            self.min_battery_voltage = values["discharge_voltage_limit"]
+            self.bms_check |= self.BITMASK[0]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BMS_SOC_SOH]:
+            # BMS SOC and SOH
+            self.soc = values["soc"]
+            self.soh = values["soh"]
+            self.bms_check |= self.BITMASK[1]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BMS_VOLT_CURR_TEMP]:
+            # BMS voltage, current and temperature
+            self.voltage = values["voltage"]
+            self.current = values["current"] * INVERT_CURRENT_MEASUREMENT
+            self.to_temperature(1, values["temperature"])
+            self.init_check |= self.BITMASK[0]
+            self.bms_check |= self.BITMASK[2]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BMS_BAT_DATA]:
+            # BMS manufacturer name, battery pack number, battery type and battery capacity
+            bms_manufacturer_name = "".join(map(chr, data[0:2])) # usualy DY as ASCII
+            bms_battery_pack_number = "".join(map(chr, data[2:5])) # usualy 001 as ASCII
+            bms_battery_type = values["battery_type"]
+            # DEYE specific battery code for cell manufacturer and cell types
+            if bms_battery_type == 1:
+                bms_bat_type_ascii = "GOTION 96Ah"
+            elif bms_battery_type == 2:
+                bms_bat_type_ascii = "CATL 100Ah"
+            elif bms_battery_type == 3:
+                bms_bat_type_ascii = "EVE 100Ah"
+            elif bms_battery_type == 4:
+                bms_bat_type_ascii = "PH 100Ah"
+            elif bms_battery_type == 5:
+                bms_bat_type_ascii = "EVE 120Ah"
+            elif bms_battery_type == 6:
+                bms_bat_type_ascii = "PH 100Ah(214R)"
+            elif bms_battery_type == 7:
+                bms_bat_type_ascii = "ZENERGY 104Ah"
+            else:
+                bms_bat_type_ascii = "TYP " + str(bms_battery_type) # fallback for all other types as TYP XY
+            self.type = bms_manufacturer_name + bms_battery_pack_number + " " + bms_bat_type_ascii # compose the battery type based of all information
+            self.capacity = values["capacity"]
+            self.init_check |= self.BITMASK[1]
+            self.bms_check |= self.BITMASK[3]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BMS_MIN_MAX_CELL_DATA]:
+            # Collected BMS information: Minimal and maximal cell voltage and temperature (without number of concerned cell)
+            if self.high_low_intercan is False:
+                self.cell_max_voltage = values["cell_max_voltage"]
+                self.cell_min_voltage = values["cell_min_voltage"]
+                self.cell_mid_voltage = (self.cell_min_voltage + self.cell_max_voltage) / 2 # calculate mean cell voltage based on min and max values
+                self.init_check |= self.BITMASK[2]
+                self.bms_check |= self.BITMASK[4]
+                if self.cell_voltages_intercan is False and self.init_done is True:
+                    self.simulate_cell_voltages()  # simulate cell voltages, if no cell voltages were received over INTERCAN
+            self.to_temperature(2, values["temperature_max"]) # use Temperature 2 as maximal cell temperature
+            self.to_temperature(3, values["temperature_min"]) # use Temperature 3 as minimal cell temperature
+            self.bms_check |= self.BITMASK[5]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BMS_SW_HW]:
+            # BMS software and hardware version
+            bms_software_version = f'{values["software_version"]:04X}'
+            if bms_software_version != self.bms_software_version:
+                self.bms_software_version = bms_software_version
+                self.update_custom_field()
+            self.hardware_version = f'{values["hardware_version"]:04X}'
+            self.init_check |= self.BITMASK[3]
+            self.bms_check |= self.BITMASK[6]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BMS_MODULE_STAT]:
+            # Collected BMS status bits for all batteries
+            # data[0]: number of batteries in operation
+            # data[1]: number of batteries with prohibited charging
+            # data[2]: number of batteries with prohibited discharging
+            # data[3]: number of batteries with communication disconnect
+            # data[4]: number of batteries in parallel
+            self.bms_check |= self.BITMASK[7]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BMS_ERR_WARN_ALM]:
+            # Collected alarms and status bits from BMS for all batteries
+            self.bms_alarms = data
+            logger.debug("CAN Message Data BMS alarms: %s",self.bms_alarms.hex())
+            self.last_error_time = time.time()
+            self.error_active = True
+            self.to_protection_bits(self.bms_alarms, self.bat_alarms)
+            self.bms_check |= self.BITMASK[8]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BAT_TEMP_MAX_CURR]:
+            # Individual MOSFET and HEATING temperatures, minimal and maximal battery current for each battery
+            self.to_temperature(0, values["temperature_mos"])
+            self.to_temperature(4, values["temperature_heating"])
+            # optional min and max battery currents for each separate battery instead of collected bms value for all batteries in sum
+#            self.max_battery_current_bms = values["max_charge_current"]
+#            self.min_battery_current_bms = values["max_discharge_current"]
+            self.bat_check |= self.BITMASK[0]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BAT_SYS_STAT]:
+            # Individual operation mode, failure level, charge cycles, balancing status and system substate for each battery
+            battery_operation_mode = values["operation_mode"]
+            # values["failure_level"]: battery failure level
+            self.history.charge_cycles = values["charge_cycles"]
+            battery_balancing_status = values["balancing_state"]
+            # values["system_substate"]: battery system substate
+            self.last_fet_status_time = time.time()
+            self.fet_status_active = True
+            self.to_fet_bits(battery_operation_mode, battery_balancing_status)
+            self.account_balancing(msg)
+            self.init_check |= self.BITMASK[4]
+            self.bat_check |= self.BITMASK[1]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BAT_SW_DATA]:
+            # Individual software and boot version for each battery
+            battery_software_version = f'{values["software_version"]:04X}'
+            battery_boot_version = "".join(map(chr, data[3:8]))
+            if battery_software_version != self.battery_software_version or battery_boot_version != self.battery_boot_version:
+                self.battery_software_version = battery_software_version
+                self.battery_boot_version = battery_boot_version
+                self.update_custom_field()
+            self.init_check |= self.BITMASK[5]
+            self.bat_check |= self.BITMASK[2]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BAT_SERIAL1]:
+            # Battery serial number part 1 of 2
+            self.battery_serial_number1 =  "".join(map(chr, data))
+            self.init_check |= self.BITMASK[6]
+            self.bat_check |= self.BITMASK[3]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BAT_SERIAL2]:
+            # Battery serial number part 2 of 2
+            self.battery_serial_number2 =  "".join(map(chr, data))
+            self.init_check |= self.BITMASK[7]
+            self.bat_check |= self.BITMASK[4]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BAT_ERR_WARN_ALM_STAT]:
+            # Individual alarms and status bits for each battery
+            self.bat_alarms = data
+            logger.debug("CAN Message Data BAT alarms: %s",self.bat_alarms.hex())
+            self.last_error_time = time.time()
+            self.error_active = True
+            self.to_protection_bits(self.bms_alarms, self.bat_alarms)
+            self.bat_check |= self.BITMASK[5]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BAT_ENERGY]:
+            # Total charged and discharged energy for each battery
+            self.history.charged_energy = values["charged_energy"]
+            self.history.discharged_energy = values["discharged_energy"]
+            self.bat_check |= self.BITMASK[6]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BAT_NUMBER_OF_FAULTS1]:
+            # Number of high/low voltage, short circuit, overtemperature alarms
+            self.history.high_voltage_alarms = values["high_voltage_alarms"]
+            self.history.low_voltage_alarms = values["low_voltage_alarms"]
+            self.bat_check |= self.BITMASK[7]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BMS_STAT]:
+            # Collected BMS status bits for all batteries
+            self.bms_charge_enable = values["charge_enable"] == 1
+            self.bms_discharge_enable = values["discharge_enable"] == 1
+            self.bms_request_heating = values["request_heating"] == 1
+            self.bms_request_full_charge = values["request_full_charge"] == 1
+            self.bms_request_force_charge = 2 if values["request_force_charge_2"] else 1 if values["request_force_charge_1"] else 0
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BAT_VOLT_CURR_SOC_SOH]:
+            # Individual voltage, current, SOC and SOH for each battery
+            self.battery_voltage = values["voltage"]
+            self.battery_current = values["current"] * INVERT_CURRENT_MEASUREMENT
+            self.battery_soc = values["soc"]
+            self.battery_soh = values["soh"]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BAT_MIN_MAX_CELL_DATA]:
+            # Individual information for each battery: Minimal and maximal cell voltage and temperature
+            self.battery_cell_max_voltage = values["cell_max_voltage"]
+            self.battery_cell_min_voltage = values["cell_min_voltage"]
+            self.battery_temperature_max = values["temperature_max"]
+            self.battery_temperature_min = values["temperature_min"]
+
+        elif msg.arbitration_id in self.CAN_FRAMES[self.BAT_NUMBER_OF_FAULTS2]:
+            # Number of charge/discharge overcurrent and charge/discharge overtemperature alarms
+            self.history.charge_overcurrent_alarms = values["charge_overcurrent_alarms"]
+            self.history.discharge_overcurrent_alarms = values["discharge_overcurrent_alarms"]
+            self.history.charge_overtemperature_alarms = values["charge_overtemperature_alarms"]
+            self.history.discharge_overtemperature_alarms = values["discharge_overtemperature_alarms"]
+
+    def decode_intercan_frame(self, msg):
+        # translate/convert one INTERCAN message to according values, decoded with the decoders compiled from deye_can.dbc
+        decoder = self.dbc_decoders.get(msg.arbitration_id)
+        if decoder is None:
+            return
+        data = msg.data
+        # highest and lowest cell voltages received over INTERCAN (if available)
+        if msg.arbitration_id in self.CAN_FRAMES[self.INTER_HIGH_LOW]:
+            values = decoder(data)
+            self.cell_max_voltage = values["cell_max_voltage"]
+            self.cell_max_no = values["cell_max_no"] # cell number for maximal cell voltage
+            self.cell_min_voltage = values["cell_min_voltage"]
+            self.cell_min_no = values["cell_min_no"] # cell number for minimal cell voltage
+            self.cell_mid_voltage = (self.cell_min_voltage + self.cell_max_voltage) / 2 # calculate mean cell voltage based on min and max values
+            self.init_check |= self.BITMASK[2]
+            if self.cell_voltages_intercan is False and self.init_done is True:
+                self.simulate_cell_voltages()  # simulate cell voltages, if no cell voltages were received over INTERCAN
+            if self.high_low_intercan is False and self.init_done is True:
+                logger.info("Receive highest and lowest cell voltages from INTERCAN instead of PCSCAN")
+            self.high_low_intercan_time = time.time()
+            self.high_low_intercan = True
+            self.intercan_check |= self.BITMASK[0]
+
+        # cell voltages received over INTERCAN (if available)
+        elif self.init_done is True and msg.arbitration_id in self.INTER_CELL_VOLTAGES_FIRST_CELL:
+            # cell voltages 1-4, 5-8, 9-12 or 13-16
+            first_cell = self.INTER_CELL_VOLTAGES_FIRST_CELL[msg.arbitration_id]
+            for ii, cell_voltage in enumerate(decoder(data).values()):
+                self.cells[first_cell + ii].voltage = cell_voltage
+            self.cell_voltages_received(first_cell)
+
+        # response to a parameter read request
+        elif self.parameter_query and msg.arbitration_id in self.CAN_FRAMES[self.INTER_PARAMETER]:
+            complete = self.parameter_query.complete()
+            if self.parameter_query.receive(data) is not None:
+                self.parameters = self.parameter_query.values()
+                if "charge_cycles" in self.parameters:
+                    self.history.charge_cycles = self.parameters["charge_cycles"]
+                if complete is False and self.parameter_query.complete() is True:
+                    logger.info("BMS parameters read over INTERCAN: " + ", ".join(f"{name} = {value}" for name, value in self.parameters.items()))
+
+    def account_balancing(self, msg):
+        # balancing time of the cells up to a BAT_SYS_STAT message, also used for the messages superseded in a batch
+        if self.balancing is not None:
+            self.balancing.update(unpack_from(">H", msg.data, 4)[0], msg.timestamp or time.time())
+
+    def cell_voltages_received(self, first_cell):
+        # cell voltages from first_cell on were received over INTERCAN
+        if self.cell_voltages_intercan is False and self.init_done is True:
+            logger.info("Receive cell voltages from INTERCAN instead of simulation using min and max values from PCSCAN")
+        self.cell_voltages_time = time.time()
+        self.cell_voltages_intercan = True
+        self.intercan_check |= self.BITMASK[1 + first_cell // 4]
+
+    def init_parameter_query(self):
+        # read requests of the BMS parameters, which are not broadcast (protection settings, counters, battery type)
+        from bms.deye_can_parameters import ParameterQuery
+        from utils_ext import DEYE_CAN_PARAMETER_QUERY_INTERVAL, DEYE_CAN_PARAMETER_TTL
+
+        def send(arbitration_id, data):
+            self.intercan_bus.send(can.Message(arbitration_id=arbitration_id, data=data, is_extended_id=True))
+
+        self.parameter_query = ParameterQuery(send, interval=DEYE_CAN_PARAMETER_QUERY_INTERVAL, ttl=DEYE_CAN_PARAMETER_TTL)
+
+    def query_parameters(self):
+        # send the next due parameter read request, the rate limit and the cache of the responses are handled by ParameterQuery
+        if not self.parameter_query or not self.intercan_bus or self.intercan_timeout_count >= self.INTERCAN_TIMEOUT:
+            return
+        try:
+            self.parameter_query.poll()
+        except (OSError, can.CanError) as e:
+            # ParameterQuery sends no requests until the backoff time elapsed, log only the first error of a series
+            if self.parameter_query.backoff <= 1:
+                logger.error(f"Error while sending a parameter read request over INTERCAN, retry in {self.parameter_query.backoff:.0f}s: {e}")
+            else:
+                logger.debug(f"Error while sending a parameter read request over INTERCAN, retry in {self.parameter_query.backoff:.0f}s: {e}")
 
-        for i in range(self.cell_count):
-            # loop through all cells and set the mean voltage
-            self.cells[i].voltage = round(self.cell_mid_voltage, 3)
+    def decode_frame(self, msg, decode):
+        # validate, track and decode one CAN message, a faulty message does not abort the remaining messages
+        if self.frame_is_valid(msg):
+            self.mark_dirty(msg)
+            try:
+                decode(msg)
+            except Exception as e:
+                self.frame_error(msg, e)
+
+    def check_init_done(self):
+        if self.init_done is False and self.init_check & 255 == 255:
+            self.init_done = self.init_battery_cell_settings() # init of battery cell settings after required values are received
+            self.dirty = self.DIRTY_ALL
+            logger.debug("self.init_done = %d", self.init_done)
+
+    def decode_backlog(self):
+        # decode all queued CAN messages as one batch, if more messages are queued than are read in one poll
+        from bms.deye_can_batch import decode_batch, drain
+
+        frames = [(msg, self.decode_pcscan_frame) for msg in drain(self.pcscan_bus, self.BATCH_LIMIT)]
+        pcscan_frames = len(frames)
+        if self.intercan_bus and self.intercan_timeout_count < self.INTERCAN_TIMEOUT:
+            frames += [(msg, self.decode_intercan_frame) for msg in drain(self.intercan_bus, self.BATCH_LIMIT)]
+        if len(frames) < self.MESSAGES_TO_READ:
+            # no backlog: decode the messages one by one and continue with the normal polling
+            for msg, decode in frames:
+                self.decode_frame(msg, decode)
+            self.check_init_done()
+            return False
+        logger.debug(f"Decode a backlog of {len(frames)} CAN messages as one batch")
+        decode_batch(self, frames)
+        if pcscan_frames > 0 and self.pcscan_timeout is True:
+            self.pcscan_timeout = False
+            logger.info("CAN Message on PCSCAN received again")
+        if len(frames) > pcscan_frames and self.intercan_timeout is True:
+            self.intercan_timeout = False
+            self.intercan_timeout_count = 0
+            logger.info("CAN Message on INTERCAN received again")
+        self.check_init_done()
+        return True
 
     def read_data_deye_CAN(self):
         # read CAN data
-        bms_check = 0                     # value to check if all needed BMS data received over PCSCAN is available
-        bat_check = 0                     # value to check if all needed BATTERY data received over PCSCAN is available
-        intercan_check = 0                # value to check if all needed data received over INTERCAN is available
-        mean_cell_volt_available = False  # mean cell voltage is calculated based on min and max cell voltage 
+        from utils_ext import DEYE_CAN_BATCH_DECODE, DEYE_CAN_PARAMETER_QUERY
+
+        self.bms_check = 0                # value to check if all needed BMS data received over PCSCAN is available
+        self.bat_check = 0                # value to check if all needed BATTERY data received over PCSCAN is available
+        self.intercan_check = 0           # value to check if all needed data received over INTERCAN is available
 
         if self.pcscan_bus is False:
             logger.debug("PCSCAN bus init")
@@ -526,6 +1326,9 @@ class Deye_Can(Battery):
                 return False
             logger.debug("INTERCAN bus init done")
 
+        if DEYE_CAN_PARAMETER_QUERY and self.parameter_query is None and self.intercan_available is True:
+            self.init_parameter_query()
+
         try:
             if ((time.time() - self.last_error_time) > self.ERROR_STATUS_TIMEOUT) and self.error_active is True:
                 self.error_active = False # reset errors after timeout
@@ -545,10 +1348,16 @@ class Deye_Can(Battery):
                 self.cell_voltages_intercan = False # reset cell voltages active flag after timeout
                 logger.warning("Timeout occurred when receiving cell voltages over INTERCAN. Switch to PCSCAN fallback and to simulated values")
 
+            self.query_parameters()
+            if DEYE_CAN_BATCH_DECODE and self.decode_backlog() is True:
+                # a backlog after a stall was decoded as one batch, the next poll continues with the normal polling
+                return True
+
             messages_to_read = self.MESSAGES_TO_READ # counter for received CAN messages (common for both PCSCAN and INTERCAN)
             intercan_last_recv = self.MESSAGES_TO_READ # special counter storage for INTERCAN messages
             while messages_to_read > 0:
                 # main while loop to pull/receive of CAN messages on both PCSCAN and INTERCAN (if available) and translate/convert these to according values 
+                self.query_parameters()
                 pcscan_msg = self.pcscan_bus.recv(1) # receive PCSCAN message
                 if pcscan_msg is None:
                     if self.pcscan_timeout is False:
@@ -587,239 +1396,18 @@ class Deye_Can(Battery):
                     # return without decoding of messages, if both PCSCAN and INTERCAN achieved timeout
                     return False
 
+                # each message is validated and decoded separately, a faulty message does not abort the remaining messages
                 if pcscan_msg is not None:
                     messages_to_read -= 1
-                    if pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BMS_LIM_VOLT_CURR]:
-                        # BMS limits: Maximal and minimal charge and discharge voltages, maximal charge and discharge currents
-                        self.max_battery_voltage = unpack_from("<H", bytes([pcscan_msg.data[0], pcscan_msg.data[1]]))[0] / 10
-                        self.max_battery_charge_current = unpack_from("<h", bytes([pcscan_msg.data[2], pcscan_msg.data[3]]))[0] / 10
-                        self.max_battery_discharge_current = unpack_from("<h", bytes([pcscan_msg.data[4], pcscan_msg.data[5]]))[0] / 10
-                        self.min_battery_voltage = unpack_from("<H", bytes([pcscan_msg.data[6], pcscan_msg.data[7]]))[0] / 10
-                        bms_check |= self.BITMASK[0]
-
-                    elif pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BMS_SOC_SOH]:
-                        # BMS SOC and SOH
-                        self.soc = unpack_from("<H", bytes([pcscan_msg.data[0], pcscan_msg.data[1]]))[0]
-                        self.soh = unpack_from("<H", bytes([pcscan_msg.data[2], pcscan_msg.data[3]]))[0]
-                        bms_check |= self.BITMASK[1]
-
-                    elif pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BMS_VOLT_CURR_TEMP]:
-                        # BMS voltage, current and temperature
-                        self.voltage = unpack_from("<h", bytes([pcscan_msg.data[0], pcscan_msg.data[1]]))[0] / 100
-                        self.current = unpack_from("<h", bytes([pcscan_msg.data[2], pcscan_msg.data[3]]))[0] / -10 * INVERT_CURRENT_MEASUREMENT
-                        temperature_1 = unpack_from("<h", bytes([pcscan_msg.data[4], pcscan_msg.data[5]]))[0] / 10
-                        self.to_temperature(1, temperature_1)
-                        self.init_check |= self.BITMASK[0]
-                        bms_check |= self.BITMASK[2]
-                        
-                    elif pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BMS_BAT_DATA]:
-                        # BMS manufacturer name, battery pack number, battery type and battery capacity
-                        bms_manufacturer_name = "".join(map(chr, bytes([pcscan_msg.data[0], pcscan_msg.data[1]]))) # usualy DY as ASCII
-                        bms_battery_pack_number = "".join(map(chr, bytes([pcscan_msg.data[2], pcscan_msg.data[3], pcscan_msg.data[4]]))) # usualy 001 as ASCII
-                        bms_battery_type = unpack_from("<B", bytes([pcscan_msg.data[5]]))[0]
-                        # DEYE specific battery code for cell manufacturer and cell types
-                        if bms_battery_type == 1:
-                            bms_bat_type_ascii = "GOTION 96Ah"
-                        elif bms_battery_type == 2:
-                            bms_bat_type_ascii = "CATL 100Ah"
-                        elif bms_battery_type == 3:
-                            bms_bat_type_ascii = "EVE 100Ah"
-                        elif bms_battery_type == 4:
-                            bms_bat_type_ascii = "PH 100Ah"
-                        elif bms_battery_type == 5:
-                            bms_bat_type_ascii = "EVE 120Ah"
-                        elif bms_battery_type == 6:
-                            bms_bat_type_ascii = "PH 100Ah(214R)"
-                        elif bms_battery_type == 7:
-                            bms_bat_type_ascii = "ZENERGY 104Ah"
-                        else:
-                            bms_bat_type_ascii = "TYP " + str(bms_battery_type) # fallback for all other types as TYP XY
-                        self.type = bms_manufacturer_name + bms_battery_pack_number + " " + bms_bat_type_ascii # compose the battery type based of all information
-                        self.capacity = unpack_from("<H", bytes([pcscan_msg.data[6], pcscan_msg.data[7]]))[0] / 10
-                        self.init_check |= self.BITMASK[1]
-                        bms_check |= self.BITMASK[3]
-
-                    elif pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BMS_MIN_MAX_CELL_DATA]:
-                        # Collected BMS information: Minimal and maximal cell voltage and temperature (without number of concerned cell)
-                        if self.high_low_intercan is False:
-                            self.cell_max_voltage = unpack_from("<H", bytes([pcscan_msg.data[0], pcscan_msg.data[1]]))[0] / 1000
-                            self.cell_min_voltage = unpack_from("<H", bytes([pcscan_msg.data[2], pcscan_msg.data[3]]))[0] / 1000
-                            self.cell_mid_voltage = (self.cell_min_voltage + self.cell_max_voltage) / 2 # calculate mean cell voltage based on min and max values
-                            self.init_check |= self.BITMASK[2]
-                            bms_check |= self.BITMASK[4]
-                            mean_cell_volt_available = True
-                            if self.cell_voltages_intercan is False and self.init_done is True:
-                                self.simulate_cell_voltages()  # simulate cell voltages, if no cell voltages were received over INTERCAN
-                        temperature_2 = unpack_from("<h", bytes([pcscan_msg.data[4], pcscan_msg.data[5]]))[0] / 10
-                        self.to_temperature(2, temperature_2) # use Temperature 2 as maximal cell temperature
-                        temperature_3 = unpack_from("<h", bytes([pcscan_msg.data[6], pcscan_msg.data[7]]))[0] / 10
-                        self.to_temperature(3, temperature_3) # use Temperature 3 as minimal cell temperature
-                        bms_check |= self.BITMASK[5]
-
-                    elif pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BMS_SW_HW]:
-                        # BMS software and hardware version
-                        self.bms_software_version = f'{int(pcscan_msg.data[0]):X}'.rjust(2,'0') + f'{int(pcscan_msg.data[1]):X}'.rjust(2,'0')
-                        self.custom_field = "BMS: " + self.bms_software_version + " Firmware: " + self.battery_software_version + " BOOT: " + self.battery_boot_version
-                        self.hardware_version = f'{int(pcscan_msg.data[2]):X}'.rjust(2,'0') + f'{int(pcscan_msg.data[3]):X}'.rjust(2,'0')
-                        self.init_check |= self.BITMASK[3]
-                        bms_check |= self.BITMASK[6]
-
-                    elif pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BMS_MODULE_STAT]:
-                        # Collected BMS status bits for all batteries
-                        bms_num_of_bat_in_operation = unpack_from("<B", bytes([pcscan_msg.data[0]]))[0]
-                        bms_num_of_bat_prohibited_charging = unpack_from("<B", bytes([pcscan_msg.data[1]]))[0]
-                        bms_num_of_bat_prohibited_discharging = unpack_from("<B", bytes([pcscan_msg.data[2]]))[0]
-                        bms_num_of_bat_com_disconnect = unpack_from("<B", bytes([pcscan_msg.data[3]]))[0]
-                        bms_num_of_bat_in_parallel = unpack_from("<B", bytes([pcscan_msg.data[4]]))[0]
-                        bms_check |= self.BITMASK[7]
-
-                    elif pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BMS_ERR_WARN_ALM]:
-                        # Collected alarms and status bits from BMS for all batteries
-                        self.bms_alarms = pcscan_msg.data
-                        logger.debug("CAN Message Data BMS alarms: %s",self.bms_alarms.hex())
-                        self.last_error_time = time.time()
-                        self.error_active = True
-                        self.to_protection_bits(self.bms_alarms, self.bat_alarms)
-                        bms_check |= self.BITMASK[8]
-
-                    elif pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BAT_TEMP_MAX_CURR]:
-                        # Individual MOSFET and HEATING temperatures, minimal and maximal battery current for each battery
-                        temperature_0 = unpack_from("<h", bytes([pcscan_msg.data[0], pcscan_msg.data[1]]))[0] / 10
-                        self.to_temperature(0, temperature_0)
-                        temperature_4 = unpack_from("<h", bytes([pcscan_msg.data[2], pcscan_msg.data[3]]))[0] / 10
-                        self.to_temperature(4, temperature_4)
-						# optional min and max battery currents for each separate battery instead of collected bms value for all batteries in sum
-#                        self.max_battery_current_bms = unpack_from("<H", bytes([pcscan_msg.data[4], pcscan_msg.data[5]]))[0]
-#                        self.min_battery_current_bms = unpack_from("<H", bytes([pcscan_msg.data[6], pcscan_msg.data[7]]))[0]
-                        bat_check |= self.BITMASK[0]
-
-                    elif pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BAT_SYS_STAT]:
-                        # Individual operation mode, failure level, charge cycles, balancing status and system substate for each battery
-                        battery_operation_mode = unpack_from("<B", bytes([pcscan_msg.data[0]]))[0]
-                        battery_failure_level = unpack_from("<B", bytes([pcscan_msg.data[1]]))[0]
-                        self.history.charge_cycles = unpack_from("<H", bytes([pcscan_msg.data[2], pcscan_msg.data[3]]))[0]
-                        battery_balancing_status = unpack_from(">H", bytes([pcscan_msg.data[4], pcscan_msg.data[5]]))[0]
-                        battery_system_substate = unpack_from("<B", bytes([pcscan_msg.data[6]]))[0]
-                        self.last_fet_status_time = time.time()
-                        self.fet_status_active = True
-                        self.to_fet_bits(battery_operation_mode, battery_balancing_status)
-                        self.init_check |= self.BITMASK[4]
-                        bat_check |= self.BITMASK[1]
-
-                    elif pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BAT_SW_DATA]:
-                        # Individual software and boot version for each battery
-                        self.battery_software_version = f'{int(pcscan_msg.data[0]):X}'.rjust(2,'0') + f'{int(pcscan_msg.data[1]):X}'.rjust(2,'0')
-                        self.battery_boot_version = "".join(map(chr, bytes([pcscan_msg.data[3], pcscan_msg.data[4], pcscan_msg.data[5], pcscan_msg.data[6], pcscan_msg.data[7]])))
-                        self.custom_field = "BMS: " + self.bms_software_version + " Firmware: " + self.battery_software_version + " BOOT: " + self.battery_boot_version
-                        self.init_check |= self.BITMASK[5]
-                        bat_check |= self.BITMASK[2]
-
-                    elif pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BAT_SERIAL1]:
-                        # Battery serial number part 1 of 2
-                        self.battery_serial_number1 =  "".join(map(chr, pcscan_msg.data))
-                        self.init_check |= self.BITMASK[6]
-                        bat_check |= self.BITMASK[3]
-
-                    elif pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BAT_SERIAL2]:
-                        # Battery serial number part 2 of 2
-                        self.battery_serial_number2 =  "".join(map(chr, pcscan_msg.data))
-                        self.init_check |= self.BITMASK[7]
-                        bat_check |= self.BITMASK[4]
-
-                    elif pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BAT_ERR_WARN_ALM_STAT]:
-                        # Individual alarms and status bits for each battery
-                        self.bat_alarms = pcscan_msg.data
-                        logger.debug("CAN Message Data BAT alarms: %s",self.bat_alarms.hex())
-                        self.last_error_time = time.time()
-                        self.error_active = True
-                        self.to_protection_bits(self.bms_alarms, self.bat_alarms)
-                        bat_check |= self.BITMASK[5]
-
-                    elif pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BAT_ENERGY]:
-                        # Total charged and discharged energy for each battery
-                        self.history.charged_energy = unpack_from("<L", bytes([pcscan_msg.data[0], pcscan_msg.data[1], pcscan_msg.data[2], pcscan_msg.data[3]]))[0] / 1000
-                        self.history.discharged_energy = unpack_from("<L", bytes([pcscan_msg.data[4], pcscan_msg.data[5], pcscan_msg.data[6], pcscan_msg.data[7]]))[0] / 1000
-                        bat_check |= self.BITMASK[6]
-
-                    elif pcscan_msg.arbitration_id in self.CAN_FRAMES[self.BAT_NUMBER_OF_FAULTS1]:
-                        # Number of high/low voltage, short circuit, overtemperature alarms
-                        self.history.high_voltage_alarms = unpack_from("<H", bytes([pcscan_msg.data[0], pcscan_msg.data[1]]))[0]
-                        self.history.low_voltage_alarms = unpack_from("<H", bytes([pcscan_msg.data[2], pcscan_msg.data[3]]))[0]
-                        bat_check |= self.BITMASK[7]
+                    self.decode_frame(pcscan_msg, self.decode_pcscan_frame)
 
                 if intercan_msg is not None:
                     messages_to_read -= 1
-                    # highest and lowest cell voltages received over INTERCAN (if available)
-                    if intercan_msg.arbitration_id in self.CAN_FRAMES[self.INTER_HIGH_LOW]:
-                        self.cell_max_voltage = unpack_from(">H", bytes([intercan_msg.data[0], intercan_msg.data[1]]))[0] / 1000
-                        self.cell_max_no = unpack_from("<B", bytes([intercan_msg.data[2]]))[0] # cell number for maximal cell voltage
-                        self.cell_min_voltage = unpack_from(">H", bytes([intercan_msg.data[3], intercan_msg.data[4]]))[0] / 1000
-                        self.cell_min_no = unpack_from("<B", bytes([intercan_msg.data[5]]))[0] # cell number for minimal cell voltage
-                        self.cell_mid_voltage = (self.cell_min_voltage + self.cell_max_voltage) / 2 # calculate mean cell voltage based on min and max values
-                        mean_cell_volt_available = True
-                        self.init_check |= self.BITMASK[2]
-                        if self.cell_voltages_intercan is False and self.init_done is True:
-                            self.simulate_cell_voltages()  # simulate cell voltages, if no cell voltages were received over INTERCAN
-                        if self.high_low_intercan is False and self.init_done is True:
-                            logger.info("Receive highest and lowest cell voltages from INTERCAN instead of PCSCAN")
-                        self.high_low_intercan_time = time.time()
-                        self.high_low_intercan = True
-                        intercan_check |= self.BITMASK[0]
-
-                    # cell voltages received over INTERCAN (if available)
-                    elif self.init_done is True and intercan_msg.arbitration_id in self.CAN_FRAMES[self.INTER_CELL_VOLTAGES0]:
-                        # cell voltages 1-4
-                        self.cells[0].voltage = unpack_from(">H", bytes([intercan_msg.data[0], intercan_msg.data[1]]))[0] / 1000
-                        self.cells[1].voltage = unpack_from(">H", bytes([intercan_msg.data[2], intercan_msg.data[3]]))[0] / 1000
-                        self.cells[2].voltage = unpack_from(">H", bytes([intercan_msg.data[4], intercan_msg.data[5]]))[0] / 1000
-                        self.cells[3].voltage = unpack_from(">H", bytes([intercan_msg.data[6], intercan_msg.data[7]]))[0] / 1000
-                        if self.cell_voltages_intercan is False and self.init_done is True:
-                            logger.info("Receive cell voltages from INTERCAN instead of simulation using min and max values from PCSCAN")
-                        self.cell_voltages_time = time.time()
-                        self.cell_voltages_intercan = True
-                        intercan_check |= self.BITMASK[1]
-
-                    elif self.init_done is True and intercan_msg.arbitration_id in self.CAN_FRAMES[self.INTER_CELL_VOLTAGES1]:
-                        # cell voltages 5-8
-                        self.cells[4].voltage = unpack_from(">H", bytes([intercan_msg.data[0], intercan_msg.data[1]]))[0] / 1000
-                        self.cells[5].voltage = unpack_from(">H", bytes([intercan_msg.data[2], intercan_msg.data[3]]))[0] / 1000
-                        self.cells[6].voltage = unpack_from(">H", bytes([intercan_msg.data[4], intercan_msg.data[5]]))[0] / 1000
-                        self.cells[7].voltage = unpack_from(">H", bytes([intercan_msg.data[6], intercan_msg.data[7]]))[0] / 1000
-                        if self.cell_voltages_intercan is False and self.init_done is True:
-                            logger.info("Receive cell voltages from INTERCAN instead of simulation using min and max values from PCSCAN")
-                        self.cell_voltages_time = time.time()
-                        self.cell_voltages_intercan = True
-                        intercan_check |= self.BITMASK[2]
-
-                    elif self.init_done is True and intercan_msg.arbitration_id in self.CAN_FRAMES[self.INTER_CELL_VOLTAGES2]:
-                        # cell voltages 9-12
-                        self.cells[8].voltage = unpack_from(">H", bytes([intercan_msg.data[0], intercan_msg.data[1]]))[0] / 1000
-                        self.cells[9].voltage = unpack_from(">H", bytes([intercan_msg.data[2], intercan_msg.data[3]]))[0] / 1000
-                        self.cells[10].voltage = unpack_from(">H", bytes([intercan_msg.data[4], intercan_msg.data[5]]))[0] / 1000
-                        self.cells[11].voltage = unpack_from(">H", bytes([intercan_msg.data[6], intercan_msg.data[7]]))[0] / 1000
-                        if self.cell_voltages_intercan is False and self.init_done is True:
-                            logger.info("Receive cell voltages from INTERCAN instead of simulation using min and max values from PCSCAN")
-                        self.cell_voltages_time = time.time()
-                        self.cell_voltages_intercan = True
-                        intercan_check |= self.BITMASK[3]
-
-                    elif self.init_done is True and intercan_msg.arbitration_id in self.CAN_FRAMES[self.INTER_CELL_VOLTAGES3]:
-                        # cell voltages 13-16
-                        self.cells[12].voltage = unpack_from(">H", bytes([intercan_msg.data[0], intercan_msg.data[1]]))[0] / 1000
-                        self.cells[13].voltage = unpack_from(">H", bytes([intercan_msg.data[2], intercan_msg.data[3]]))[0] / 1000
-                        self.cells[14].voltage = unpack_from(">H", bytes([intercan_msg.data[4], intercan_msg.data[5]]))[0] / 1000
-                        self.cells[15].voltage = unpack_from(">H", bytes([intercan_msg.data[6], intercan_msg.data[7]]))[0] / 1000
-                        if self.cell_voltages_intercan is False and self.init_done is True:
-                            logger.info("Receive cell voltages from INTERCAN instead of simulation using min and max values from PCSCAN")
-                        self.cell_voltages_time = time.time()
-                        self.cell_voltages_intercan = True
-                        intercan_check |= self.BITMASK[4]
-
-                if self.init_done is False and self.init_check & 255 == 255:
-                    self.init_done = self.init_battery_cell_settings() # init of battery cell settings after required values are received
-                    logger.debug("self.init_done = %d", self.init_done)
+                    self.decode_frame(intercan_msg, self.decode_intercan_frame)
+
+                self.check_init_done()
                 # bitwise status for receiving of CAN messages on PCSCAN and INTERCAN and status the INITIALISATION. Each bit represents respectively one CAN message or one init condition 
-                logger.debug("bms_check = %s, bat_check = %s, intercan_check = %s, self.init_check = %s", "{:016b}".format(bms_check), "{:016b}".format(bat_check), "{:016b}".format(intercan_check), "{:016b}".format(self.init_check))
+                logger.debug("bms_check = %s, bat_check = %s, intercan_check = %s, self.init_check = %s", "{:016b}".format(self.bms_check), "{:016b}".format(self.bat_check), "{:016b}".format(self.intercan_check), "{:016b}".format(self.init_check))
             return True
 
         except Exception:
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Round-robin time-series archive of the decoded DEYE CAN values with a fixed size on disk.
+# The reader part of this module has no dependencies to the rest of dbus-serialbattery.
+#
+# If DEYE_CAN_ARCHIVE is enabled, the battery voltage, current, SOC, temperatures and all cell voltages of each
+# battery are archived in the memory-mapped file DEYE_CAN_ARCHIVE_PATH/deye_can_<port>.archive with several
+# resolutions, e.g. DEYE_CAN_ARCHIVE_RESOLUTIONS = 1:86400,60:44640,3600:87600
+#   1 s buckets for one day, 1 min buckets for one month, 1 h buckets for ten years
+# Each bucket stores the minimum, mean and maximum of each value within the bucket. The buckets of a resolution
+# are a ring, the slot of a bucket is (bucket time / step) modulo number of buckets, so a query reads the buckets
+# of a time range directly without a search.
+# The values are aggregated in memory. Closed buckets are written to the file in one batch and synced every
+# DEYE_CAN_ARCHIVE_FLUSH_INTERVAL seconds.
+#
+# Layout (little endian, all offsets in bytes):
+#   0  4s  magic "DEYA"
+#   4  H   layout version
+#   6  H   number of series (SERIES)
+#   8  H   number of resolutions
+#  10  2x  reserved
+#  12      for each resolution: I step in seconds, I number of buckets, Q offset of the first bucket
+#          buckets: q start time in seconds since epoch, I number of samples, 4x reserved,
+#                   for each series f minimum, f mean, f maximum (NaN without a valid value)
+#
+# Reader on the command line:
+#   python3 deye_can_archive.py /data/dbus-serialbattery/archive/deye_can_can0.archive voltage cell_1 --from 2026-10-19T08:00
+#
+# By asmcc@github
+
+from datetime import datetime
+from struct import Struct
+import argparse
+import json
+import math
+import mmap
+import os
+import sys
+import time
+
+MAGIC = b"DEYA"
+LAYOUT_VERSION = 1
+MAX_CELLS = 16  # same as in deye_can_state.py
+
+HEADER = Struct("<4sHHH2x")
+RESOLUTION = Struct("<IIQ")
+BUCKET_HEADER = Struct("<qI4x")
+
+SERIES = (
+    "voltage",
+    "current",
+    "soc",
+    "temperature_mos",
+    "temperature_1",
+    "temperature_2",
+    "temperature_3",
+    "temperature_4",
+) + tuple(f"cell_{ii + 1}" for ii in range(MAX_CELLS))
+SERIES_INDEX = {name: index for index, name in enumerate(SERIES)}
+BUCKET_VALUES = Struct("<" + "f" * 3 * len(SERIES))
+BUCKET_SIZE = BUCKET_HEADER.size + BUCKET_VALUES.size
+
+
+def parse_resolutions(value: str) -> list:
+    """
+    Parse the resolutions of the archive.
+
+    :param value: Comma separated list of step:buckets, e.g. "1:86400,60:44640"
+    :return: List of tuples (step in seconds, number of buckets) ordered by the step
+    """
+    resolutions = []
+    for item in value.split(","):
+        if item.strip() != "":
+            step, buckets = item.split(":")
+            resolutions.append((int(step), int(buckets)))
+    return sorted(resolutions)
+
+
+def archive_size(resolutions: list) -> int:
+    return HEADER.size + RESOLUTION.size * len(resolutions) + BUCKET_SIZE * sum(buckets for _, buckets in resolutions)
+
+
+class Bucket:
+    """
+    Aggregation of the values within one bucket in memory.
+    """
+
+    def __init__(self, start: int):
+        self.start = start
+        self.samples = 0
+        self.minimum = [math.nan] * len(SERIES)
+        self.maximum = [math.nan] * len(SERIES)
+        self.sum = [0.0] * len(SERIES)
+        self.count = [0] * len(SERIES)
+
+    def add(self, values: list) -> None:
+        self.samples += 1
+        for ii, value in enumerate(values):
+            # missing values are NaN and not aggregated
+            if value == value:
+                if self.count[ii] == 0:
+                    self.minimum[ii] = self.maximum[ii] = value
+                elif value < self.minimum[ii]:
+                    self.minimum[ii] = value
+                elif value > self.maximum[ii]:
+                    self.maximum[ii] = value
+                self.sum[ii] += value
+                self.count[ii] += 1
+
+    def pack(self) -> bytes:
+        values = []
+        for ii in range(len(SERIES)):
+            mean = self.sum[ii] / self.count[ii] if self.count[ii] > 0 else math.nan
+            values += (self.minimum[ii], mean, self.maximum[ii])
+        return BUCKET_HEADER.pack(self.start, self.samples) + BUCKET_VALUES.pack(*values)
+
+
+def _read_layout(buffer):
+    # resolutions and offsets of an archive, None if the layout is not supported
+    magic, version, series, count = HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != LAYOUT_VERSION or series != len(SERIES):
+        return None
+    return [RESOLUTION.unpack_from(buffer, HEADER.size + ii * RESOLUTION.size) for ii in range(count)]
+
+
+class ArchiveWriter:
+    """
+    State writer (see deye_can_state.py), which archives the values of each written state record.
+    """
+
+    def __init__(self, path: str, resolutions: list, flush_interval: float = 300):
+        """
+        :param path: Path of the archive file, created or recreated if the layout does not match
+        :param resolutions: List of tuples (step in seconds, number of buckets)
+        :param flush_interval: Interval in seconds for writing the closed buckets to the file
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.resolutions = sorted(resolutions)
+        self.size = archive_size(self.resolutions)
+        self.buffer = self._open()
+        self.layout = _read_layout(self.buffer)
+        self.buckets = [None] * len(self.resolutions)
+        self.pending = []
+        self.last_flush = time.monotonic()
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path), mode=0o755, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            valid = False
+            if os.fstat(fd).st_size == self.size:
+                with mmap.mmap(fd, self.size, mmap.MAP_SHARED, mmap.PROT_READ) as buffer:
+                    layout = _read_layout(buffer)
+                    valid = layout is not None and [(step, buckets) for step, buckets, _ in layout] == self.resolutions
+            if not valid:
+                # new archive or changed resolutions: the file is recreated with the fixed size, empty buckets have the time 0
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+                header = HEADER.pack(MAGIC, LAYOUT_VERSION, len(SERIES), len(self.resolutions))
+                offset = HEADER.size + RESOLUTION.size * len(self.resolutions)
+                for step, buckets in self.resolutions:
+                    header += RESOLUTION.pack(step, buckets, offset)
+                    offset += buckets * BUCKET_SIZE
+                os.pwrite(fd, header, 0)
+            return mmap.mmap(fd, self.size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+
+    def write(self, record: bytes) -> None:
+        try:
+            from bms.deye_can_state import unpack_state
+        except ImportError:
+            from deye_can_state import unpack_state
+
+        state = unpack_state(record)
+        if state["init_done"] != 1:
+            return
+        cell_voltages = state["cell_voltages"]
+        values = [state[name] for name in SERIES[:-MAX_CELLS]] + cell_voltages + [math.nan] * (MAX_CELLS - len(cell_voltages))
+        self.add(state["timestamp"], values)
+
+    def add(self, timestamp: float, values: list) -> None:
+        """
+        Add a sample of all series.
+
+        :param timestamp: Time of the sample in seconds since epoch
+        :param values: Values in the order of SERIES, NaN for missing values
+        :return: None
+        """
+        for ii, (step, _) in enumerate(self.resolutions):
+            start = int(timestamp // step) * step
+            bucket = self.buckets[ii]
+            if bucket is not None and bucket.start != start:
+                self.pending.append((ii, bucket.start, bucket.pack()))
+                bucket = None
+            if bucket is None:
+                bucket = self.buckets[ii] = Bucket(start)
+            bucket.add(values)
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the closed and the open buckets to the file and sync it.
+
+        :return: None
+        """
+        # the open buckets are written too, so that queries see the current values; they are overwritten on close
+        for ii, start, data in self.pending + [(ii, bucket.start, bucket.pack()) for ii, bucket in enumerate(self.buckets) if bucket is not None]:
+            step, buckets, offset = self.layout[ii]
+            position = offset + (start // step) % buckets * BUCKET_SIZE
+            self.buffer[position : position + BUCKET_SIZE] = data
+        self.pending = []
+        self.buffer.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        self.flush()
+        self.buffer.close()
+
+
+def read_archive(path: str, series: list, start: float = None, end: float = None, step: int = None):
+    """
+    Read the buckets of a time range.
+
+    :param path: Path of the archive file
+    :param series: Names of the series, see SERIES
+    :param start: Start of the range in seconds since epoch, the retention time of the resolution before the end if None
+    :param end: End of the range in seconds since epoch, now if None
+    :param step: Resolution in seconds, the finest resolution covering the start if None
+    :return: Tuple (step, list of tuples (bucket time, {series: (minimum, mean, maximum)}))
+    """
+    end = time.time() if end is None else end
+    indexes = [SERIES_INDEX[name] for name in series]
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            layout = _read_layout(buffer)
+            if layout is None:
+                raise ValueError(f"{path} is no archive of this version")
+            if step is not None:
+                resolution = [item for item in layout if item[0] == step]
+                if len(resolution) == 0:
+                    raise ValueError(f"no resolution of {step} s in {path}")
+                resolution = resolution[0]
+            elif start is None:
+                resolution = layout[0]
+            else:
+                covering = [item for item in layout if time.time() - item[0] * item[1] <= start]
+                resolution = covering[0] if len(covering) > 0 else layout[-1]
+            step, buckets, offset = resolution
+            if start is None:
+                start = end - step * buckets
+            rows = []
+            bucket_time = int(max(start, end - step * buckets) // step) * step
+            while bucket_time < end:
+                position = offset + (bucket_time // step) % buckets * BUCKET_SIZE
+                stored_time, samples = BUCKET_HEADER.unpack_from(buffer, position)
+                # the slot may hold an older bucket or no bucket at all
+                if stored_time == bucket_time and samples > 0:
+                    values = BUCKET_VALUES.unpack_from(buffer, position + BUCKET_HEADER.size)
+                    rows.append((bucket_time, {SERIES[index]: values[index * 3 : index * 3 + 3] for index in indexes}))
+                bucket_time += step
+    return step, rows
+
+
+def _parse_time(value: str) -> float:
+    return datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the archived values of a DEYE CAN battery")
+    parser.add_argument("path", help="archive file, e.g. /data/dbus-serialbattery/archive/deye_can_can0.archive")
+    parser.add_argument("series", nargs="*", default=["voltage", "current", "soc"], help="series, one of: " + ", ".join(SERIES))
+    parser.add_argument("--from", dest="start", type=_parse_time, help="start time, e.g. 2026-10-19T08:00")
+    parser.add_argument("--to", dest="end", type=_parse_time, help="end time (exclusive)")
+    parser.add_argument("--step", type=int, help="resolution in seconds, the finest resolution covering the start time if missing")
+    parser.add_argument("--json", action="store_true", help="one JSON object per bucket")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.series if name not in SERIES_INDEX]
+    if len(unknown) > 0:
+        print("Unknown series: " + ", ".join(unknown))
+        sys.exit(2)
+    try:
+        step, rows = read_archive(args.path, args.series, args.start, args.end, args.step)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    try:
+        if not args.json:
+            print(f"# resolution {step} s, min/mean/max of " + ", ".join(args.series))
+        for bucket_time, values in rows:
+            if args.json:
+                print(json.dumps({"time": bucket_time, **{name: [None if value != value else round(value, 4) for value in item] for name, item in values.items()}}))
+            else:
+                print(
+                    datetime.fromtimestamp(bucket_time).isoformat(sep=" ")
+                    + "  "
+                    + "  ".join(f"{name} " + "/".join(f"{value:.3f}" for value in item) for name, item in values.items())
+                )
+    except BrokenPipeError:
+        pass
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Accounting of the cell balancing of DEYE CAN batteries, used to spot weak cells.
+# This module has no dependencies to the rest of dbus-serialbattery, so it can be used by external readers.
+#
+# If DEYE_CAN_BALANCING is enabled, each BAT_SYS_STAT message (0x400) updates for each cell:
+#   - the total balancing time
+#   - the number of balancing events (start of balancing)
+#   - the balancing time in the slots of two rolling windows (1 hour in minute slots, 1 day in hour slots),
+#     the duty cycle is the balancing time in the window divided by the length of the window
+# The time between two messages is accounted to the cells, which were balancing according to the previous message.
+# Only the cells with a set bit are visited, so an update costs nearly nothing, if no cell is balancing.
+# Gaps longer than MAX_GAP seconds (lost messages, restart) are accounted with MAX_GAP only.
+#
+# All counters have a fixed size. They are saved every DEYE_CAN_BALANCING_SAVE_INTERVAL seconds and on exit to
+# DEYE_CAN_BALANCING_PATH/deye_can_<port>.balancing and loaded again after a restart.
+#
+# File layout (little endian):
+#   header, see HEADER: magic "DEVB", layout version, number of cells, mask of the balancing cells,
+#                       start time of the accounting and time of the last update in seconds since epoch
+#   total balancing time of each cell in seconds (d)
+#   number of balancing events of each cell (I)
+#   for each window: index of the current slot (q), balancing time in seconds of each slot and cell (f)
+#
+# Reader on the command line:
+#   python3 deye_can_balancing.py /data/dbus-serialbattery/balancing/deye_can_can0.balancing
+#
+# By asmcc@github
+
+from array import array
+from struct import Struct
+import argparse
+import os
+import sys
+import time
+
+MAGIC = b"DEVB"
+LAYOUT_VERSION = 1
+HEADER = Struct("<4sHHLdd")
+SLOT_INDEX = Struct("<q")
+CELLS = 16
+MAX_GAP = 10
+# rolling windows: (name, length of a slot in seconds, number of slots)
+WINDOWS = (
+    ("1h", 60, 60),
+    ("24h", 3600, 24),
+)
+
+
+class BalancingCounters:
+    """
+    Balancing time, events and rolling duty cycles of the cells of one battery.
+    """
+
+    def __init__(self, path: str = None, save_interval: float = 300, cells: int = CELLS):
+        """
+        :param path: File for saving and loading the counters, None to keep them in memory only
+        :param save_interval: Interval in seconds for saving the counters with save_if_due()
+        :param cells: Number of cells (bits of the balancing mask)
+        """
+        self.path = path
+        self.save_interval = save_interval
+        self.cells = cells
+        self.cell_mask = (1 << cells) - 1
+        self.read_only = False
+        self.mask = 0
+        self.start_time = None
+        self.last_time = None
+        self.last_save = time.monotonic()
+        self.mtime = None
+        self.time = array("d", bytes(8 * cells))
+        self.events = array("I", bytes(4 * cells))
+        self.slot_index = [0] * len(WINDOWS)
+        self.slots = [array("f", bytes(4 * cells * slots)) for _, _, slots in WINDOWS]
+        if path is not None and os.path.isfile(path):
+            self.load()
+
+    def update(self, mask: int, timestamp: float) -> None:
+        """
+        Account the balancing state of a BAT_SYS_STAT message.
+
+        :param mask: Balancing bitmask, bit 0 = cell 1
+        :param timestamp: Receive time of the message in seconds since epoch
+        :return: None
+        """
+        previous = self.mask
+        self.mask = mask & self.cell_mask
+        last = self.last_time
+        self.last_time = timestamp
+        if self.start_time is None:
+            self.start_time = timestamp
+
+        # events: cells, which started balancing
+        started = self.mask & ~previous
+        while started:
+            bit = started & -started
+            cell = bit.bit_length() - 1
+            self.events[cell] = (self.events[cell] + 1) & 0xFFFFFFFF
+            started ^= bit
+
+        self._roll(timestamp)
+        if previous == 0 or last is None:
+            return
+        elapsed = min(timestamp - last, MAX_GAP)
+        if elapsed <= 0:
+            return
+        # balancing time of the cells, which were balancing since the last message
+        offsets = [self.slot_index[window] % WINDOWS[window][2] * self.cells for window in range(len(WINDOWS))]
+        while previous:
+            bit = previous & -previous
+            cell = bit.bit_length() - 1
+            self.time[cell] += elapsed
+            for window, offset in enumerate(offsets):
+                self.slots[window][offset + cell] += elapsed
+            previous ^= bit
+
+    def _roll(self, timestamp: float) -> None:
+        # move the windows to the slot of the timestamp, the passed slots are cleared
+        for window, (_, slot_seconds, slots) in enumerate(WINDOWS):
+            index = int(timestamp // slot_seconds)
+            if index == self.slot_index[window]:
+                continue
+            # also a clock set back clears the window
+            passed = index - self.slot_index[window] if index > self.slot_index[window] else slots
+            for clear in range(self.slot_index[window] + 1, self.slot_index[window] + 1 + min(passed, slots)):
+                offset = clear % slots * self.cells
+                self.slots[window][offset : offset + self.cells] = array("f", bytes(4 * self.cells))
+            self.slot_index[window] = index
+
+    def duty_cycles(self, window: int, now: float = None) -> list:
+        """
+        Duty cycle of each cell within a rolling window.
+
+        :param window: Index of WINDOWS
+        :param now: Time in seconds since epoch, time of the last update if None
+        :return: List of the duty cycles (0 - 1) of the cells
+        """
+        _, slot_seconds, slots = WINDOWS[window]
+        now = self.last_time if now is None else now
+        if now is None or self.start_time is None:
+            return [0.0] * self.cells
+        self._roll(now)
+        # the window is shorter, as long as the accounting did not run for the whole window
+        length = min(slot_seconds * slots, max(now - self.start_time, slot_seconds))
+        totals = [0.0] * self.cells
+        values = self.slots[window]
+        for offset in range(0, len(values), self.cells):
+            for cell in range(self.cells):
+                totals[cell] += values[offset + cell]
+        return [min(1.0, total / length) for total in totals]
+
+    def pack(self) -> bytes:
+        data = bytearray(HEADER.pack(MAGIC, LAYOUT_VERSION, self.cells, self.mask, self.start_time or 0, self.last_time or 0))
+        data += self.time.tobytes() + self.events.tobytes()
+        for window in range(len(WINDOWS)):
+            data += SLOT_INDEX.pack(self.slot_index[window]) + self.slots[window].tobytes()
+        return bytes(data)
+
+    def unpack(self, data: bytes) -> bool:
+        """
+        Take over saved counters.
+
+        :param data: Content of a saved file
+        :return: True if the counters were taken over, False if the file has another layout
+        """
+        size = HEADER.size + 12 * self.cells + sum(SLOT_INDEX.size + 4 * self.cells * slots for _, _, slots in WINDOWS)
+        if len(data) != size:
+            return False
+        magic, version, cells, mask, start_time, last_time = HEADER.unpack_from(data)
+        if magic != MAGIC or version != LAYOUT_VERSION or cells != self.cells:
+            return False
+        self.mask = mask
+        self.start_time = start_time or None
+        self.last_time = last_time or None
+        offset = HEADER.size
+        self.time = array("d", data[offset : offset + 8 * self.cells])
+        offset += 8 * self.cells
+        self.events = array("I", data[offset : offset + 4 * self.cells])
+        offset += 4 * self.cells
+        for window, (_, _, slots) in enumerate(WINDOWS):
+            self.slot_index[window] = SLOT_INDEX.unpack_from(data, offset)[0]
+            offset += SLOT_INDEX.size
+            self.slots[window] = array("f", data[offset : offset + 4 * self.cells * slots])
+            offset += 4 * self.cells * slots
+        return True
+
+    def load(self) -> bool:
+        with open(self.path, "rb") as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime
+            return self.unpack(f.read())
+
+    def reload_if_changed(self) -> bool:
+        """
+        Load the counters again, if the file was saved by another process (ingestion process).
+
+        :return: True if the counters were loaded
+        """
+        try:
+            if os.stat(self.path).st_mtime == self.mtime:
+                return False
+            return self.load()
+        except OSError:
+            return False
+
+    def save(self) -> None:
+        # write atomically, the old file stays valid, if the write is interrupted
+        self.last_save = time.monotonic()
+        if self.path is None or self.read_only is True:
+            return
+        os.makedirs(os.path.dirname(self.path), mode=0o755, exist_ok=True)
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(self.pack())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+    def save_if_due(self) -> None:
+        if time.monotonic() - self.last_save >= self.save_interval:
+            self.save()
+
+    def close(self) -> None:
+        # save the counters once more, the counters are still readable but no longer saved
+        self.save()
+        self.read_only = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the balancing counters of a DEYE CAN battery")
+    parser.add_argument("file", help="counter file, e.g. /data/dbus-serialbattery/balancing/deye_can_can0.balancing")
+    args = parser.parse_args()
+
+    counters = BalancingCounters()
+    with open(args.file, "rb") as file:
+        if not counters.unpack(file.read()):
+            print("Unknown layout of " + args.file)
+            sys.exit(1)
+    duty_cycles = [counters.duty_cycles(window) for window in range(len(WINDOWS))]
+    print("cell  balancing [h]  events  " + "  ".join(f"duty {name:>4}" for name, _, _ in WINDOWS))
+    for cell in range(counters.cells):
+        print(
+            f"{cell + 1:4d}  {counters.time[cell] / 3600:13.2f}  {counters.events[cell]:6d}  "
+            + "  ".join(f"{duty_cycles[window][cell] * 100:8.1f}%" for window in range(len(WINDOWS)))
+        )
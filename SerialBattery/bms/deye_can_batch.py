@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Batch decoding of a backlog of DEYE CAN messages, e.g. after a stall of the driver or a busy system.
+# If DEYE_CAN_BATCH_DECODE is enabled and more messages are queued on the CAN sockets than are read in one poll,
+# all queued messages are drained and decoded as one batch:
+#   - the messages are grouped by arbitration id; only the last message of each id is decoded, because the
+#     older messages are superseded. Alarm and MOSFET status messages are decoded on each change, so that every
+#     transition is still recorded (event journal). The superseded BAT_SYS_STAT messages are still passed to the
+#     balancing accounting, which accounts the time between consecutive messages
+#   - the remaining messages (at most one per id) are decoded with the scalar decoders of Deye_Can. A vectorized
+#     decoding of the cell voltages does not pay off for the one to four cell voltage messages per stack
+#
+# By asmcc@github
+
+
+def drain(bus, limit: int) -> list:
+    """
+    Receive the queued messages of a CAN bus without waiting.
+
+    :param bus: python-can bus
+    :param limit: Maximal number of received messages
+    :return: List of the received messages in the order of reception
+    """
+    messages = []
+    while len(messages) < limit:
+        msg = bus.recv(0)
+        if msg is None:
+            break
+        messages.append(msg)
+    return messages
+
+
+def decode_batch(battery, frames: list) -> None:
+    """
+    Decode a backlog of messages.
+
+    :param battery: Deye_Can battery instance
+    :param frames: List of tuples (message, decode function of the battery) in the order of reception
+    :return: None
+    """
+    transition_ids = battery.TRANSITION_FRAMES
+    balancing_ids = battery.CAN_FRAMES[battery.BAT_SYS_STAT] if battery.balancing is not None else ()
+    latest = {}
+    payloads = {}
+    for msg, decode in frames:
+        if not battery.frame_is_valid(msg):
+            continue
+        superseded = latest.pop(msg.arbitration_id, None)
+        if superseded is not None and msg.arbitration_id in balancing_ids:
+            # the balancing time is accounted between consecutive messages
+            battery.account_balancing(superseded[0])
+        if msg.arbitration_id in transition_ids and payloads.get(msg.arbitration_id, battery.frame_data.get(msg.arbitration_id)) != msg.data:
+            # changed alarm or MOSFET status: decoded in order, so that each transition is recorded
+            battery.decode_frame(msg, decode)
+        else:
+            latest[msg.arbitration_id] = (msg, decode)
+        payloads[msg.arbitration_id] = msg.data
+
+    for msg, decode in latest.values():
+        battery.decode_frame(msg, decode)
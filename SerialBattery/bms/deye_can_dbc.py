@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Compiler of the DEYE CAN protocol description deye_can.dbc into decoder functions.
+# This module has no dependencies to the rest of dbus-serialbattery, so it can be used by external tools, e.g. the
+# offline analysis tools/deye_can_analyze.py. The driver decodes the CAN messages with the generated functions and
+# maps the returned values onto the battery (bms/deye_can.py).
+#
+# The DBC file describes the PCSCAN and INTERCAN messages declaratively: start bit, length, byte order
+# (@1 little endian, @0 big endian), sign, factor and offset of each signal. load_decoders() generates Python
+# source with one specialized function per message: the byte aligned signals of a message are unpacked with one
+# precompiled struct.Struct and scaled with constant factors, the other signals (status bits) are extracted with
+# shifts and masks. Factors like 0.1 are compiled as division by 10, so the values are the same as the ones of the
+# hand-coded decoders.
+#
+# The generated module is cached as deye_can_decoders_<hash>.py in the cache directory (bytecode in __pycache__),
+# the hash covers the DBC file and the compiler version. On the next start only the DBC file is hashed, it is
+# neither parsed nor compiled again. Without a writable cache directory the module is compiled in memory.
+#
+# Show the generated module on the command line:
+#   python3 deye_can_dbc.py deye_can.dbc
+#
+# By asmcc@github
+
+from hashlib import sha1
+import argparse
+import importlib.util
+import os
+import re
+import sys
+import types
+
+COMPILER_VERSION = 1
+MODULE_PREFIX = "deye_can_decoders_"
+EXTENDED_ID_FLAG = 0x80000000
+
+_MESSAGE = re.compile(r"^BO_\s+(\d+)\s+(\w+)\s*:\s*(\d+)\s+\w+")
+_SIGNAL = re.compile(
+    r"^SG_\s+(\w+)\s*(\S+)?\s*:\s*(\d+)\|(\d+)@([01])([+-])\s*\(([^,]+),([^)]+)\)\s*\[[^]]*\]\s*\"([^\"]*)\""
+)
+_STRUCT_CODES = {(1, False): "B", (1, True): "b", (2, False): "H", (2, True): "h", (4, False): "L", (4, True): "l", (8, False): "Q", (8, True): "q"}
+
+
+class Signal:
+    def __init__(self, name: str, start: int, length: int, little_endian: bool, signed: bool, factor: float, offset: float, unit: str):
+        self.name = name
+        self.start = start
+        self.length = length
+        self.little_endian = little_endian
+        self.signed = signed
+        self.factor = factor
+        self.offset = offset
+        self.unit = unit
+
+    def byte_range(self):
+        # first and last data byte of the signal
+        if self.little_endian:
+            return self.start // 8, (self.start + self.length - 1) // 8
+        # big endian: the start bit is the most significant bit, the following bits continue in the next bytes
+        return self.start // 8, self.start // 8 + (max(0, self.length - self.start % 8 - 1) + 7) // 8
+
+    def aligned(self) -> bool:
+        # byte aligned signals are unpacked with struct
+        if (self.length // 8, self.signed) not in _STRUCT_CODES or self.length % 8 != 0:
+            return False
+        return self.start % 8 == (0 if self.little_endian else 7)
+
+
+class Message:
+    def __init__(self, arbitration_id: int, name: str, length: int):
+        self.arbitration_id = arbitration_id
+        self.name = name
+        self.length = length
+        self.signals = []
+
+    def min_length(self) -> int:
+        # number of data bytes needed to decode all signals
+        return max([signal.byte_range()[1] + 1 for signal in self.signals], default=0)
+
+
+def parse_dbc(text: str) -> list:
+    """
+    Parse the messages and signals of a DBC file. Other sections (comments, value tables) are ignored.
+
+    :param text: Content of the DBC file
+    :return: List of Message
+    """
+    messages = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if line.startswith("BO_ "):
+            match = _MESSAGE.match(line)
+            if match is None:
+                raise ValueError(f"line {number}: invalid message: {line}")
+            arbitration_id = int(match.group(1))
+            if arbitration_id & EXTENDED_ID_FLAG:
+                arbitration_id &= 0x1FFFFFFF
+            messages.append(Message(arbitration_id, match.group(2), int(match.group(3))))
+        elif line.startswith("SG_ "):
+            match = _SIGNAL.match(line)
+            if match is None or len(messages) == 0:
+                raise ValueError(f"line {number}: invalid signal: {line}")
+            if match.group(2) is not None:
+                raise ValueError(f"line {number}: multiplexed signals are not supported: {line}")
+            messages[-1].signals.append(
+                Signal(
+                    match.group(1),
+                    int(match.group(3)),
+                    int(match.group(4)),
+                    match.group(5) == "1",
+                    match.group(6) == "-",
+                    float(match.group(7)),
+                    float(match.group(8)),
+                    match.group(9),
+                )
+            )
+    return messages
+
+
+def _scaled(signal: Signal, raw: str) -> str:
+    # scaling expression of a raw value, factors like 0.1 as division to get the same values as the hand-coded decoders
+    if signal.factor == 1 and signal.offset == 0:
+        return raw
+    if signal.factor != 0 and abs(1 / signal.factor - round(1 / signal.factor)) < 1e-9 and abs(signal.factor) < 1:
+        expression = f"{raw} / {round(1 / signal.factor)}"
+    else:
+        expression = f"{raw} * {signal.factor!r}"
+    if signal.offset != 0:
+        expression += f" + {signal.offset!r}"
+    return expression
+
+
+def _bits(signal: Signal) -> str:
+    # expression extracting a signal, which is not byte aligned
+    first, last = signal.byte_range()
+    mask = (1 << signal.length) - 1
+    if first == last:
+        value = f"data[{first}]"
+    else:
+        value = f"int.from_bytes(data[{first}:{last + 1}], \"{'little' if signal.little_endian else 'big'}\")"
+    if signal.little_endian:
+        shift = signal.start - first * 8
+    else:
+        shift = (last - first) * 8 + signal.start % 8 - signal.length + 1
+    expression = f"({value} >> {shift})" if shift else value
+    return f"{expression} & {mask:#x}"
+
+
+def _struct_groups(signals: list) -> list:
+    # byte aligned signals, grouped by byte order into non overlapping groups unpacked with one struct each
+    groups = []
+    for little_endian in (True, False):
+        group = []
+        end = 0
+        for signal in sorted((signal for signal in signals if signal.aligned() and signal.little_endian == little_endian), key=lambda signal: signal.start // 8):
+            if signal.start // 8 < end and len(group) > 0:
+                groups.append(group)
+                group = []
+                end = 0
+            group.append(signal)
+            end = signal.start // 8 + signal.length // 8
+        if len(group) > 0:
+            groups.append(group)
+    return groups
+
+
+def compile_source(messages: list, digest: str = "") -> str:
+    """
+    Generate the Python source of the decoder module.
+
+    :param messages: List of Message
+    :param digest: Hash of the DBC file, written to the header of the module
+    :return: Source of the module with DECODERS (id -> function(data) -> dict), MESSAGE_NAMES, MESSAGE_LENGTHS and SIGNAL_UNITS
+    """
+    lines = [
+        "# -*- coding: utf-8 -*-",
+        f"# Generated by deye_can_dbc.py (compiler version {COMPILER_VERSION}) from a DBC file with hash {digest}, do not edit",
+        "",
+        "from struct import Struct",
+        "",
+    ]
+    struct_lines = []
+    function_lines = []
+    functions = []
+    structs = 0
+    for message in messages:
+        body = []
+        values = {}
+        for group in _struct_groups(message.signals):
+            fmt = "<" if group[0].little_endian else ">"
+            position = first = group[0].start // 8
+            names = []
+            for signal in group:
+                fmt += "x" * (signal.start // 8 - position) + _STRUCT_CODES[(signal.length // 8, signal.signed)]
+                position = signal.start // 8 + signal.length // 8
+                names.append(f"r{len(values)}")
+                values[signal.name] = _scaled(signal, names[-1])
+            struct_lines.append(f"_S{structs} = Struct({fmt!r})")
+            unpack = f"_S{structs}.unpack_from(data, {first})" if first else f"_S{structs}.unpack_from(data)"
+            body.append(f"    {', '.join(names)}, = {unpack}" if len(names) == 1 else f"    {', '.join(names)} = {unpack}")
+            structs += 1
+        for signal in message.signals:
+            if signal.name in values:
+                continue
+            raw = _bits(signal)
+            if signal.signed:
+                body.append(f"    r{len(values)} = {raw}")
+                body.append(f"    if r{len(values)} & {1 << (signal.length - 1):#x}:")
+                body.append(f"        r{len(values)} -= {1 << signal.length:#x}")
+                raw = f"r{len(values)}"
+            values[signal.name] = _scaled(signal, raw if signal.signed or (signal.factor == 1 and signal.offset == 0) else f"({raw})")
+        function = f"decode_{message.arbitration_id:x}"
+        functions.append((message, function))
+        function_lines.append("")
+        function_lines.append("")
+        function_lines.append(f"def {function}(data):")
+        function_lines.append(f"    # {message.name}")
+        function_lines.extend(body)
+        if len(values) == 0:
+            function_lines.append("    return {}")
+        else:
+            function_lines.append("    return {")
+            for signal in message.signals:
+                function_lines.append(f"        {signal.name!r}: {values[signal.name]},")
+            function_lines.append("    }")
+    lines.extend(struct_lines)
+    lines.extend(function_lines)
+    lines.append("")
+    lines.append("")
+    lines.append("DECODERS = {")
+    lines.extend(f"    {message.arbitration_id:#x}: {function}," for message, function in functions)
+    lines.append("}")
+    lines.append("MESSAGE_NAMES = {")
+    lines.extend(f"    {message.arbitration_id:#x}: {message.name!r}," for message in messages)
+    lines.append("}")
+    lines.append("MESSAGE_LENGTHS = {")
+    lines.extend(f"    {message.arbitration_id:#x}: {message.min_length()}," for message in messages)
+    lines.append("}")
+    lines.append("SIGNAL_UNITS = {")
+    lines.extend(f"    {signal.name!r}: {signal.unit!r}," for signal in {signal.name: signal for message in messages for signal in message.signals}.values() if signal.unit)
+    lines.append("}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+def _digest(text: str) -> str:
+    return sha1(f"{COMPILER_VERSION}\n{text}".encode("utf-8")).hexdigest()[:16]
+
+
+def _compile_in_memory(name: str, source: str, origin: str):
+    module = types.ModuleType(name)
+    module.__file__ = origin
+    exec(compile(source, origin, "exec"), module.__dict__)
+    return module
+
+
+def load_decoders(dbc_path: str, cache_path: str = None):
+    """
+    Load the decoder module of a DBC file, compiled only if it is not in the cache.
+
+    :param dbc_path: Path of the DBC file
+    :param cache_path: Directory of the compiled modules, no disk cache if None or empty
+    :return: Module with DECODERS, MESSAGE_NAMES, MESSAGE_LENGTHS and SIGNAL_UNITS
+    """
+    with open(dbc_path, "r", encoding="utf-8") as f:
+        text = f.read()
+    digest = _digest(text)
+    name = MODULE_PREFIX + digest
+    if name in sys.modules:
+        return sys.modules[name]
+
+    path = None if not cache_path else os.path.join(cache_path, name + ".py")
+    if path is None or not os.path.isfile(path):
+        source = compile_source(parse_dbc(text), digest)
+        if path is None:
+            return _compile_in_memory(name, source, dbc_path)
+        try:
+            os.makedirs(cache_path, mode=0o755, exist_ok=True)
+            # write atomically, a concurrently started driver reads either no module or the complete one
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(source)
+            os.replace(path + ".tmp", path)
+            # remove the modules of older DBC files or compiler versions
+            for old in os.listdir(cache_path):
+                if old.startswith(MODULE_PREFIX) and old.endswith(".py") and old != name + ".py":
+                    os.unlink(os.path.join(cache_path, old))
+        except OSError:
+            return _compile_in_memory(name, source, dbc_path)
+
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[name] = module
+    return module
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile a DBC file into decoder functions and show the generated module")
+    parser.add_argument("dbc", nargs="?", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "deye_can.dbc"), help="DBC file, default deye_can.dbc")
+    args = parser.parse_args()
+
+    with open(args.dbc, "r", encoding="utf-8") as f:
+        dbc_text = f.read()
+    print(compile_source(parse_dbc(dbc_text), _digest(dbc_text)))
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Separate ingestion process for DEYE CAN batteries.
+# The child process owns the PCSCAN and INTERCAN sockets, decodes the CAN messages and writes the decoded state
+# into a shared memory segment. The dbus main loop only reads consistent snapshots from this segment,
+# so CAN decoding and dbus publishing do not share the same interpreter and GIL and can run on separate cores.
+#
+# The process is started with the spawn method, because the driver already runs threads (CanReceiverThreads, MQTT)
+# when the process is started, which must not be copied in an inconsistent state by fork. The battery is created
+# again in the new interpreter from the decoded state of the driver (see Deye_Can.handoff_state()), which also opens
+# the outputs (state file, MQTT, journal, archive, balancing) after the driver closed them.
+# The process stops on SIGINT and SIGTERM and ignores SIGHUP (the config is reloaded by the driver).
+# A process, which exited unexpectedly, is started again by the driver after a backoff time.
+#
+# By asmcc@github
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+from multiprocessing import shared_memory
+from bms.deye_can_state import SIZE, StateReader, StateWriter, unpack_state
+from utils import logger
+import multiprocessing
+import os
+import signal
+import time
+
+RESTART_BACKOFF_MAX = 60  # maximal time in seconds before an exited ingestion process is started again
+
+
+def _ingest_main(battery_class, port: str, baud: int, address, handoff: dict, shm_name: str, stop_event, parent_pid: int) -> None:
+    """
+    Main function of the ingestion process.
+
+    :param battery_class: Class of the battery (Deye_Can)
+    :param port: CAN interface of the battery
+    :param baud: Bitrate of the battery
+    :param address: Address of the battery
+    :param handoff: Decoded state of the driver, returned by handoff_state() of the battery
+    :param shm_name: Name of the shared memory segment
+    :param stop_event: Event to stop the process
+    :param parent_pid: Process id of the driver, the process stops if the driver is gone
+    :return: None
+    """
+    from utils_ext import SIGNAL_PROFILER
+
+    # the signal handlers only set a flag, the process stops after the current poll
+    stopping = []
+    signal.signal(signal.SIGINT, lambda sig, frame: stopping.append(sig))
+    signal.signal(signal.SIGTERM, lambda sig, frame: stopping.append(sig))
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    profiler = None
+    if SIGNAL_PROFILER:
+        from utils_profiler import SignalProfiler
+
+        # the profiling is started and stopped after the current poll
+        profiler = SignalProfiler()
+        profiler.install(signal.SIGUSR1)
+    else:
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+    battery = battery_class(port, baud, address)
+    battery.adopt_state(handoff)
+    battery.init_state_writers()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    # the shared memory segment is written in addition to the exported state file (if enabled)
+    battery.state_writers.append(StateWriter(shm.buf))
+    logger.info(f"DEYE CAN ingestion process started with pid {os.getpid()}")
+    try:
+        while not stopping and not stop_event.is_set() and os.getppid() == parent_pid:
+            battery.read_status_data()
+            if profiler is not None:
+                profiler.poll()
+    finally:
+        battery.shutdown_buses()
+        battery.state_writers.pop()
+        battery.close_outputs()
+        shm.close()
+        logger.info("DEYE CAN ingestion process stopped")
+
+
+class DeyeCanIngestProcess:
+    """
+    Owner of the ingestion process and the shared memory segment on the driver side.
+    """
+
+    def __init__(self, battery):
+        self.battery = battery
+        self.shm = None
+        self.reader = None
+        self.process = None
+        self.stop_event = None
+        self.last_record = b""
+        # decoded values changed since the last read_state() call
+        self.changed = False
+        self.start_time = 0
+        self.restart_backoff = 0
+        self.restart_time = None
+
+    def start(self) -> bool:
+        """
+        Start the ingestion process. The CAN buses of the battery are closed in this process
+        and opened again in the ingestion process.
+
+        :return: True if the process was started, False otherwise
+        """
+        try:
+            self.shm = shared_memory.SharedMemory(create=True, size=SIZE)
+            self.reader = StateReader(self.shm.buf)
+            self.stop_event = multiprocessing.get_context("spawn").Event()
+            self.battery.shutdown_buses()
+            self.spawn()
+        except Exception as e:
+            logger.error(f"Error while starting DEYE CAN ingestion process: {e}")
+            self.stop()
+            return False
+        return True
+
+    def spawn(self) -> None:
+        # new interpreter without the threads of the driver, the battery is created again from its decoded state
+        self.process = multiprocessing.get_context("spawn").Process(
+            target=_ingest_main,
+            args=(
+                type(self.battery),
+                self.battery.port,
+                self.battery.baud_rate,
+                self.battery.address,
+                self.battery.handoff_state(),
+                self.shm.name,
+                self.stop_event,
+                os.getpid(),
+            ),
+            name="deye-can-ingest",
+            daemon=True,
+        )
+        self.process.start()
+        self.start_time = time.monotonic()
+
+    def restart(self) -> None:
+        """
+        Start an exited ingestion process again, the time between two starts doubles up to RESTART_BACKOFF_MAX seconds.
+
+        :return: None
+        """
+        now = time.monotonic()
+        if self.restart_time is None:
+            # a process, which ran longer than the maximal backoff, is started again after the minimal backoff
+            if now - self.start_time > RESTART_BACKOFF_MAX:
+                self.restart_backoff = 0
+            self.restart_backoff = min(max(self.restart_backoff * 2, 1), RESTART_BACKOFF_MAX)
+            self.restart_time = now + self.restart_backoff
+            logger.error(f"DEYE CAN ingestion process exited with code {self.process.exitcode}, restart in {self.restart_backoff} seconds")
+            return
+        if now < self.restart_time:
+            return
+        self.restart_time = None
+        try:
+            self.spawn()
+        except Exception as e:
+            # the exited process is still known, so the next call schedules the next attempt
+            logger.error(f"Error while restarting DEYE CAN ingestion process: {e}")
+
+    def read_state(self, max_age: float):
+        """
+        Read the last decoded state from the shared memory segment.
+
+        :param max_age: Maximal age of the state in seconds
+        :return: Dictionary returned by unpack_state(), None if no valid state is available
+        """
+        if self.process is None:
+            logger.error("DEYE CAN ingestion process is not running")
+            return None
+        if not self.process.is_alive():
+            self.restart()
+            return None
+        record = self.reader.read()
+        if record is None:
+            return None
+        # the timestamp in the first 8 bytes changes with every write
+        self.changed = record[8:] != self.last_record[8:]
+        self.last_record = record
+        state = unpack_state(record)
+        if time.time() - state["timestamp"] > max_age:
+            logger.warning(f"DEYE CAN ingestion state is older than {max_age} seconds")
+            return None
+        return state
+
+    def stop(self) -> None:
+        """
+        Stop the ingestion process and release the shared memory segment.
+
+        :return: None
+        """
+        if self.stop_event is not None:
+            self.stop_event.set()
+        if self.process is not None:
+            self.process.join(3)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
+        if self.shm is not None:
+            self.reader = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
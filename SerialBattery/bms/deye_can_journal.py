@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Append-only binary journal of the alarm and MOSFET state transitions of DEYE CAN batteries.
+# This module has no dependencies to the rest of dbus-serialbattery, so it can be used by external readers.
+#
+# If DEYE_CAN_JOURNAL is enabled, each transition decoded by to_protection_bits() and to_fet_bits() is recorded
+# in the directory DEYE_CAN_JOURNAL_PATH/<port>. Only transitions are recorded, so the journal grows only, if
+# something changes. The records are buffered in memory and written with one write and fsync every
+# DEYE_CAN_JOURNAL_FLUSH_INTERVAL seconds, so the SD card is not written on every transition.
+#
+# The journal is split into segment files named by the hexadecimal start time of the segment in microseconds.
+# The file names are the time index: a range query opens only the segments covering the range and finds the
+# first record by binary search, because the records within a segment are ordered by time.
+# The oldest segments are deleted, if there are more than DEYE_CAN_JOURNAL_MAX_SEGMENTS segments.
+#
+# Segment layout (little endian, all offsets in bytes):
+#   0  4s  magic "DEVJ"
+#   4  H   layout version
+#   6  H   size of a record
+#   8  Q   start time of the segment in microseconds since epoch
+#  16      records, see RECORD:
+#            Q   time in microseconds since epoch (not decreasing within the journal)
+#            H   pack (bus address of the battery)
+#            B   event id, index of EVENT_NAMES
+#            B   old level
+#            B   new level
+#            3x  reserved
+#
+# Reader on the command line:
+#   python3 deye_can_journal.py /data/dbus-serialbattery/journal/can0 --from "2026-10-19 08:00" --event high_cell_voltage
+#
+# By asmcc@github
+
+from datetime import datetime
+from struct import Struct
+import argparse
+import json
+import mmap
+import os
+import sys
+import time
+
+MAGIC = b"DEVJ"
+LAYOUT_VERSION = 1
+SEGMENT_HEADER = Struct("<4sHHQ")
+RECORD = Struct("<QHBBB3x")
+SEGMENT_SUFFIX = ".evj"
+
+# event ids are stored in the journal, new events must only be appended to EVENT_NAMES
+PROTECTION_EVENTS = (
+    "high_cell_voltage",
+    "low_cell_voltage",
+    "high_voltage",
+    "low_voltage",
+    "low_soc",
+    "high_charge_current",
+    "high_discharge_current",
+    "high_charge_temperature",
+    "low_charge_temperature",
+    "high_temperature",
+    "low_temperature",
+    "high_internal_temperature",
+    "cell_imbalance",
+    "fuse_blown",
+    "internal_failure",
+)
+FET_EVENTS = (
+    "charge_fet",
+    "discharge_fet",
+    "balance_fet",
+)
+EVENT_NAMES = PROTECTION_EVENTS + FET_EVENTS
+EVENT_IDS = {name: event for event, name in enumerate(EVENT_NAMES)}
+
+
+def _segment_name(start: int) -> str:
+    return f"{start:016x}{SEGMENT_SUFFIX}"
+
+
+def list_segments(directory: str) -> list:
+    """
+    Segments of a journal ordered by time.
+
+    :param directory: Directory of the journal
+    :return: List of tuples (start time in microseconds, path)
+    """
+    segments = []
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    segments.append((int(name[: -len(SEGMENT_SUFFIX)], 16), os.path.join(directory, name)))
+                except ValueError:
+                    pass
+    return sorted(segments)
+
+
+class JournalWriter:
+    """
+    Buffered writer of journal records. Not thread safe, used by the decoding thread or process of one port.
+    """
+
+    def __init__(self, directory: str, flush_interval: float = 60, segment_records: int = 65536, max_segments: int = 32):
+        """
+        :param directory: Directory of the journal, created if missing
+        :param flush_interval: Maximal time in seconds a record is buffered before it is written and synced
+        :param segment_records: Number of records per segment
+        :param max_segments: Number of kept segments, the oldest segments are deleted
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.segment_records = segment_records
+        self.max_segments = max_segments
+        self.buffer = bytearray()
+        self.buffer_time = None
+        self.fd = None
+        self.records = 0
+        self.last_time = 0
+        os.makedirs(directory, mode=0o755, exist_ok=True)
+        self._open_last_segment()
+
+    def _open_last_segment(self) -> None:
+        # continue the last segment after a restart, a partially written last record is cut off
+        segments = list_segments(self.directory)
+        if len(segments) == 0:
+            return
+        start, path = segments[-1]
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_APPEND)
+        except OSError:
+            return
+        size = os.fstat(fd).st_size
+        header = os.pread(fd, SEGMENT_HEADER.size, 0)
+        if len(header) < SEGMENT_HEADER.size or SEGMENT_HEADER.unpack(header)[:3] != (MAGIC, LAYOUT_VERSION, RECORD.size):
+            os.close(fd)
+            return
+        self.records = (size - SEGMENT_HEADER.size) // RECORD.size
+        os.ftruncate(fd, SEGMENT_HEADER.size + self.records * RECORD.size)
+        if self.records > 0:
+            self.last_time = RECORD.unpack(os.pread(fd, RECORD.size, SEGMENT_HEADER.size + (self.records - 1) * RECORD.size))[0]
+        else:
+            self.last_time = start
+        self.fd = fd
+
+    def _new_segment(self, start: int) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+        path = os.path.join(self.directory, _segment_name(start))
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND | os.O_TRUNC, 0o644)
+        os.write(self.fd, SEGMENT_HEADER.pack(MAGIC, LAYOUT_VERSION, RECORD.size, start))
+        self.records = 0
+        segments = list_segments(self.directory)
+        for _, old_path in segments[: max(0, len(segments) - self.max_segments)]:
+            os.unlink(old_path)
+
+    def append(self, pack: int, event: int, old: int, new: int, timestamp: float = None) -> None:
+        """
+        Buffer a transition. The record is written by the next flush.
+
+        :param pack: Bus address of the battery
+        :param event: Event id, index of EVENT_NAMES
+        :param old: Level before the transition
+        :param new: Level after the transition
+        :param timestamp: Time of the transition in seconds since epoch, now if None
+        :return: None
+        """
+        # the time never decreases, so the records stay ordered for the binary search, also if the clock is set back
+        micros = max(self.last_time, int((time.time() if timestamp is None else timestamp) * 1000000))
+        self.last_time = micros
+        self.buffer += RECORD.pack(micros, pack, event, old, new)
+        if self.buffer_time is None:
+            self.buffer_time = time.monotonic()
+
+    def flush_if_due(self) -> None:
+        if self.buffer_time is not None and time.monotonic() - self.buffer_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered records and sync them to the storage.
+
+        :return: None
+        """
+        if len(self.buffer) == 0:
+            return
+        offset = 0
+        while offset < len(self.buffer):
+            if self.fd is None or self.records >= self.segment_records:
+                self._new_segment(RECORD.unpack_from(self.buffer, offset)[0])
+            count = min(self.segment_records - self.records, (len(self.buffer) - offset) // RECORD.size)
+            os.write(self.fd, self.buffer[offset : offset + count * RECORD.size])
+            os.fsync(self.fd)
+            self.records += count
+            offset += count * RECORD.size
+        self.buffer = bytearray()
+        self.buffer_time = None
+
+    def close(self) -> None:
+        self.flush()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def _first_record(buffer, count: int, start: int) -> int:
+    # index of the first record with a time >= start (binary search)
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if RECORD.unpack_from(buffer, SEGMENT_HEADER.size + middle * RECORD.size)[0] < start:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def read_journal(directory: str, start: float = None, end: float = None, pack: int = None, events: list = None):
+    """
+    Read the records of a journal in a time range.
+
+    :param directory: Directory of the journal
+    :param start: Start of the range in seconds since epoch (inclusive), None for the beginning
+    :param end: End of the range in seconds since epoch (exclusive), None for the end
+    :param pack: Return only the records of this pack, all if None
+    :param events: Return only these event ids, all if None
+    :return: Iterator of tuples (time in seconds since epoch, pack, event name, old level, new level)
+    """
+    start_micros = 0 if start is None else int(start * 1000000)
+    end_micros = None if end is None else int(end * 1000000)
+    segments = list_segments(directory)
+    for index, (segment_start, path) in enumerate(segments):
+        # skip segments, which end before the range, and stop at the first segment starting after it
+        if index + 1 < len(segments) and segments[index + 1][0] <= start_micros:
+            continue
+        if end_micros is not None and segment_start >= end_micros:
+            break
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            count = (size - SEGMENT_HEADER.size) // RECORD.size
+            if count <= 0:
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                if SEGMENT_HEADER.unpack_from(buffer)[:3] != (MAGIC, LAYOUT_VERSION, RECORD.size):
+                    continue
+                for ii in range(_first_record(buffer, count, start_micros), count):
+                    micros, record_pack, event, old, new = RECORD.unpack_from(buffer, SEGMENT_HEADER.size + ii * RECORD.size)
+                    if end_micros is not None and micros >= end_micros:
+                        return
+                    if (pack is None or record_pack == pack) and (events is None or event in events):
+                        name = EVENT_NAMES[event] if event < len(EVENT_NAMES) else str(event)
+                        yield micros / 1000000, record_pack, name, old, new
+
+
+def _parse_time(value: str) -> float:
+    return datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the alarm and MOSFET state transitions of a DEYE CAN journal")
+    parser.add_argument("directory", help="journal directory, e.g. /data/dbus-serialbattery/journal/can0")
+    parser.add_argument("--from", dest="start", type=_parse_time, help="start time, e.g. 2026-10-19T08:00")
+    parser.add_argument("--to", dest="end", type=_parse_time, help="end time (exclusive)")
+    parser.add_argument("--pack", type=int, help="show only this pack (bus address)")
+    parser.add_argument("--event", action="append", choices=EVENT_NAMES, help="show only this event, can be repeated")
+    parser.add_argument("--json", action="store_true", help="one JSON object per line")
+    args = parser.parse_args()
+
+    if len(list_segments(args.directory)) == 0:
+        print("No journal segments in " + args.directory)
+        sys.exit(1)
+    events = None if args.event is None else [EVENT_IDS[name] for name in args.event]
+    try:
+        for timestamp, pack, name, old, new in read_journal(args.directory, args.start, args.end, args.pack, events):
+            if args.json:
+                print(json.dumps({"time": timestamp, "pack": pack, "event": name, "old": old, "new": new}))
+            else:
+                print(f"{datetime.fromtimestamp(timestamp).isoformat(sep=' ', timespec='milliseconds')}  pack {pack}  {name}  {old} -> {new}")
+    except BrokenPipeError:
+        pass
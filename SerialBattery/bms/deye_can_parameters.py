@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Active read of the DEYE BMS parameters over INTERCAN, see CAN/INTERCAN/InterCAN_parameters_address_table.xlsx
+# This module has no dependencies to the rest of dbus-serialbattery.
+#
+# The BMS answers a read request with DLC 1 (the parameter address) on 0x18F10180 (battery #1, #2 on 0x18F10280)
+# with a response on 0x18F18001 (#2 on 0x18F18002):
+#   byte 0    parameter address
+#   byte 1-4  raw value, big endian
+# The protection settings, charge limits, counters and the battery type are not broadcast, so they are only
+# available by these requests.
+#
+# ParameterQuery requests each parameter once and keeps the responses for DEYE_CAN_PARAMETER_TTL seconds, so the
+# parameters are not requested again on each poll. The requests are rate limited to one request per
+# DEYE_CAN_PARAMETER_QUERY_INTERVAL seconds, so the INTERCAN traffic between the batteries is not disturbed.
+# Parameters without a response are requested again after a timeout and given up after some retries until the TTL
+# expired. After a send error (e.g. a full transmit buffer) no requests are sent for a backoff time, which doubles on
+# each further error up to max_backoff and is reset by the next successful request.
+#
+# The parameters are stored in the state record (deye_can_state.py), so they are also available in the state file, over
+# MQTT and in the driver process, if the ingestion process polls the CAN buses.
+# The serial number, the versions and the cell count have no parameter address, so the initialisation still waits
+# for their broadcasts and is not shortened by the requests.
+#
+# By asmcc@github
+
+import time
+
+READ_REQUEST_ID = 0x18F10080      # read request, + 0x100 * battery number
+READ_RESPONSE_ID = 0x18F18000     # read response, + battery number
+
+
+def _mv(raw: int) -> float:
+    return raw / 1000
+
+
+def _deci(raw: int) -> float:
+    return raw / 10
+
+
+def _current(raw: int) -> float:
+    return (raw - 3000) / 10
+
+
+def _temperature(raw: int) -> int:
+    return raw - 40
+
+
+def _raw(raw: int) -> int:
+    return raw
+
+
+# readable parameters: address -> (name, unit, conversion of the raw value)
+PARAMETERS = {
+    0x01: ("cell_overvoltage_l1", "V", _mv),
+    0x02: ("cell_overvoltage_recover_l1", "V", _mv),
+    0x65: ("cell_overvoltage_l2", "V", _mv),
+    0x04: ("cell_undervoltage_l1", "V", _mv),
+    0x05: ("cell_undervoltage_recover_l1", "V", _mv),
+    0x68: ("cell_undervoltage_l2", "V", _mv),
+    0x07: ("battery_overvoltage_l1", "V", _deci),
+    0x6B: ("battery_overvoltage_l2", "V", _deci),
+    0x0A: ("battery_undervoltage_l1", "V", _deci),
+    0x6E: ("battery_undervoltage_l2", "V", _deci),
+    0x0D: ("charge_overcurrent_l1", "A", _current),
+    0x71: ("charge_overcurrent_l2", "A", _current),
+    0x10: ("discharge_overcurrent_l1", "A", _current),
+    0x74: ("discharge_overcurrent_l2", "A", _current),
+    0x13: ("charge_high_temperature_l1", "°C", _temperature),
+    0x16: ("charge_low_temperature_l1", "°C", _temperature),
+    0x19: ("discharge_high_temperature_l1", "°C", _temperature),
+    0x1C: ("discharge_low_temperature_l1", "°C", _temperature),
+    0x1F: ("cell_voltage_difference_l1", "V", _mv),
+    0x25: ("mosfet_high_temperature_l1", "°C", _temperature),
+    0xC9: ("charge_cycles", "", _raw),
+    0xCA: ("soc", "%", _deci),
+    0xCB: ("soh", "%", _deci),
+    0xCC: ("short_circuit_count", "", _raw),
+    0xCD: ("over_discharge_count", "", _raw),
+    0xCE: ("over_charge_count", "", _raw),
+    0xCF: ("over_current_count", "", _raw),
+    0xD0: ("temperature_protection_count", "", _raw),
+    0xD1: ("min_charge_voltage", "V", _mv),
+    0xD2: ("max_charge_voltage", "V", _mv),
+    0xD3: ("heating_start_temperature", "°C", _temperature),
+    0xD4: ("heating_stop_temperature", "°C", _temperature),
+    0xD5: ("balance_start_voltage", "V", _mv),
+    0xD6: ("balance_start_difference", "V", _mv),
+    0xD7: ("battery_type", "", _raw),
+}
+
+
+class ParameterQuery:
+    """
+    Rate limited read requests of BMS parameters with a cache of the responses.
+    Not thread safe, used by the thread or process polling the INTERCAN bus.
+    """
+
+    def __init__(self, send, battery: int = 1, addresses: list = None, interval: float = 0.1, ttl: float = 3600, timeout: float = 1, retries: int = 3, max_backoff: float = 300):
+        """
+        :param send: Function called with the arbitration id and the data of a request, raises an exception on errors
+        :param battery: Number of the battery (1 = master)
+        :param addresses: Requested parameter addresses, all PARAMETERS if None
+        :param interval: Minimal time in seconds between two requests
+        :param ttl: Time in seconds a response is kept, before the parameter is requested again
+        :param timeout: Time in seconds to wait for a response
+        :param retries: Number of requests without response, before a parameter is given up until the TTL expired
+        :param max_backoff: Maximal time in seconds without requests after repeated send errors
+        """
+        self.send = send
+        self.request_id = READ_REQUEST_ID + 0x100 * battery
+        self.response_id = READ_RESPONSE_ID + battery
+        self.addresses = list(PARAMETERS) if addresses is None else addresses
+        self.interval = interval
+        self.ttl = ttl
+        self.timeout = timeout
+        self.retries = retries
+        self.cache = {}           # address -> (raw value or None if given up, time of the response)
+        self.pending = {}         # address -> time of the request
+        self.failures = {}        # address -> number of requests without response
+        self.last_request = 0
+        self.max_backoff = max_backoff
+        self.backoff = 0          # current time in seconds without requests after a send error, 0 without error
+        self.blocked_until = 0    # monotonic time until no requests are sent after a send error
+
+    def _due(self, address: int, now: float) -> bool:
+        if address in self.pending:
+            return False
+        cached = self.cache.get(address)
+        return cached is None or now - cached[1] >= self.ttl
+
+    def poll(self, now: float = None) -> bool:
+        """
+        Send the next due request, if the rate limit allows it.
+
+        :param now: Monotonic time, now if None
+        :return: True if a request was sent
+        :raises: The exception of send(), no requests are sent until the backoff time elapsed
+        """
+        now = time.monotonic() if now is None else now
+        for address, request_time in list(self.pending.items()):
+            if now - request_time >= self.timeout:
+                # no response: request again, give up after the retries until the TTL expired
+                del self.pending[address]
+                self.failures[address] = self.failures.get(address, 0) + 1
+                if self.failures[address] >= self.retries:
+                    self.cache[address] = (None, now)
+                    self.failures[address] = 0
+        if now - self.last_request < self.interval or now < self.blocked_until:
+            return False
+        for address in self.addresses:
+            if self._due(address, now):
+                try:
+                    self.send(self.request_id, bytes([address]))
+                except Exception:
+                    self.backoff = min(max(self.backoff * 2, self.interval, 1), self.max_backoff)
+                    self.blocked_until = now + self.backoff
+                    raise
+                self.backoff = 0
+                self.pending[address] = now
+                self.last_request = now
+                return True
+        return False
+
+    def receive(self, data, now: float = None):
+        """
+        Take over a response.
+
+        :param data: Data of a message with the arbitration id response_id
+        :param now: Monotonic time, now if None
+        :return: Tuple (address, raw value) or None for an unexpected response
+        """
+        if len(data) < 5 or data[0] not in PARAMETERS:
+            return None
+        address = data[0]
+        raw = int.from_bytes(data[1:5], "big")
+        self.cache[address] = (raw, time.monotonic() if now is None else now)
+        self.pending.pop(address, None)
+        self.failures.pop(address, None)
+        return address, raw
+
+    def complete(self) -> bool:
+        # all parameters were answered or given up
+        return all(address in self.cache for address in self.addresses)
+
+    def values(self) -> dict:
+        """
+        :return: Dictionary parameter name -> converted value of the answered parameters
+        """
+        values = {}
+        for address, (raw, _) in self.cache.items():
+            if raw is not None:
+                name, _, convert = PARAMETERS[address]
+                values[name] = convert(raw)
+        return values
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Fixed binary layout of the decoded DEYE CAN battery state and a seqlock to exchange it between processes.
+# This module has no dependencies to the rest of dbus-serialbattery, so it can be used by external readers.
+#
+# If DEYE_CAN_STATE_EXPORT is enabled, the driver writes the state of each battery into a memory-mapped file
+# /run/dbus-serialbattery/deye_can_<port>.state with the layout below. Local consumers read it with
+#   from deye_can_state import read_snapshot
+#   state = read_snapshot("/run/dbus-serialbattery/deye_can_can0.state")
+# or on the command line with
+#   python3 deye_can_state.py /run/dbus-serialbattery/deye_can_can0.state
+#
+# Layout (little endian, all offsets in bytes):
+#   0  4s  magic "DEYE"
+#   4  H   layout version
+#   6  H   size of the state record
+#   8  Q   sequence counter (odd while the writer updates the record)
+#  16  I   CRC32 of the state record
+#  20  4x  reserved
+#  24      state record, see STATE_FIELDS (name, struct code, count)
+#
+# Floats without a valid value (also BMS parameters without a response) are stored as NaN, levels and flags without a valid value as 255.
+#
+# By asmcc@github
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+from struct import Struct
+import json
+import math
+import mmap
+import os
+import sys
+import time
+import zlib
+
+MAGIC = b"DEYE"
+LAYOUT_VERSION = 2
+MAX_CELLS = 16
+NO_VALUE = 255
+
+HEADER = Struct("<4sHHQI4x")
+SEQ_OFFSET = 8
+SEQ = Struct("<Q")
+
+# protection levels in the order of the state record
+PROTECTION_FIELDS = (
+    "high_cell_voltage",
+    "low_cell_voltage",
+    "high_voltage",
+    "low_voltage",
+    "low_soc",
+    "high_charge_current",
+    "high_discharge_current",
+    "high_charge_temperature",
+    "low_charge_temperature",
+    "high_temperature",
+    "low_temperature",
+    "high_internal_temperature",
+    "cell_imbalance",
+    "fuse_blown",
+    "internal_failure",
+)
+
+# BMS parameters read over INTERCAN in the order of the state record, same names as PARAMETERS in deye_can_parameters.py
+PARAMETER_FIELDS = (
+    "cell_overvoltage_l1",
+    "cell_overvoltage_recover_l1",
+    "cell_overvoltage_l2",
+    "cell_undervoltage_l1",
+    "cell_undervoltage_recover_l1",
+    "cell_undervoltage_l2",
+    "battery_overvoltage_l1",
+    "battery_overvoltage_l2",
+    "battery_undervoltage_l1",
+    "battery_undervoltage_l2",
+    "charge_overcurrent_l1",
+    "charge_overcurrent_l2",
+    "discharge_overcurrent_l1",
+    "discharge_overcurrent_l2",
+    "charge_high_temperature_l1",
+    "charge_low_temperature_l1",
+    "discharge_high_temperature_l1",
+    "discharge_low_temperature_l1",
+    "cell_voltage_difference_l1",
+    "mosfet_high_temperature_l1",
+    "charge_cycles",
+    "soc",
+    "soh",
+    "short_circuit_count",
+    "over_discharge_count",
+    "over_charge_count",
+    "over_current_count",
+    "temperature_protection_count",
+    "min_charge_voltage",
+    "max_charge_voltage",
+    "heating_start_temperature",
+    "heating_stop_temperature",
+    "balance_start_voltage",
+    "balance_start_difference",
+    "battery_type",
+)
+
+STATE_FIELDS = (
+    ("timestamp", "d", 1),                      # time of the last update in seconds since epoch
+    ("init_done", "B", 1),                      # all initialisation values received
+    ("pcscan_online", "B", 1),                  # CAN messages received on PCSCAN
+    ("intercan_online", "B", 1),                # CAN messages received on INTERCAN
+    ("cell_count", "B", 1),                     # number of cells
+    ("charge_fet", "B", 1),                     # charge MOSFET status
+    ("discharge_fet", "B", 1),                  # discharge MOSFET status
+    ("balance_fet", "B", 1),                    # balancing active
+    ("balance_mask", "H", 1),                   # balancing status of cells 1-16, bit 0 = cell 1
+    ("protection", "B", len(PROTECTION_FIELDS)),  # protection levels 0, 1, 2 in the order of PROTECTION_FIELDS
+    ("voltage", "d", 1),                        # battery voltage in V
+    ("current", "d", 1),                        # battery current in A
+    ("soc", "d", 1),                            # state of charge in %
+    ("soh", "d", 1),                            # state of health in %
+    ("capacity", "d", 1),                       # capacity in Ah
+    ("max_battery_voltage", "d", 1),            # charge voltage limit in V
+    ("min_battery_voltage", "d", 1),            # discharge voltage limit in V
+    ("max_battery_charge_current", "d", 1),     # charge current limit in A
+    ("max_battery_discharge_current", "d", 1),  # discharge current limit in A
+    ("temperature_mos", "d", 1),                # MOSFET temperature in °C
+    ("temperature_1", "d", 1),                  # average cell temperature in °C
+    ("temperature_2", "d", 1),                  # maximal cell temperature in °C
+    ("temperature_3", "d", 1),                  # minimal cell temperature in °C
+    ("temperature_4", "d", 1),                  # heating film temperature in °C
+    ("cell_min_voltage", "d", 1),               # minimal cell voltage in V
+    ("cell_max_voltage", "d", 1),               # maximal cell voltage in V
+    ("cell_min_no", "B", 1),                    # number of the cell with the minimal voltage
+    ("cell_max_no", "B", 1),                    # number of the cell with the maximal voltage
+    ("cell_voltages", "d", MAX_CELLS),          # cell voltages in V
+    ("charge_cycles", "I", 1),                  # number of charge cycles
+    ("charged_energy", "d", 1),                 # total charged energy in kWh
+    ("discharged_energy", "d", 1),              # total discharged energy in kWh
+    ("high_voltage_alarms", "H", 1),            # number of high voltage alarms
+    ("low_voltage_alarms", "H", 1),             # number of low voltage alarms
+    ("bms_alarms", "8s", 1),                    # raw data of CAN frame 0x359
+    ("bat_alarms", "8s", 1),                    # raw data of CAN frame 0x110
+    ("type", "24s", 1),                         # battery type, ASCII
+    ("hardware_version", "8s", 1),              # hardware version, ASCII
+    ("bms_software_version", "8s", 1),          # BMS software version, ASCII
+    ("battery_software_version", "8s", 1),      # battery software version, ASCII
+    ("battery_boot_version", "8s", 1),          # battery boot version, ASCII
+    ("serial_number", "16s", 1),                # battery serial number, ASCII
+    ("parameters", "d", len(PARAMETER_FIELDS)),  # BMS parameters read over INTERCAN in the order of PARAMETER_FIELDS
+)
+
+STATE = Struct("<" + "".join((str(count) if count > 1 else "") + code for _, code, count in STATE_FIELDS))
+SIZE = HEADER.size + STATE.size
+
+
+def _float(value) -> float:
+    return math.nan if value is None else float(value)
+
+
+def _level(value) -> int:
+    return NO_VALUE if value is None else int(value)
+
+
+def _ascii(value) -> bytes:
+    return (value or "").encode("ascii", "replace")
+
+
+def pack_battery(battery) -> bytes:
+    """
+    Pack the decoded values of a DEYE CAN battery into a state record.
+
+    :param battery: Deye_Can battery instance
+    :return: State record as bytes
+    """
+    cells = battery.cells[:MAX_CELLS]
+    cell_voltages = [_float(cell.voltage) for cell in cells] + [math.nan] * (MAX_CELLS - len(cells))
+    balance_mask = 0
+    for ii, cell in enumerate(cells):
+        if cell.balance:
+            balance_mask |= 1 << ii
+    protection = battery.protection
+    history = battery.history
+    parameters = getattr(battery, "parameters", {})
+    return STATE.pack(
+        time.time(),
+        1 if battery.init_done else 0,
+        0 if battery.pcscan_timeout else 1,
+        1 if battery.intercan_available and not battery.intercan_timeout else 0,
+        min(len(battery.cells), MAX_CELLS),
+        _level(battery.charge_fet),
+        _level(battery.discharge_fet),
+        _level(battery.balance_fet),
+        balance_mask,
+        *[_level(getattr(protection, name, None)) for name in PROTECTION_FIELDS],
+        _float(battery.voltage),
+        _float(battery.current),
+        _float(battery.soc),
+        _float(battery.soh),
+        _float(battery.capacity),
+        _float(battery.max_battery_voltage),
+        _float(battery.min_battery_voltage),
+        _float(battery.max_battery_charge_current),
+        _float(battery.max_battery_discharge_current),
+        _float(battery.temperature_mos),
+        _float(battery.temperature_1),
+        _float(battery.temperature_2),
+        _float(battery.temperature_3),
+        _float(battery.temperature_4),
+        _float(battery.cell_min_voltage),
+        _float(battery.cell_max_voltage),
+        battery.cell_min_no or 0,
+        battery.cell_max_no or 0,
+        *cell_voltages,
+        history.charge_cycles or 0,
+        _float(history.charged_energy),
+        _float(history.discharged_energy),
+        history.high_voltage_alarms or 0,
+        history.low_voltage_alarms or 0,
+        bytes(battery.bms_alarms),
+        bytes(battery.bat_alarms),
+        _ascii(battery.type),
+        _ascii(battery.hardware_version),
+        _ascii(battery.bms_software_version),
+        _ascii(battery.battery_software_version),
+        _ascii(battery.battery_boot_version),
+        _ascii(battery.battery_serial_number1 + battery.battery_serial_number2),
+        *[_float(parameters.get(name)) for name in PARAMETER_FIELDS],
+    )
+
+
+def unpack_state(record) -> dict:
+    """
+    Unpack a state record into a dictionary with the names of STATE_FIELDS.
+    Fields with a count greater than 1 are returned as lists, strings are decoded.
+
+    :param record: State record as bytes
+    :return: Dictionary with the decoded values
+    """
+    values = STATE.unpack(record)
+    state = {}
+    index = 0
+    for name, code, count in STATE_FIELDS:
+        if count > 1:
+            state[name] = list(values[index:index + count])
+            index += count
+            continue
+        value = values[index]
+        if code.endswith("s") and name not in ("bms_alarms", "bat_alarms"):
+            value = value.rstrip(b"\x00").decode("ascii", "replace")
+        state[name] = value
+        index += 1
+    state["cell_voltages"] = state["cell_voltages"][:state["cell_count"]]
+    state["protection"] = dict(zip(PROTECTION_FIELDS, state["protection"]))
+    state["parameters"] = {name: value for name, value in zip(PARAMETER_FIELDS, state["parameters"]) if not math.isnan(value)}
+    return state
+
+
+def _value(value):
+    return None if isinstance(value, float) and math.isnan(value) else value
+
+
+def _level_value(value):
+    return None if value == NO_VALUE else value
+
+
+def apply_state(battery, state: dict, cell_class) -> None:
+    """
+    Copy an unpacked state into a battery instance.
+
+    :param battery: Deye_Can battery instance
+    :param state: Dictionary returned by unpack_state()
+    :param cell_class: Cell class of battery.py, used for missing cell instances
+    :return: None
+    """
+    for name in (
+        "voltage",
+        "current",
+        "soc",
+        "soh",
+        "capacity",
+        "max_battery_voltage",
+        "min_battery_voltage",
+        "max_battery_charge_current",
+        "max_battery_discharge_current",
+        "temperature_mos",
+        "temperature_1",
+        "temperature_2",
+        "temperature_3",
+        "temperature_4",
+        "cell_min_voltage",
+        "cell_max_voltage",
+    ):
+        setattr(battery, name, _value(state[name]))
+    battery.cell_min_no = state["cell_min_no"]
+    battery.cell_max_no = state["cell_max_no"]
+    battery.charge_fet = _level_value(state["charge_fet"])
+    battery.discharge_fet = _level_value(state["discharge_fet"])
+    battery.balance_fet = _level_value(state["balance_fet"])
+    for name, level in state["protection"].items():
+        setattr(battery.protection, name, _level_value(level))
+    battery.history.charge_cycles = state["charge_cycles"]
+    battery.history.charged_energy = _value(state["charged_energy"])
+    battery.history.discharged_energy = _value(state["discharged_energy"])
+    battery.history.high_voltage_alarms = state["high_voltage_alarms"]
+    battery.history.low_voltage_alarms = state["low_voltage_alarms"]
+    battery.bms_alarms = state["bms_alarms"]
+    battery.bat_alarms = state["bat_alarms"]
+    battery.parameters = state["parameters"]
+    battery.type = state["type"]
+    battery.hardware_version = state["hardware_version"]
+    battery.bms_software_version = state["bms_software_version"]
+    battery.battery_software_version = state["battery_software_version"]
+    battery.battery_boot_version = state["battery_boot_version"]
+    battery.battery_serial_number1 = state["serial_number"][:8]
+    battery.battery_serial_number2 = state["serial_number"][8:]
+    battery.custom_field = "BMS: " + battery.bms_software_version + " Firmware: " + battery.battery_software_version + " BOOT: " + battery.battery_boot_version
+
+    cell_count = state["cell_count"]
+    if cell_count > 0:
+        battery.cell_count = cell_count
+        while len(battery.cells) < cell_count:
+            battery.cells.append(cell_class(False))
+        for ii, voltage in enumerate(state["cell_voltages"]):
+            battery.cells[ii].voltage = _value(voltage)
+            battery.cells[ii].balance = state["balance_mask"] & (1 << ii) != 0
+    battery.init_done = state["init_done"] == 1
+
+
+class StateWriter:
+    """
+    Single writer of state records into a shared buffer (shared memory, mmap).
+    The sequence counter is odd while the record is written, the CRC protects readers against
+    partially visible writes on weakly ordered CPUs.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.seq = 0
+        HEADER.pack_into(self.buffer, 0, MAGIC, LAYOUT_VERSION, STATE.size, self.seq, 0)
+
+    def write(self, record: bytes) -> None:
+        self.seq += 1
+        SEQ.pack_into(self.buffer, SEQ_OFFSET, self.seq)
+        self.buffer[HEADER.size:SIZE] = record
+        self.seq += 1
+        HEADER.pack_into(self.buffer, 0, MAGIC, LAYOUT_VERSION, STATE.size, self.seq, zlib.crc32(record))
+
+
+class StateReader:
+    """
+    Reader of state records written by a StateWriter. read() returns a consistent copy of the record.
+    """
+
+    RETRIES = 100
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def read(self):
+        """
+        Read a consistent state record.
+
+        :return: State record as bytes, None if no consistent record could be read
+        """
+        for _ in range(self.RETRIES):
+            magic, version, size, seq_begin, crc = HEADER.unpack_from(self.buffer, 0)
+            if magic != MAGIC or version != LAYOUT_VERSION or size != STATE.size or seq_begin == 0:
+                return None
+            if seq_begin & 1:
+                time.sleep(0)
+                continue
+            record = bytes(self.buffer[HEADER.size:SIZE])
+            seq_end = SEQ.unpack_from(self.buffer, SEQ_OFFSET)[0]
+            if seq_begin == seq_end and zlib.crc32(record) == crc:
+                return record
+        return None
+
+
+def create_state_file(path: str) -> StateWriter:
+    """
+    Create (or reuse) a memory-mapped state file and return a writer for it.
+
+    :param path: Path of the state file
+    :return: StateWriter writing into the memory-mapped file
+    """
+    os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, SIZE)
+        buffer = mmap.mmap(fd, SIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+    finally:
+        os.close(fd)
+    return StateWriter(buffer)
+
+
+def read_snapshot(path: str):
+    """
+    Read a consistent snapshot from a state file written by the driver.
+
+    :param path: Path of the state file
+    :return: Dictionary returned by unpack_state(), None if no consistent record is available
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < SIZE:
+            return None
+        with mmap.mmap(f.fileno(), SIZE, access=mmap.ACCESS_READ) as buffer:
+            record = StateReader(buffer).read()
+    return None if record is None else unpack_state(record)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: " + sys.argv[0] + " <state file>")
+        sys.exit(2)
+    snapshot = read_snapshot(sys.argv[1])
+    if snapshot is None:
+        print("No consistent state available in " + sys.argv[1])
+        sys.exit(1)
+    snapshot["bms_alarms"] = snapshot["bms_alarms"].hex()
+    snapshot["bat_alarms"] = snapshot["bat_alarms"].hex()
+    snapshot["cell_voltages"] = [_value(voltage) for voltage in snapshot["cell_voltages"]]
+    print(json.dumps({name: _value(value) for name, value in snapshot.items()}, indent=2))
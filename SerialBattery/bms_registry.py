@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Registry of all supported BMS classes. Each entry only records where the class is found and how it is probed,
+# the module in bms/ is imported when the class is selected with BMS_TYPE or probed during the detection.
+# This keeps the startup time and the memory of the driver low, e.g. a CAN-only configuration with
+# BMS_TYPE = Deye_Can does not import any serial or Bluetooth BMS module.
+#
+# By asmcc@github
+
+from utils import logger
+import importlib
+
+SERIAL = "serial"
+CAN = "can"
+BLE = "ble"
+
+
+class BmsEntry:
+    """
+    One probe of a BMS class: module and class name, transport, baud rate and default address.
+    """
+
+    def __init__(self, module: str, class_name: str, transport: str, baud: int = None, address: bytes = None, opt_in: bool = False):
+        """
+        :param module: Name of the module in the bms package, e.g. jkbms
+        :param class_name: Name of the BMS class, as used in BMS_TYPE
+        :param transport: SERIAL, CAN or BLE
+        :param baud: Baud rate for serial BMS
+        :param address: Default address, if not configured in BATTERY_ADDRESSES
+        :param opt_in: Only probed, if explicitly set in BMS_TYPE
+        """
+        self.module = module
+        self.class_name = class_name
+        self.transport = transport
+        self.baud = baud
+        self.address = address
+        self.opt_in = opt_in
+
+    def load(self):
+        """
+        Import the module and return the BMS class.
+
+        :return: The BMS class
+        """
+        return getattr(importlib.import_module("bms." + self.module), self.class_name)
+
+    def to_test(self) -> dict:
+        """
+        Import the BMS class and return the entry in the format of the supported_bms_types list.
+
+        :return: Dictionary with bms, baud and address
+        """
+        test = {"bms": self.load()}
+        if self.baud is not None:
+            test["baud"] = self.baud
+        if self.address is not None:
+            test["address"] = self.address
+        return test
+
+
+BMS_REGISTRY = [
+    BmsEntry("daly", "Daly", SERIAL, 9600, b"\x40"),
+    BmsEntry("daly", "Daly", SERIAL, 9600, b"\x80"),
+    BmsEntry("daren_485", "Daren485", SERIAL, 19200, b"\x01"),
+    BmsEntry("ecs", "Ecs", SERIAL, 19200),
+    BmsEntry("eg4_lifepower", "EG4_Lifepower", SERIAL, 9600, b"\x01"),
+    BmsEntry("eg4_ll", "EG4_LL", SERIAL, 9600, b"\x01"),
+    BmsEntry("felicity", "Felicity", SERIAL, 9600, b"\x01"),
+    BmsEntry("heltecmodbus", "HeltecModbus", SERIAL, 9600, b"\x01"),
+    BmsEntry("hlpdatabms4s", "HLPdataBMS4S", SERIAL, 9600),
+    BmsEntry("jkbms", "Jkbms", SERIAL, 115200),
+    BmsEntry("jkbms_pb", "Jkbms_pb", SERIAL, 115200, b"\x01"),
+    BmsEntry("lltjbd", "LltJbd", SERIAL, 9600, b"\x00"),
+    BmsEntry("pace", "Pace", SERIAL, 9600, b"\x00"),
+    BmsEntry("renogy", "Renogy", SERIAL, 9600, b"\x30"),
+    BmsEntry("renogy", "Renogy", SERIAL, 9600, b"\xF7"),
+    BmsEntry("seplos", "Seplos", SERIAL, 19200, b"\x00"),
+    BmsEntry("seplosv3", "Seplosv3", SERIAL, 19200),
+    # enabled only if explicitly set in config under "BMS_TYPE"
+    BmsEntry("ant", "ANT", SERIAL, 19200, opt_in=True),
+    BmsEntry("mnb", "MNB", SERIAL, 9600, opt_in=True),
+    BmsEntry("sinowealth", "Sinowealth", SERIAL, 9600, opt_in=True),
+    # CAN
+    BmsEntry("daly_can", "Daly_Can", CAN),
+    BmsEntry("jkbms_can", "Jkbms_Can", CAN),
+    BmsEntry("deye_can", "Deye_Can", CAN),
+    # Bluetooth, selected by the port name
+    BmsEntry("jkbms_ble", "Jkbms_Ble", BLE),
+    BmsEntry("lltjbd_ble", "LltJbd_Ble", BLE),
+    BmsEntry("litime_ble", "LiTime_Ble", BLE),
+]
+
+
+def supported_bms_names(transport: str, bms_type: list) -> list:
+    """
+    Names of the supported BMS classes of a transport without importing them.
+
+    :param transport: SERIAL, CAN or BLE
+    :param bms_type: BMS_TYPE from the config, opt-in classes are only supported if listed there
+    :return: List of class names
+    """
+    names = []
+    for entry in BMS_REGISTRY:
+        if entry.transport == transport and (not entry.opt_in or entry.class_name in bms_type) and entry.class_name not in names:
+            names.append(entry.class_name)
+    return names
+
+
+def expected_bms_types(transport: str, bms_type: list, fallback: bool = False) -> list:
+    """
+    Import the BMS classes to be probed on a transport.
+
+    :param transport: SERIAL, CAN or BLE
+    :param bms_type: BMS_TYPE from the config, all supported classes are probed if empty
+    :param fallback: Probe all supported classes, if none of the classes in BMS_TYPE belongs to the transport
+    :return: List of dictionaries with bms, baud and address in the order of the registry
+    """
+    supported = [entry for entry in BMS_REGISTRY if entry.transport == transport and (not entry.opt_in or entry.class_name in bms_type)]
+    expected = [entry for entry in supported if entry.class_name in bms_type or len(bms_type) == 0]
+    if len(expected) == 0 and fallback:
+        logger.warning(f"No supported {transport.upper()} BMS type found in BMS_TYPE: {', '.join(bms_type)}. Using all supported BMS types.")
+        expected = supported
+    return [entry.to_test() for entry in expected]
+
+
+def get_bms_class(class_name: str, transport: str = None):
+    """
+    Import a BMS class by its name.
+
+    :param class_name: Name of the BMS class, e.g. Jkbms_Ble
+    :param transport: Restrict the search to SERIAL, CAN or BLE
+    :return: The BMS class or None, if the class is not registered
+    """
+    for entry in BMS_REGISTRY:
+        if entry.class_name == class_name and (transport is None or entry.transport == transport):
+            return entry.load()
+    return None
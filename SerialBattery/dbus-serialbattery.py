@@ -1,18 +1,19 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
-import math
 import os
 import signal
 import sys
-from datetime import datetime
-from time import sleep
+from time import monotonic, sleep
 from typing import Union
 
 from dbus.mainloop.glib import DBusGMainLoop
 from gi.repository import GLib as gobject
 
+import bms_registry  # the BMS classes are imported from the registry only when they are selected or probed
 from battery import Battery
 from dbushelper import DbusHelper
+from dbushelper_ext import BalancingPublisher, ChangeTrackedPublisher
+from poll_scheduler import PollScheduler
 from utils import (
     BMS_TYPE,
     bytearray_to_string,
@@ -26,77 +27,42 @@ from utils import (
     POLL_INTERVAL,
     validate_config_values,
 )
-
-# import battery classes
-# TODO: import only the classes that are needed
-from bms.daly import Daly
-from bms.daren_485 import Daren485
-from bms.ecs import Ecs
-from bms.eg4_lifepower import EG4_Lifepower
-from bms.eg4_ll import EG4_LL
-from bms.felicity import Felicity
-from bms.heltecmodbus import HeltecModbus
-from bms.hlpdatabms4s import HLPdataBMS4S
-from bms.jkbms import Jkbms
-from bms.jkbms_pb import Jkbms_pb
-from bms.lltjbd import LltJbd
-from bms.pace import Pace
-from bms.renogy import Renogy
-from bms.seplos import Seplos
-from bms.seplosv3 import Seplosv3
+from utils_ext import (
+    DATA_AGE_DBUS,
+    DATA_AGE_LOG_INTERVAL,
+    DATA_AGE_TRACING,
+    DBUS_BATCHED_PUBLISH,
+    DBUS_BATCHED_PUBLISH_FULL_INTERVAL,
+    DBUS_CELL_ARRAYS,
+    DBUS_CELL_PATHS_INTERVAL,
+    HANDOFF,
+    MEMORY_BUDGET,
+    MEMORY_MONITOR,
+    MEMORY_MONITOR_LOG_INTERVAL,
+    MEMORY_MONITOR_TRACEMALLOC,
+    POLL_CONCURRENT,
+    POLL_CONCURRENT_DEADLINE,
+    POLL_INTERVAL_MAX,
+    POLL_INTERVAL_MIN,
+    SIGNAL_PROFILER,
+)
+from utils_port import wait_for_serial_port
+from utils_reload import reload_config, set_logging_level
 
 # add ext folder to sys.path
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), "ext"))
 
-# enabled only if explicitly set in config under "BMS_TYPE"
-if "ANT" in BMS_TYPE:
-    from bms.ant import ANT
-if "MNB" in BMS_TYPE:
-    from bms.mnb import MNB
-if "Sinowealth" in BMS_TYPE:
-    from bms.sinowealth import Sinowealth
-
-supported_bms_types = [
-    {"bms": Daly, "baud": 9600, "address": b"\x40"},
-    {"bms": Daly, "baud": 9600, "address": b"\x80"},
-    {"bms": Daren485, "baud": 19200, "address": b"\x01"},
-    {"bms": Ecs, "baud": 19200},
-    {"bms": EG4_Lifepower, "baud": 9600, "address": b"\x01"},
-    {"bms": EG4_LL, "baud": 9600, "address": b"\x01"},
-    {"bms": Felicity, "baud": 9600, "address": b"\x01"},
-    {"bms": HeltecModbus, "baud": 9600, "address": b"\x01"},
-    {"bms": HLPdataBMS4S, "baud": 9600},
-    {"bms": Jkbms, "baud": 115200},
-    {"bms": Jkbms_pb, "baud": 115200, "address": b"\x01"},
-    {"bms": LltJbd, "baud": 9600, "address": b"\x00"},
-    {"bms": Pace, "baud": 9600, "address": b"\x00"},
-    {"bms": Renogy, "baud": 9600, "address": b"\x30"},
-    {"bms": Renogy, "baud": 9600, "address": b"\xF7"},
-    {"bms": Seplos, "baud": 19200, "address": b"\x00"},
-    {"bms": Seplosv3, "baud": 19200},
-]
-
-# enabled only if explicitly set in config under "BMS_TYPE"
-if "ANT" in BMS_TYPE:
-    supported_bms_types.append({"bms": ANT, "baud": 19200})
-if "MNB" in BMS_TYPE:
-    supported_bms_types.append({"bms": MNB, "baud": 9600})
-if "Sinowealth" in BMS_TYPE:
-    supported_bms_types.append({"bms": Sinowealth, "baud": 9600})
-
-expected_bms_types = [battery_type for battery_type in supported_bms_types if battery_type["bms"].__name__ in BMS_TYPE or len(BMS_TYPE) == 0]
-
-logger.info("")
-logger.info("Starting dbus-serialbattery")
-
-
-# count loops
-count_for_loops = 5
-delayed_loop_count = 0
 
 
 def main():
-    global expected_bms_types, supported_bms_types
+    # logged in main(), the DEYE CAN ingestion process imports this module again (spawn)
+    logger.info("")
+    logger.info("Starting dbus-serialbattery")
+
+    expected_bms_types = []
+
+    # CanReceiverThreads of all CAN ports served by this process
+    can_threads = []
 
     def exit_driver(sig, frame, code: int = 0) -> None:
         """
@@ -118,9 +84,9 @@ def main():
             if battery and len(battery) > 0 and hasattr(battery[0], "disconnect") and callable(battery[0].disconnect):
                 battery[0].disconnect()
 
-        # Stop the CanReceiverThread
+        # Stop the CanReceiverThreads
         elif port.startswith(("can", "vecan", "vcan")):
-            if "can_thread" in globals() and can_thread is not None:
+            for can_thread in can_threads:
                 can_thread.stop()
 
         # Close the serial connection
@@ -136,55 +102,69 @@ def main():
     signal.signal(signal.SIGINT, exit_driver)
     signal.signal(signal.SIGTERM, exit_driver)
 
-    def poll_battery(loop) -> bool:
+    # start and stop profiling with SIGUSR1, if enabled, see utils_profiler.py
+    if SIGNAL_PROFILER:
+        from utils_profiler import SignalProfiler
+
+        # the profiling is started and stopped on the main loop and not within the signal handler
+        SignalProfiler().install(signal.SIGUSR1, gobject.idle_add)
+
+    def poll_battery(loop, keys: list = None) -> dict:
         """
-        Polls the battery for data and updates it on the dbus.
+        Polls the batteries for data and updates them on the dbus.
         Calls `publish_battery` from DbusHelper for each battery instance.
 
         :param loop: The main event loop
-        :return: Always returns True
+        :param keys: Keys of the batteries to poll, all batteries if None
+        :return: Dictionary with the poll duration in seconds for each polled battery
         """
-        global count_for_loops, delayed_loop_count
-
-        # count execution time in milliseconds
-        start = datetime.now()
-
-        for key_address in battery:
-            helper[key_address].publish_battery(loop)
+        keys = list(battery) if keys is None else keys
+        costs = {}
+
+        def publish(key_address):
+            if key_address in balancing:
+                balancing[key_address].update(battery[key_address])
+            if key_address in publisher:
+                publisher[key_address].publish(loop)
+            else:
+                helper[key_address].publish_battery(loop)
+            if key_address in tracer:
+                tracer[key_address].record()
 
-        runtime = (datetime.now() - start).total_seconds()
-        logger.debug(f"Polling data took {runtime:.3f} seconds")
+        # measure the execution time with the monotonic clock
+        start = monotonic()
 
-        # check if polling took too long and adjust poll interval, but only after 5 loops
-        # since the first polls are always slower
-        if runtime > battery[first_key].poll_interval / 1000:
-            delayed_loop_count += 1
-            if delayed_loop_count > 1:
-                logger.warning(f"Polling data took {runtime:.3f} seconds. Automatically increase interval in {count_for_loops - delayed_loop_count} cycles.")
+        if poller is not None:
+            # refresh the batteries concurrently, then publish the results on the main loop
+            if POLL_CONCURRENT_DEADLINE > 0:
+                deadline = POLL_CONCURRENT_DEADLINE
+            else:
+                deadline = min(battery[key_address].poll_interval for key_address in keys) / 1000 * 0.9
+            results = poller.refresh(deadline, keys)
+            for key_address in keys:
+                publish_start = monotonic()
+                poller.publish(key_address, results[key_address], lambda: publish(key_address))
+                costs[key_address] = poller.runtime.get(key_address, 0) + monotonic() - publish_start
         else:
-            delayed_loop_count = 0
-
-        if delayed_loop_count >= count_for_loops:
-            # round up to the next half second
-            new_poll_interval = math.ceil((runtime + 0.05) * 2) / 2 * 1000
+            for key_address in keys:
+                publish_start = monotonic()
+                publish(key_address)
+                costs[key_address] = monotonic() - publish_start
 
-            # limit max poll interval to 60 seconds
-            if new_poll_interval > 60000:
-                new_poll_interval = 60000
+        if memory_monitor is not None:
+            memory_monitor.sample()
 
-            battery[first_key].poll_interval = new_poll_interval
-            logger.warning(f"Polling took too long for the last {count_for_loops} cycles. Set to {new_poll_interval/1000:.3f} s")
+        logger.debug(f"Polling data took {monotonic() - start:.3f} seconds")
 
-            delayed_loop_count = 0
+        return costs
 
-        return True
-
-    def get_battery(_port: str, _bus_address: hex = None, can_transport_interface: object = None) -> Union[Battery, None]:
+    def get_battery(_port: str, _bus_address: hex = None, can_transport_interface: object = None, bms_types: list = None) -> Union[Battery, None]:
         """
         Attempts to establish a connection to the battery and returns the battery object if successful.
 
         :param _port: The port to connect to.
         :param _bus_address: The Modbus/CAN address to connect to (optional).
+        :param bms_types: The BMS types to test, all expected BMS types if None (optional).
         :return: The battery object if a connection is established, otherwise None.
         """
         # Try to establish communications with the battery 3 times, else exit
@@ -193,7 +173,7 @@ def main():
         while retry <= retries:
             logger.info("-- Testing BMS: " + str(retry) + " of " + str(retries) + " rounds")
             # Create a new battery object that can read the battery and run connection test
-            for test in expected_bms_types:
+            for test in expected_bms_types if bms_types is None else bms_types:
                 # noinspection PyBroadException
                 try:
                     if _bus_address is not None:
@@ -214,6 +194,9 @@ def main():
                     if battery.test_connection() and battery.validate_data():
                         logger.info("-- Connection established to " + battery.__class__.__name__)
                         return battery
+                    # a failed probe must not keep files or connections open
+                    if hasattr(battery, "close_outputs"):
+                        battery.close_outputs()
                 except KeyboardInterrupt:
                     return None
                 except Exception:
@@ -232,6 +215,67 @@ def main():
 
         return None
 
+    def get_can_batteries(port: str) -> Union[dict, None]:
+        """
+        Detects the bitrate, starts the CanReceiverThread and searches the batteries on one CAN port.
+
+        :param port: The CAN port, e.g. can0
+        :return: Dictionary address -> battery object of the found batteries, None if the CAN interface is not accessible.
+        """
+        battery = {}
+
+        # detect the bitrate in listen-only mode before the CanReceiverThread opens the interface
+        from utils_ext import CAN_AUTOBAUD, CAN_AUTOBAUD_BITRATES, CAN_AUTOBAUD_SAMPLE_TIME
+
+        detected_busspeed = None
+        if CAN_AUTOBAUD:
+            from utils_autobaud import detect_bitrate
+
+            detected_busspeed = detect_bitrate(port, CAN_AUTOBAUD_BITRATES, CAN_AUTOBAUD_SAMPLE_TIME)
+
+        # start the corresponding CanReceiverThread
+        from utils_can import CanReceiverThread, CanTransportInterface
+
+        try:
+            can_thread = CanReceiverThread.get_instance(bustype="socketcan", channel=port)
+        except Exception as e:
+            logger.error(f"Error while accessing CAN interface: {e}")
+            return None
+        can_threads.append(can_thread)
+
+        # wait until thread has initialized
+        if not can_thread.can_initialised.wait(2):
+            logger.error("Timeout while accessing CAN interface")
+            return None
+
+        can_transport_interface = CanTransportInterface()
+        can_transport_interface.can_message_cache_callback = can_thread.get_message_cache
+        can_transport_interface.can_bus = can_thread.can_bus
+        logger.debug("Wait shortly to make sure that all needed data is in the cache")
+        # Slowest message cycle transmission is every 1 second, wait a bit more for the first time to fetch all needed data (only jk bms)
+        sleep(2)
+        addresses = [None] if len(BATTERY_ADDRESSES) == 0 else BATTERY_ADDRESSES  # use default address, if not configured
+
+        # with a detected bitrate the interface is already configured, otherwise try all bitrates with a full battery detection
+        for busspeed in [250, 500] if detected_busspeed is None else [detected_busspeed]:
+            for address in addresses:
+                bat = get_battery(port, address, can_transport_interface)
+                if bat:
+                    battery[address] = bat
+                    logger.info(f"Successful battery connection at {port} and this address {str(address)}")
+                else:
+                    logger.warning(f"No battery connection at {port} and this address {str(address)}")
+
+            # if we've found at least 1 battery, stop the search here. otherwise retry with other bus speeds
+            if len(battery) > 0 or detected_busspeed is not None:
+                break
+
+            logger.info(f"Found no devices on can bus, retrying with {busspeed} kbps")
+            can_thread.setup_can(channel=port, bitrate=busspeed, force=True)
+            sleep(2)
+
+        return battery
+
     def get_port() -> str:
         """
         Retrieves the port to connect to from the command line arguments.
@@ -256,11 +300,11 @@ def main():
             sleep(60)
             exit_driver(None, None, 1)
 
-    def check_bms_types(supported_bms_types, type) -> None:
+    def check_bms_types(supported_bms_names, type) -> None:
         """
         Checks if BMS_TYPE is not empty and all specified BMS types are supported.
 
-        :param supported_bms_types: List of supported BMS types.
+        :param supported_bms_names: List of the names of the supported BMS types.
         :param type: The type of BMS connection (ble, can, or serial).
         :return: None
         """
@@ -278,10 +322,10 @@ def main():
 
         if len(bms_types) > 0:
             for bms_type in bms_types:
-                if bms_type not in [bms["bms"].__name__ for bms in supported_bms_types]:
+                if bms_type not in supported_bms_names:
                     logger.error(
                         f'ERROR >>> BMS type "{bms_type}" is not supported. Supported BMS types are: '
-                        + f"{', '.join([bms['bms'].__name__ for bms in supported_bms_types])}"
+                        + f"{', '.join(supported_bms_names)}"
                         + "; Disabled by default: ANT, MNB, Sinowealth"
                     )
                     exit_driver(None, None, 1)
@@ -301,10 +345,40 @@ def main():
     logger.info("dbus-serialbattery v" + str(DRIVER_VERSION))
 
     port = get_port()
+    ports = port.split(",")
     battery = {}
+    # bus address of each battery key, the keys are (port, address) tuples in multi-port mode
+    battery_address = {}
+
+    if len(ports) > 1 and not all(can_port.startswith(("can", "vecan", "vcan")) for can_port in ports):
+        logger.error("ERROR >>> Several ports are only supported for CAN interfaces, e.g. can0,can1")
+        sleep(60)
+        exit_driver(None, None, 1)
+
+    # take over the batteries of a running driver for the same port, if enabled, see utils_handoff.py
+    handoff = None
+    if HANDOFF:
+        from utils_handoff import receive_handoff, registration_deferrable
+
+        if registration_deferrable():
+            handoff = receive_handoff(port)
+        else:
+            logger.warning("Handoff needs a velib_python with VeDbusService.register(). Use the normal battery detection")
+    handoff_batteries = handoff.create_batteries(bms_registry.get_bms_class) if handoff is not None else None
+    if handoff is not None and handoff_batteries is None:
+        logger.warning("Handoff failed, the running driver continues. Use the normal battery detection")
+        handoff.close()
+        handoff = None
+
+    # HANDOFF
+    if handoff is not None:
+        for key_address, bat in handoff_batteries.items():
+            battery[key_address] = bat
+            if isinstance(key_address, tuple):
+                battery_address[key_address] = key_address[1]
 
     # BLUETOOTH
-    if port.endswith("_Ble"):
+    elif port.endswith("_Ble"):
         """
         Import BLE classes only if it's a BLE port; otherwise, the driver won't start due to missing Python modules.
         This prevents issues when using the driver exclusively with a serial connection.
@@ -315,19 +389,11 @@ def main():
         else:
             ble_address = sys.argv[2]
 
-            if port == "Jkbms_Ble":
-                # noqa: F401 --> ignore flake "imported but unused" error
-                from bms.jkbms_ble import Jkbms_Ble  # noqa: F401
-
-            if port == "LltJbd_Ble":
-                # noqa: F401 --> ignore flake "imported but unused" error
-                from bms.lltjbd_ble import LltJbd_Ble  # noqa: F401
-
-            if port == "LiTime_Ble":
-                # noqa: F401 --> ignore flake "imported but unused" error
-                from bms.litime_ble import LiTime_Ble  # noqa: F401
-
-            class_ = eval(port)
+            class_ = bms_registry.get_bms_class(port, bms_registry.BLE)
+            if class_ is None:
+                logger.error(f"ERROR >>> No Bluetooth BMS found for {port}")
+                sleep(60)
+                exit_driver(None, None, 1)
 
             # do not remove ble_ prefix, since the dbus service cannot be only numbers
             testbms = class_("ble_" + ble_address.replace(":", "").lower(), 9600, ble_address)
@@ -346,84 +412,75 @@ def main():
         vecan: Newer Venus GX devices
         vcan: Virtual CAN interface for testing
         """
-        from bms.daly_can import Daly_Can
-        from bms.jkbms_can import Jkbms_Can
-        from bms.deye_can import Deye_Can
-
-        # only try CAN BMS on CAN port
-        supported_bms_types = [
-            {"bms": Daly_Can},
-            {"bms": Jkbms_Can},
-            {"bms": Deye_Can},
-        ]
-
         # check if BMS_TYPE is not empty and all BMS types in the list are supported
-        check_bms_types(supported_bms_types, "can")
-
-        expected_bms_types = [battery_type for battery_type in supported_bms_types if battery_type["bms"].__name__ in BMS_TYPE or len(BMS_TYPE) == 0]
-
-        # If no BMS type is supported, use all supported BMS types
-        if len(expected_bms_types) == 0:
-            logger.warning(f"No supported CAN BMS type found in BMS_TYPE: {', '.join(BMS_TYPE)}. Using all supported BMS types.")
-            expected_bms_types = supported_bms_types
-
-        # start the corresponding CanReceiverThread if BMS for this type found
-        from utils_can import CanReceiverThread, CanTransportInterface
-
-        try:
-            can_thread = CanReceiverThread.get_instance(bustype="socketcan", channel=port)
-        except Exception as e:
-            logger.error(f"Error while accessing CAN interface: {e}")
-            sleep(60)
-            exit_driver(None, None, 1)
-
-        # wait until thread has initialized
-        if not can_thread.can_initialised.wait(2):
-            logger.error("Timeout while accessing CAN interface")
-            sleep(60)
-            exit_driver(None, None, 1)
-
-        can_transport_interface = CanTransportInterface()
-        can_transport_interface.can_message_cache_callback = can_thread.get_message_cache
-        can_transport_interface.can_bus = can_thread.can_bus
-        logger.debug("Wait shortly to make sure that all needed data is in the cache")
-        # Slowest message cycle transmission is every 1 second, wait a bit more for the first time to fetch all needed data (only jk bms)
-        sleep(2)
-        addresses = [None] if len(BATTERY_ADDRESSES) == 0 else BATTERY_ADDRESSES  # use default address, if not configured
+        check_bms_types(bms_registry.supported_bms_names(bms_registry.CAN, BMS_TYPE), "can")
+
+        # only try CAN BMS on CAN port. If no BMS type is supported, use all supported BMS types
+        expected_bms_types = bms_registry.expected_bms_types(bms_registry.CAN, BMS_TYPE, fallback=True)
+
+        # several CAN ports can be served by one process, e.g. "can0,can1" (multi-port mode)
+        if len(ports) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            # tell the expected BMS classes, which interfaces are PCSCAN ports (only Deye_Can uses a second interface)
+            for bms_type in expected_bms_types:
+                if hasattr(bms_type["bms"], "pcscan_ports"):
+                    bms_type["bms"].pcscan_ports = ports
+            # the ports are independent, so they are probed concurrently
+            with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+                can_batteries_of_port = dict(zip(ports, executor.map(get_can_batteries, ports)))
+            for can_port in ports:
+                can_batteries = can_batteries_of_port[can_port]
+                if can_batteries is None:
+                    logger.error(f"Error while accessing CAN interface {can_port}, continue with the other ports")
+                    continue
+                for address, bat in can_batteries.items():
+                    # the port is part of the key, the dbus service name is still built from the port and the address
+                    battery[(can_port, address)] = bat
+                    battery_address[(can_port, address)] = address
+        else:
+            can_batteries = get_can_batteries(port)
+            if can_batteries is None:
+                sleep(60)
+                exit_driver(None, None, 1)
+            battery.update(can_batteries)
 
-        for busspeed in [250, 500]:
-            for address in addresses:
-                bat = get_battery(port, address, can_transport_interface)
-                if bat:
-                    battery[address] = bat
-                    logger.info(f"Successful battery connection at {port} and this address {str(address)}")
-                else:
-                    logger.warning(f"No battery connection at {port} and this address {str(address)}")
+        # open the outputs of the decoded values (state file, MQTT, journal, archive, balancing) only for the
+        # detected batteries, not for each probe
+        for key_address in battery:
+            if hasattr(battery[key_address], "init_state_writers"):
+                battery[key_address].init_state_writers()
 
-            # if we've found at least 1 battery, stop the search here. otherwise retry with other bus speeds
-            if len(battery) > 0:
-                break
+        # move the decoding of CAN messages to a separate process, if supported by the BMS and enabled in the config
+        from utils_ext import DEYE_CAN_INGEST_PROCESS
 
-            logger.info(f"Found no devices on can bus, retrying with {busspeed} kbps")
-            can_thread.setup_can(channel=port, bitrate=busspeed, force=True)
-            sleep(2)
+        if DEYE_CAN_INGEST_PROCESS:
+            for key_address in battery:
+                if hasattr(battery[key_address], "start_ingest_process"):
+                    battery[key_address].start_ingest_process()
 
     # SERIAL
     else:
         # check if BMS_TYPE is not empty and all BMS types in the list are supported
-        check_bms_types(supported_bms_types, "serial")
+        check_bms_types(bms_registry.supported_bms_names(bms_registry.SERIAL, BMS_TYPE), "serial")
 
-        # wait some seconds to be sure that the serial connection is ready
+        expected_bms_types = bms_registry.expected_bms_types(bms_registry.SERIAL, BMS_TYPE)
+
+        # wait until the serial port is ready (at most 16 seconds like before)
         # else the error throw a lot of timeouts
-        sleep(16)
+        wait_for_serial_port(port, 16)
 
         # Check if BATTERY_ADDRESSES is not empty
         if BATTERY_ADDRESSES:
+            bms_types = None
             for address in BATTERY_ADDRESSES:
-                found_battery = get_battery(port, address)
+                found_battery = get_battery(port, address, bms_types=bms_types)
                 if found_battery:
                     battery[address] = found_battery
                     logger.info(f"Successful battery connection at {port} and this address {address}")
+                    # all batteries on one bus use the same protocol, so the remaining addresses are only probed with the found BMS type
+                    if bms_types is None:
+                        bms_types = [test for test in expected_bms_types if test["bms"] is type(found_battery)]
                 else:
                     logger.warning(f"No battery connection at {port} and this address {address}")
         # Use default address
@@ -449,34 +506,102 @@ def main():
 
     # Get the initial values for the battery used by setup_vedbus
     helper = {}
+    publisher = {}
+    tracer = {}
+    balancing = {}
+    # VeDbusService of each battery, whose name is registered after the old driver released it (handoff)
+    deferred = {}
 
     for key_address in battery:
-        helper[key_address] = DbusHelper(battery[key_address], key_address)
+        helper[key_address] = DbusHelper(battery[key_address], battery_address.get(key_address, key_address))
+        if handoff is not None:
+            from utils_handoff import defer_registration
+
+            deferred[key_address] = helper[key_address]._dbusservice
+            defer_registration(deferred[key_address])
         if not helper[key_address].setup_vedbus():
             logger.error(
                 "ERROR >>> Problem with battery set up at " + port + (" and this Modbus address: " + ", ".join(BATTERY_ADDRESSES) if BATTERY_ADDRESSES else "")
             )
+            if handoff is not None:
+                # the old driver keeps running
+                handoff.close()
             exit_driver(None, None, 1)
 
+        # trace the age of the published values, if enabled and supported by the BMS
+        if DATA_AGE_TRACING and hasattr(battery[key_address], "frame_time"):
+            from utils_data_age import DataAgeTracer
+
+            tracer[key_address] = DataAgeTracer(
+                battery[key_address].connection_name(),
+                battery[key_address],
+                helper[key_address]._dbusservice if DATA_AGE_DBUS else None,
+                DATA_AGE_LOG_INTERVAL,
+            )
+
+        # publish only changed values in one batch and/or cell values as arrays, if enabled
+        if DBUS_BATCHED_PUBLISH or DBUS_CELL_ARRAYS:
+            publisher[key_address] = ChangeTrackedPublisher(
+                helper[key_address],
+                DBUS_BATCHED_PUBLISH_FULL_INTERVAL if DBUS_BATCHED_PUBLISH else 0,
+                DBUS_CELL_ARRAYS,
+                DBUS_CELL_PATHS_INTERVAL,
+            )
+
         # Calculate the initial values for the battery
         battery[key_address].set_calculated_data()
 
+    # the old driver releases its dbus service names after all services were set up, only the names are registered then
+    if handoff is not None:
+        from utils_handoff import register_deferred
+
+        if not handoff.release():
+            logger.error("ERROR >>> The running driver did not release its dbus service names")
+            exit_driver(None, None, 1)
+        # the old driver closed its outputs (journal, archive, balancing) before the confirmation
+        for key_address in battery:
+            if hasattr(battery[key_address], "init_state_writers"):
+                battery[key_address].init_state_writers()
+
+    # publish the balancing counters of each cell, if accounted by the BMS
+    for key_address in battery:
+        if getattr(battery[key_address], "balancing", None) is not None:
+            balancing[key_address] = BalancingPublisher(helper[key_address]._dbusservice)
+
+    for key_address in deferred:
+        register_deferred(deferred[key_address])
+
     # get first key from battery dict
     first_key = list(battery.keys())[0]
 
+    # sample the memory of the driver process after each poll cycle, if enabled, see utils_memory.py
+    memory_monitor = None
+    if MEMORY_MONITOR:
+        from utils_memory import MemoryMonitor
+
+        memory_monitor = MemoryMonitor(helper[first_key]._dbusservice, MEMORY_BUDGET, MEMORY_MONITOR_LOG_INTERVAL, MEMORY_MONITOR_TRACEMALLOC)
+
+    # refresh several batteries concurrently, if enabled
+    poller = None
+    scheduler = None
+    if POLL_CONCURRENT and len(battery) > 1:
+        from poll_concurrent import ConcurrentPoller
+
+        poller = ConcurrentPoller(battery)
+        logger.info(f"Refresh {len(battery)} batteries concurrently")
+
     # try using active callback on this battery (normally only used for Bluetooth BMS)
-    if not battery[first_key].use_callback(lambda: poll_battery(mainloop)):
-        # change poll interval if set in config
-        if POLL_INTERVAL is not None:
-            battery[first_key].poll_interval = POLL_INTERVAL
+    if not battery[first_key].use_callback(lambda: poll_battery(mainloop) is not None):
+        for key_address in battery:
+            # change poll interval if set in config
+            if POLL_INTERVAL is not None:
+                battery[key_address].poll_interval = POLL_INTERVAL
 
-        logger.info(f"Polling interval: {battery[first_key].poll_interval/1000:.3f} s")
+            logger.info(f"Polling interval of battery {key_address}: {battery[key_address].poll_interval/1000:.3f} s")
 
-        # if not possible, poll the battery every poll_interval milliseconds
-        gobject.timeout_add(
-            battery[first_key].poll_interval,
-            lambda: poll_battery(mainloop),
-        )
+        # if not possible, poll each battery with its own interval, adapted to the duration of the polls
+        scheduler = PollScheduler(battery, lambda keys: poll_battery(mainloop, keys), POLL_INTERVAL_MIN / 1000, POLL_INTERVAL_MAX / 1000)
+        scheduler.start()
 
     # print log at this point, else not all data is correctly populated
     for key_address in battery:
@@ -494,12 +619,75 @@ def main():
         for key_address in battery:
             battery[key_address].setup_external_sensor()
 
+    def apply_poll_interval(value) -> None:
+        # empty POLL_INTERVAL: keep the interval, the default of the BMS is only known at the start
+        if value is None:
+            logger.warning("POLL_INTERVAL removed, the current poll interval is kept until the next restart")
+        elif scheduler is not None:
+            scheduler.reconfigure(interval=value / 1000)
+
+    def apply_poll_interval_bounds(value) -> None:
+        from utils_ext import POLL_INTERVAL_MAX, POLL_INTERVAL_MIN
+
+        if scheduler is not None:
+            scheduler.reconfigure(min_interval=POLL_INTERVAL_MIN / 1000, max_interval=POLL_INTERVAL_MAX / 1000)
+
+    def apply_data_age_log_interval(value) -> None:
+        for key_address in tracer:
+            tracer[key_address].log_interval = value
+
+    config_appliers = {
+        "LOGGING": set_logging_level,
+        "POLL_INTERVAL": apply_poll_interval,
+        "POLL_INTERVAL_MIN": apply_poll_interval_bounds,
+        "POLL_INTERVAL_MAX": apply_poll_interval_bounds,
+        "DATA_AGE_LOG_INTERVAL": apply_data_age_log_interval,
+    }
+
+    def apply_config_reload() -> bool:
+        reload_config(config_appliers)
+        # one-shot idle callback
+        return False
+
+    # reload the config with SIGHUP, settings which are safe to change are applied without a restart, see utils_reload.py
+    # the config is reloaded on the main loop and not within the signal handler
+    signal.signal(signal.SIGHUP, lambda sig, frame: gobject.idle_add(apply_config_reload))
+
+    handed_over = []
+
+    def release_for_handoff() -> None:
+        """
+        Stops the publishing and releases the dbus service names for a new driver process.
+
+        :return: None
+        """
+        if scheduler is not None:
+            scheduler.stop()
+        for key_address in helper:
+            dbusservice = helper[key_address]._dbusservice
+            dbusservice._dbusconn.release_name(dbusservice.name)
+        # flush and close the outputs before the confirmation, the new driver opens them after it
+        for key_address in battery:
+            if hasattr(battery[key_address], "close_outputs"):
+                battery[key_address].close_outputs()
+        handed_over.append(True)
+        mainloop.quit()
+
+    # offer the batteries to a new driver process, if enabled
+    if HANDOFF:
+        from utils_handoff import HandoffServer
+
+        HandoffServer(port, battery, release_for_handoff).start()
+
     # Run the main loop
     try:
         mainloop.run()
     except KeyboardInterrupt:
         pass
 
+    if handed_over:
+        exit_driver(None, None, 0)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Extensions for the publishing of battery values on dbus, which are used in addition to dbushelper.py.
+#
+# By asmcc@github
+
+from time import monotonic
+from utils import logger
+import re
+import time
+
+
+class BatchedDbusService:
+    """
+    Proxy for the VeDbusService of a DbusHelper.
+
+    Values set by DbusHelper.publish_dbus() are collected and only the paths with a changed value are sent
+    with flush(). If the VeDbusService supports batching (context manager of newer velib versions),
+    all changed paths are sent as one ItemsChanged signal instead of one PropertiesChanged signal per path.
+    All other attributes and methods are forwarded to the VeDbusService.
+    """
+
+    def __init__(self, service):
+        self._service = service
+        self._pending = {}
+        self._batching = hasattr(type(service), "__enter__") and hasattr(type(service), "__exit__")
+        self._rate_limits = []
+        self._path_limits = {}
+
+    def __getattr__(self, name):
+        return getattr(self._service, name)
+
+    def __getitem__(self, path):
+        if path in self._pending:
+            return self._pending[path]
+        return self._service[path]
+
+    def __setitem__(self, path, value):
+        self._pending[path] = value
+
+    def __delitem__(self, path):
+        self._pending.pop(path, None)
+        del self._service[path]
+
+    def add_rate_limit(self, pattern: str, interval: float) -> None:
+        """
+        Send the paths matching a regular expression at most once per interval.
+
+        :param pattern: Regular expression for the paths
+        :param interval: Minimal interval between two updates in seconds
+        :return: None
+        """
+        # [regex, interval, time of the last update]
+        self._rate_limits.append([re.compile(pattern), interval, 0])
+        self._path_limits = {}
+
+    def _rate_limit(self, path: str):
+        if path not in self._path_limits:
+            self._path_limits[path] = next((limit for limit in self._rate_limits if limit[0].match(path)), None)
+        return self._path_limits[path]
+
+    def flush(self, pattern=None) -> int:
+        """
+        Send all pending values, which differ from the values on dbus.
+        Values of rate limited paths stay pending, until the interval of their rate limit elapsed.
+
+        :param pattern: Compiled regular expression, only the matching paths are sent and the others stay pending
+        :return: Number of sent paths
+        """
+        if len(self._pending) == 0:
+            return 0
+        if pattern is None:
+            pending, self._pending = self._pending, {}
+        else:
+            pending = {path: value for path, value in self._pending.items() if pattern.match(path)}
+            for path in pending:
+                del self._pending[path]
+        if len(self._rate_limits) > 0:
+            now = monotonic()
+            due = [limit for limit in self._rate_limits if now - limit[2] >= limit[1]]
+            for limit in due:
+                limit[2] = now
+            for path in list(pending):
+                limit = self._rate_limit(path)
+                if limit is not None and limit not in due:
+                    self._pending[path] = pending.pop(path)
+        changed = [(path, value) for path, value in pending.items() if self._service[path] != value]
+        if len(changed) == 0:
+            return 0
+        if self._batching:
+            with self._service as service:
+                for path, value in changed:
+                    service[path] = value
+        else:
+            for path, value in changed:
+                self._service[path] = value
+        return len(changed)
+
+
+class CellArrayPublisher:
+    """
+    Publishes the cell voltages, balancing states and the deviation of each cell voltage from the mean voltage
+    as one array-typed dbus value each, so that consumers get all cells with one signal.
+    dbus arrays cannot contain None, so the voltage arrays are empty while the voltage of any cell is unknown.
+    """
+
+    PATH_VOLTAGES = "/Voltages/CellArray"
+    PATH_BALANCES = "/Balances/CellArray"
+    PATH_DEVIATIONS = "/Voltages/CellDeviationArray"
+    # per-cell paths of DbusHelper, e.g. /Voltages/Cell1 and /Balances/Cell1
+    PATTERN_CELL_PATHS = r"^/(Voltages|Balances)/Cell\d+$"
+
+    def __init__(self, service):
+        self.service = service
+        self.service.add_path(self.PATH_VOLTAGES, [])
+        self.service.add_path(self.PATH_BALANCES, [])
+        self.service.add_path(self.PATH_DEVIATIONS, [])
+
+    def update(self, battery) -> None:
+        """
+        Update the arrays with the current cell values of the battery.
+
+        :param battery: Battery instance
+        :return: None
+        """
+        self.service[self.PATH_BALANCES] = [1 if cell.balance else 0 for cell in battery.cells]
+        if any(cell.voltage is None for cell in battery.cells):
+            self.service[self.PATH_VOLTAGES] = []
+            self.service[self.PATH_DEVIATIONS] = []
+            return
+        voltages = [round(cell.voltage, 3) for cell in battery.cells]
+        mean_voltage = sum(voltages) / len(voltages) if len(voltages) > 0 else 0
+        self.service[self.PATH_VOLTAGES] = voltages
+        # deviation from the mean cell voltage in mV
+        self.service[self.PATH_DEVIATIONS] = [round((voltage - mean_voltage) * 1000) for voltage in voltages]
+
+
+class BalancingPublisher:
+    """
+    Publishes the balancing counters of a battery (see bms/deye_can_balancing.py) as one array-typed dbus value each.
+    The counters change slowly, so the arrays are updated at most once per interval.
+    """
+
+    PATH_TIME = "/Balancing/TimeArray"
+    PATH_EVENTS = "/Balancing/EventsArray"
+    # duty cycle within a rolling window, e.g. /Balancing/DutyCycle1hArray
+    PATH_DUTY_CYCLE = "/Balancing/DutyCycle{}Array"
+
+    def __init__(self, service, interval: float = 60):
+        """
+        :param service: VeDbusService of the battery
+        :param interval: Minimal interval between two updates in seconds
+        """
+        from bms.deye_can_balancing import WINDOWS
+
+        self.service = service
+        self.interval = interval
+        self.last_update = 0
+        self.windows = [name for name, _, _ in WINDOWS]
+        self.service.add_path(self.PATH_TIME, [])
+        self.service.add_path(self.PATH_EVENTS, [])
+        for name in self.windows:
+            self.service.add_path(self.PATH_DUTY_CYCLE.format(name), [])
+
+    def update(self, battery) -> None:
+        """
+        Update the arrays with the balancing counters of the battery, if the interval elapsed.
+
+        :param battery: Battery instance with balancing counters
+        :return: None
+        """
+        if monotonic() - self.last_update < self.interval:
+            return
+        self.last_update = monotonic()
+        counters = battery.balancing
+        cells = min(battery.cell_count, counters.cells)
+        # balancing time in hours
+        self.service[self.PATH_TIME] = [round(seconds / 3600, 3) for seconds in counters.time[:cells]]
+        self.service[self.PATH_EVENTS] = list(counters.events[:cells])
+        # duty cycle in %
+        for window, name in enumerate(self.windows):
+            self.service[self.PATH_DUTY_CYCLE.format(name)] = [round(duty * 100, 1) for duty in counters.duty_cycles(window, time.time())[:cells]]
+
+
+class ChangeTrackedPublisher:
+    """
+    Publishes the values of a battery only, if the battery reports changed values.
+
+    Batteries with change tracking (pop_dirty()) are refreshed every cycle, but DbusHelper.publish_battery()
+    and the flush to dbus run only if values changed, the refresh failed or the full publishing interval elapsed,
+    so that calculated values (e.g. charge limits managed over time) are still sent regularly.
+    Batteries without change tracking are published and flushed every cycle.
+    The connection state and the alarms (URGENT_PATHS) are never held back.
+
+    Optionally the cell values are published as arrays (CellArrayPublisher) and the per-cell paths
+    are rate limited to the given interval.
+    """
+
+    URGENT_PATHS = re.compile(r"^/(Connected$|Alarms/)")
+
+    def __init__(self, helper, full_interval: float, cell_arrays: bool = False, cell_paths_interval: float = 0):
+        self.helper = helper
+        self.full_interval = full_interval
+        self.last_full_publish = 0
+        self.service = BatchedDbusService(helper._dbusservice)
+        helper._dbusservice = self.service
+        self.cell_arrays = None
+        if cell_arrays:
+            self.cell_arrays = CellArrayPublisher(self.service)
+            if cell_paths_interval > 0:
+                self.service.add_rate_limit(CellArrayPublisher.PATTERN_CELL_PATHS, cell_paths_interval)
+
+    def publish(self, loop) -> int:
+        """
+        Refresh the battery and publish the changed values.
+
+        :param loop: The main event loop
+        :return: Number of sent paths
+        """
+        battery = self.helper.battery
+        if not hasattr(battery, "pop_dirty"):
+            self.helper.publish_battery(loop)
+            return self._flush(-1)
+
+        result = battery.refresh_data()
+        dirty = battery.pop_dirty()
+        if dirty == 0 and result is True and monotonic() - self.last_full_publish < self.full_interval:
+            # nothing changed: no publish_battery(), the pending values are kept, except the urgent ones
+            return self.service.flush(self.URGENT_PATHS)
+
+        # publish_battery() uses the result instead of reading the battery again, like PollConcurrent.publish()
+        replaced = battery.__dict__.get("refresh_data")
+        battery.refresh_data = lambda: result
+        try:
+            self.helper.publish_battery(loop)
+        finally:
+            if replaced is None:
+                del battery.refresh_data
+            else:
+                battery.refresh_data = replaced
+        return self._flush(dirty)
+
+    def _flush(self, dirty: int) -> int:
+        battery = self.helper.battery
+        if self.cell_arrays is not None and (dirty == -1 or dirty & battery.DIRTY_CELLS):
+            self.cell_arrays.update(battery)
+        self.last_full_publish = monotonic()
+        sent = self.service.flush()
+        logger.debug(f"Published {sent} changed dbus paths")
+        return sent
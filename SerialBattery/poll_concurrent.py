@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Concurrent refresh of several batteries. The I/O bound refresh_data() calls of all batteries run in a
+# thread pool and are awaited until a common deadline. The results are published afterwards on the main
+# loop through the normal DbusHelper.publish_battery(), so dbus is only accessed from the main thread.
+# A battery, which misses the deadline, is reported with a failed refresh and runs through the same
+# error handling as a battery that does not respond (offline after 10 s, failed after 60 s). Its refresh
+# keeps running in the background and the battery is not refreshed again until it finished, so one slow
+# battery does not stall the others.
+# The batteries are grouped by their port: the batteries of one port (e.g. several BATTERY_ADDRESSES on one
+# half-duplex RS485 line) are refreshed one after another in the same thread, so their requests never overlap.
+# Only different ports are refreshed concurrently.
+#
+# By asmcc@github
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import monotonic
+from utils import logger
+
+
+class ConcurrentPoller:
+    """
+    Refreshes the batteries concurrently and publishes them with the refreshed results.
+    """
+
+    def __init__(self, battery: dict, max_workers: int = None):
+        """
+        :param battery: Dictionary key -> battery object
+        :param max_workers: Number of threads, one per port if None
+        """
+        self.battery = battery
+        ports = {self.battery[key].port for key in self.battery}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or len(ports), thread_name_prefix="refresh")
+        # port -> future of a refresh, which missed its deadline and is still running
+        self.overdue = {}
+        # key -> runtime of the last finished refresh in seconds
+        self.runtime = {}
+
+    def _refresh(self, group: list, results: dict) -> None:
+        # refresh the batteries of one port one after another, the results are available as soon as each finished
+        for key, refresh_data in group:
+            start = monotonic()
+            try:
+                results[key] = refresh_data()
+            except Exception as e:
+                logger.error(f"Refresh of battery {key} failed: {repr(e)}")
+                results[key] = False
+            finally:
+                self.runtime[key] = monotonic() - start
+
+    def refresh(self, deadline: float, keys: list = None) -> dict:
+        """
+        Refresh the batteries concurrently and wait at most until the deadline.
+
+        :param deadline: Maximal waiting time in seconds
+        :param keys: Keys of the batteries to refresh, all batteries if None
+        :return: Dictionary key -> result of refresh_data(), False if the deadline was missed
+        """
+        results = {}
+        groups = {}
+        for key in self.battery if keys is None else keys:
+            port = self.battery[key].port
+            if port in self.overdue:
+                if not self.overdue[port].done():
+                    # the refresh of the last cycle is still running on this port
+                    results[key] = False
+                    continue
+                del self.overdue[port]
+            # bind refresh_data now, publish() replaces it temporarily on the main thread
+            groups.setdefault(port, []).append((key, self.battery[key].refresh_data))
+
+        futures = {}
+        group_results = {}
+        for port, group in groups.items():
+            group_results[port] = {}
+            futures[port] = self.executor.submit(self._refresh, group, group_results[port])
+
+        wait(futures.values(), timeout=deadline)
+
+        for port, future in futures.items():
+            if not future.done():
+                self.overdue[port] = future
+            for key, _ in groups[port]:
+                if key in group_results[port]:
+                    results[key] = group_results[port][key]
+                else:
+                    logger.warning(f"Refresh of battery {key} missed the deadline of {deadline:.3f} s, battery data is stale")
+                    results[key] = False
+        return results
+
+    def publish(self, key, result: bool, publish) -> None:
+        """
+        Publish a battery with the result of its concurrent refresh.
+        refresh_data() of the battery is replaced during the call of publish, so that DbusHelper.publish_battery()
+        uses the result instead of reading the battery again.
+
+        :param key: Key of the battery
+        :param result: Result of the refresh
+        :param publish: Function, which calls DbusHelper.publish_battery() for this battery
+        :return: None
+        """
+        battery = self.battery[key]
+        battery.refresh_data = lambda: result
+        try:
+            publish()
+        finally:
+            del battery.refresh_data
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Adaptive poll scheduler with one interval per battery. The cost of each poll is measured with the
+# monotonic clock. From the 95th percentile of the last costs the interval of each battery is raised,
+# if the polls take too long, and lowered step by step, if the polls are fast, down to the lower bound
+# (POLL_INTERVAL_MIN, which may be below the configured interval, or the configured interval if not set). The batteries are polled by one GLib one-shot timer, which is rescheduled after each
+# poll for the next due battery. The due times are advanced by the interval from the last due time and
+# not from the end of the poll, so the polling does not drift. After a longer delay missed polls are
+# skipped instead of being executed in a burst.
+#
+# By asmcc@github
+
+from collections import deque
+from gi.repository import GLib
+from time import monotonic
+from utils import logger
+import math
+
+COST_SAMPLES = 20  # number of poll costs used for the percentile
+COST_HEADROOM = 1.25  # the interval should be at least 1.25 x the 95th percentile of the costs
+LOWER_FACTOR = 0.8  # the interval is lowered at most by this factor per poll
+
+
+def percentile(values, fraction: float) -> float:
+    """
+    Percentile of values with the nearest rank method.
+
+    :param values: Iterable of numbers
+    :param fraction: Percentile as fraction, e.g. 0.95
+    :return: The percentile, 0 for no values
+    """
+    ordered = sorted(values)
+    if len(ordered) == 0:
+        return 0
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class BatterySchedule:
+    """
+    Poll interval and due time of one battery.
+    """
+
+    def __init__(self, key, interval: float, min_interval: float, max_interval: float):
+        """
+        :param key: Key of the battery
+        :param interval: Configured poll interval in seconds
+        :param min_interval: Lower bound of the interval in seconds
+        :param max_interval: Upper bound of the interval in seconds
+        """
+        self.key = key
+        self.base_interval = None
+        self.interval = interval
+        self.configure(interval, min_interval, max_interval)
+        self.costs = deque(maxlen=COST_SAMPLES)
+        self.due = monotonic()
+
+    def configure(self, interval: float, min_interval: float, max_interval: float) -> None:
+        """
+        Set the configured interval and the bounds. The current interval is kept within the new bounds,
+        a changed configured interval is used as the new current interval.
+
+        :param interval: Configured poll interval in seconds
+        :param min_interval: Lower bound of the interval in seconds
+        :param max_interval: Upper bound of the interval in seconds
+        :return: None
+        """
+        if interval != self.base_interval:
+            self.interval = interval
+        self.base_interval = interval
+        self.max_interval = max(max_interval, interval)
+        self.min_interval = min(min_interval, self.max_interval)
+        self.interval = min(self.max_interval, max(self.min_interval, self.interval))
+
+    def add_cost(self, cost: float) -> None:
+        """
+        Add the cost of a poll and adapt the interval.
+
+        :param cost: Duration of the poll in seconds
+        :return: None
+        """
+        self.costs.append(cost)
+        # the lower bound and not the configured interval is the floor, so fast polls lower the interval below it
+        target = max(self.min_interval, percentile(self.costs, 0.95) * COST_HEADROOM)
+        if target > self.interval:
+            # raise immediately to the required interval
+            interval = target
+        else:
+            # lower step by step, so that a single fast poll does not cause the next overload
+            interval = max(target, self.interval * LOWER_FACTOR)
+        interval = min(self.max_interval, max(self.min_interval, round(interval, 1)))
+        if interval != self.interval:
+            logger.info(f"Poll interval of battery {self.key} changed from {self.interval:.1f} s to {interval:.1f} s")
+            self.interval = interval
+
+    def advance(self, now: float) -> None:
+        # next due time based on the last due time, skip missed polls after a longer delay
+        self.due += self.interval
+        if self.due < now:
+            self.due = now + self.interval - (now - self.due) % self.interval
+
+
+class PollScheduler:
+    """
+    Polls each battery with its own adaptive interval through a GLib timer.
+    """
+
+    def __init__(self, battery: dict, poll, min_interval: float = 0, max_interval: float = 60):
+        """
+        :param battery: Dictionary key -> battery object, the initial interval is the poll_interval of each battery
+        :param poll: Function called with the list of due keys, which returns a dictionary key -> cost in seconds
+        :param min_interval: Lower bound of the intervals in seconds (0 = poll_interval of the battery)
+        :param max_interval: Upper bound of the intervals in seconds
+        """
+        self.battery = battery
+        self.poll = poll
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.schedules = {}
+        for key in battery:
+            interval = battery[key].poll_interval / 1000
+            self.schedules[key] = BatterySchedule(key, interval, min_interval if min_interval > 0 else interval, max_interval)
+        self.timer = None
+
+    def reconfigure(self, interval: float = None, min_interval: float = None, max_interval: float = None) -> None:
+        """
+        Change the configured interval and the bounds of all batteries, e.g. after a reload of the config.
+
+        :param interval: Configured poll interval in seconds, None to keep the configured interval of each battery
+        :param min_interval: Lower bound of the intervals in seconds (0 = configured interval), None to keep it
+        :param max_interval: Upper bound of the intervals in seconds, None to keep it
+        :return: None
+        """
+        if min_interval is not None:
+            self.min_interval = min_interval
+        if max_interval is not None:
+            self.max_interval = max_interval
+        for key, schedule in self.schedules.items():
+            base_interval = schedule.base_interval if interval is None else interval
+            schedule.configure(base_interval, self.min_interval if self.min_interval > 0 else base_interval, self.max_interval)
+            self.battery[key].poll_interval = schedule.interval * 1000
+
+    def start(self) -> None:
+        """
+        Start polling. All batteries are polled the first time immediately.
+
+        :return: None
+        """
+        now = monotonic()
+        for schedule in self.schedules.values():
+            schedule.due = now
+        self._schedule(now)
+
+    def stop(self) -> None:
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+
+    def _schedule(self, now: float) -> None:
+        delay = max(0, min(schedule.due for schedule in self.schedules.values()) - now)
+        self.timer = GLib.timeout_add(round(delay * 1000), self._on_timer)
+
+    def _on_timer(self) -> bool:
+        self.timer = None
+        now = monotonic()
+        # batteries due within the next 10 ms are polled together
+        due = [key for key, schedule in self.schedules.items() if schedule.due <= now + 0.01]
+        try:
+            costs = self.poll(due) if len(due) > 0 else {}
+        except Exception as e:
+            logger.error(f"Exception occurred while polling: {repr(e)}")
+            costs = {}
+        now = monotonic()
+        for key in due:
+            schedule = self.schedules[key]
+            if key in costs:
+                schedule.add_cost(costs[key])
+                self.battery[key].poll_interval = schedule.interval * 1000
+            schedule.advance(now)
+        self._schedule(now)
+        # one-shot timer, the next timer is already scheduled
+        return False
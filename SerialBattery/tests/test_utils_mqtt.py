@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Tests of the MQTT state writer (utils_mqtt.py) with a recording client instead of paho-mqtt.
+# Run in the folder of the driver with the modules of dbus-serialbattery (utils, bms):
+#   python3 -m unittest discover -s tests
+#
+# By asmcc@github
+
+from unittest import mock
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bms.deye_can_state import MAX_CELLS, NO_VALUE, PARAMETER_FIELDS, PROTECTION_FIELDS, STATE, STATE_FIELDS  # noqa: E402
+from utils_mqtt import MqttStateWriter  # noqa: E402
+
+PREFIX = "dbus-serialbattery/can0"
+
+
+def make_record(**values) -> bytes:
+    # state record with defaults for all fields not given
+    fields = []
+    for name, code, count in STATE_FIELDS:
+        if name == "cell_voltages":
+            voltages = values.get(name, [])
+            fields.extend(voltages + [math.nan] * (MAX_CELLS - len(voltages)))
+        elif name == "protection":
+            fields.extend([NO_VALUE] * len(PROTECTION_FIELDS))
+        elif name == "parameters":
+            parameters = values.get(name, {})
+            fields.extend(parameters.get(parameter, math.nan) for parameter in PARAMETER_FIELDS)
+        elif code.endswith("s"):
+            fields.append(values.get(name, b""))
+        elif code == "d":
+            fields.append(values.get(name, math.nan))
+        else:
+            fields.append(values.get(name, 0))
+    return STATE.pack(*fields)
+
+
+class RecordingClient:
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.messages.append((topic, payload))
+
+    def topics(self) -> list:
+        return [topic for topic, _ in self.messages]
+
+    def payloads(self, topic: str) -> list:
+        return [payload for published, payload in self.messages if published == topic]
+
+
+class MqttStateWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.client = RecordingClient()
+        self.now = 1000.0
+        patcher = mock.patch("utils_mqtt.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def writer(self, deadbands=None, max_rate=0) -> MqttStateWriter:
+        return MqttStateWriter(PREFIX, deadbands or {}, max_rate, client=self.client)
+
+    def test_deadband(self):
+        writer = self.writer({"voltage": 0.01})
+        writer.write(make_record(voltage=52.00))
+        writer.write(make_record(voltage=52.005))
+        writer.write(make_record(voltage=52.02))
+        self.assertEqual(self.client.payloads(PREFIX + "/voltage"), ["52.0", "52.02"])
+
+    def test_unchanged_values_are_not_published_again(self):
+        writer = self.writer()
+        writer.write(make_record(soc=80.0))
+        count = len(self.client.messages)
+        writer.write(make_record(soc=80.0))
+        self.assertEqual(len(self.client.messages), count)
+
+    def test_rate_limit(self):
+        writer = self.writer(max_rate=1)
+        writer.write(make_record(current=1.0))
+        self.now += 0.5
+        writer.write(make_record(current=2.0))
+        self.assertEqual(self.client.payloads(PREFIX + "/current"), ["1.0"])
+        # the blocked value is compared again with the next record after the interval
+        self.now += 0.6
+        writer.write(make_record(current=2.0))
+        self.assertEqual(self.client.payloads(PREFIX + "/current"), ["1.0", "2.0"])
+
+    def test_nan_is_published_as_null(self):
+        writer = self.writer()
+        writer.write(make_record(voltage=52.0))
+        writer.write(make_record())
+        self.assertEqual(self.client.payloads(PREFIX + "/voltage"), ["52.0", "null"])
+
+    def test_parameters_are_published_by_name(self):
+        writer = self.writer()
+        writer.write(make_record(parameters={"cell_overvoltage_l1": 3.65}))
+        self.assertEqual(self.client.payloads(PREFIX + "/parameters/cell_overvoltage_l1"), ["3.65"])
+        # parameters without a response are not published
+        self.assertNotIn(PREFIX + "/parameters/battery_type", self.client.topics())
+
+    def test_reconnect_snapshot(self):
+        writer = self.writer(max_rate=1)
+        writer.write(make_record(voltage=52.0, cell_count=2, cell_voltages=[3.25, 3.26]))
+        writer.on_disconnect(self.client, None, 1)
+        # values written while disconnected are kept for the snapshot, but not published
+        self.client.messages.clear()
+        writer.write(make_record(voltage=53.0, cell_count=2, cell_voltages=[3.25, 3.27]))
+        self.assertEqual(self.client.messages, [])
+        # the snapshot ignores the rate limit and contains all current values
+        writer.on_connect(self.client, None, {}, 0)
+        self.assertEqual(self.client.payloads(PREFIX + "/voltage"), ["53.0"])
+        self.assertEqual(self.client.payloads(PREFIX + "/cell_voltages/2"), ["3.27"])
+        self.assertIn(PREFIX + "/snapshot", self.client.topics())
+        self.assertIn('"voltage": 53.0', self.client.payloads(PREFIX + "/snapshot")[0])
+
+    def test_failed_connect_publishes_nothing(self):
+        writer = self.writer()
+        writer.on_disconnect(self.client, None, 1)
+        writer.write(make_record(voltage=52.0))
+        writer.on_connect(self.client, None, {}, 5)
+        self.assertEqual(self.client.messages, [])
+        self.assertFalse(writer.connected)
+
+    def test_client_id_is_unique_per_port(self):
+        first = MqttStateWriter("dbus-serialbattery/can0", {}, 0)
+        second = MqttStateWriter("dbus-serialbattery/can1", {}, 0)
+        self.assertNotEqual(first.client_id(), second.client_id())
+
+    def test_close_keeps_an_injected_client(self):
+        client = mock.Mock()
+        writer = MqttStateWriter(PREFIX, {}, 0, client=client)
+        writer.close()
+        client.loop_stop.assert_not_called()
+        writer.write(make_record(voltage=52.0))
+        client.publish.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Fast detection of the bitrate of a CAN bus without disturbing other devices on the bus (e.g. the inverter).
+# The interface is set to listen-only mode with each candidate bitrate and the valid and erroneous frames
+# are counted for a short time. In listen-only mode the controller sends neither frames, acknowledges
+# nor error frames, so the bus is not influenced by a wrong bitrate. With the right bitrate valid frames
+# are received, with a wrong bitrate only bus errors are counted.
+# After the detection the interface is set back to normal mode with the detected bitrate, the other settings of
+# the interface (ctrlmode flags, restart-ms, up/down state) are restored from `ip -details link`.
+#
+# The interface is only reconfigured, if no valid frames are received at the configured bitrate: on a running bus
+# the detection only listens, so the other users of a shared interface (e.g. vecan0) are not disturbed.
+# Controllers without bus error reporting (e.g. mcp251x of the MCP2515 CAN HATs) reject berr-reporting with
+# EOPNOTSUPP, they are configured without it and the bus errors are taken from the interface statistics.
+#
+# Requires the ip command of iproute2 and the permission to configure the interface (root on Venus OS).
+#
+# By asmcc@github
+
+from utils import logger
+from time import monotonic
+import json
+import socket
+import struct
+import subprocess
+
+CAN_RAW_ERR_FILTER = 2  # socket option of CAN_RAW, not exported by the socket module
+CAN_FRAME = struct.Struct("=IB3x8s")
+MIN_VALID_FRAMES = 3  # minimal number of valid frames to accept a bitrate
+# ctrlmode flags changed by the detection, the other flags are not touched by `ip link set`
+CTRLMODES = ("LISTEN-ONLY", "BERR-REPORTING")
+
+_no_berr_reporting = set()  # interfaces rejecting berr-reporting
+
+
+def _ip_link_set(channel: str, *args) -> None:
+    subprocess.run(["ip", "link", "set", channel, *args], capture_output=True, text=True, check=True)
+
+
+def get_link_settings(channel: str) -> dict:
+    """
+    Get the settings of a CAN interface.
+
+    :param channel: Name of the CAN interface, e.g. can0
+    :return: Dictionary with bitrate in kbps (None if unknown), ctrlmode (list of flags), restart_ms (None if unknown)
+             and up, None if the interface is not accessible
+    """
+    try:
+        ip_out = subprocess.run(["ip", "-details", "-json", "link", "show", "dev", channel], capture_output=True, text=True, check=True)
+        link = json.loads(ip_out.stdout)[0]
+        info_data = link["linkinfo"]["info_data"]
+        bitrate = info_data.get("bittiming", {}).get("bitrate")
+        return {
+            "bitrate": None if bitrate is None else round(bitrate / 1000),
+            "ctrlmode": info_data.get("ctrlmode", []),
+            "restart_ms": info_data.get("restart_ms"),
+            "up": "UP" in link.get("flags", []),
+        }
+    except (subprocess.CalledProcessError, OSError, ValueError, KeyError, IndexError):
+        return None
+
+
+def get_bitrate(channel: str) -> tuple:
+    """
+    Get the configured bitrate and the listen-only state of a CAN interface.
+
+    :param channel: Name of the CAN interface, e.g. can0
+    :return: Tuple of bitrate in kbps (None if unknown) and listen-only flag
+    """
+    settings = get_link_settings(channel)
+    if settings is None:
+        return None, False
+    return settings["bitrate"], "LISTEN-ONLY" in settings["ctrlmode"]
+
+
+def set_bitrate(channel: str, bitrate: int, listen_only: bool = False, ctrlmode: dict = None, restart_ms: int = None, up: bool = True) -> None:
+    """
+    Restart a CAN interface with the given bitrate.
+
+    :param channel: Name of the CAN interface, e.g. can0
+    :param bitrate: Bitrate in kbps
+    :param listen_only: Set the controller into listen-only mode with bus error reporting
+    :param ctrlmode: Further ctrlmode flags, e.g. {"one-shot": True}, overriding listen-only and berr-reporting
+    :param restart_ms: Automatic restart delay after bus off in ms, unchanged if None
+    :param up: Set the interface up after the configuration
+    :return: None
+    """
+    flags = {"listen-only": listen_only, "berr-reporting": listen_only}
+    flags.update(ctrlmode or {})
+    if channel in _no_berr_reporting:
+        flags.pop("berr-reporting", None)
+    args = ["type", "can", "bitrate", str(bitrate * 1000)]
+    if restart_ms is not None:
+        args += ["restart-ms", str(restart_ms)]
+    _ip_link_set(channel, "down")
+    try:
+        _ip_link_set(channel, *args, *[arg for flag, on in flags.items() for arg in (flag, "on" if on else "off")])
+    except subprocess.CalledProcessError as e:
+        if "berr-reporting" not in flags or "not supported" not in (e.stderr or "").lower():
+            raise
+        # e.g. mcp251x: EOPNOTSUPP for berr-reporting, the rx_errors statistics are used instead
+        logger.debug(f"{channel} does not support berr-reporting")
+        _no_berr_reporting.add(channel)
+        flags.pop("berr-reporting")
+        _ip_link_set(channel, *args, *[arg for flag, on in flags.items() for arg in (flag, "on" if on else "off")])
+    if up:
+        _ip_link_set(channel, "up")
+
+
+def restore_link_settings(channel: str, settings: dict, bitrate: int = None) -> None:
+    """
+    Restore the settings of get_link_settings().
+
+    :param channel: Name of the CAN interface, e.g. can0
+    :param settings: Settings returned by get_link_settings()
+    :param bitrate: Bitrate in kbps replacing the saved one, e.g. the detected bitrate
+    :return: None
+    """
+    ctrlmode = {flag.lower(): flag in settings["ctrlmode"] for flag in CTRLMODES}
+    if bitrate is not None:
+        # the detected bitrate is used in normal mode
+        ctrlmode["listen-only"] = False
+    set_bitrate(channel, bitrate or settings["bitrate"], ctrlmode=ctrlmode, restart_ms=settings["restart_ms"], up=settings["up"] or bitrate is not None)
+
+
+def _rx_errors(channel: str) -> int:
+    try:
+        with open(f"/sys/class/net/{channel}/statistics/rx_errors", "r") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 0
+
+
+def sample_bus(channel: str, duration: float) -> tuple:
+    """
+    Count the valid and erroneous frames on a CAN interface.
+
+    :param channel: Name of the CAN interface, e.g. can0
+    :param duration: Sampling time in seconds
+    :return: Tuple of the number of valid frames and the number of errors
+    """
+    valid = 0
+    errors = 0
+    rx_errors = _rx_errors(channel)
+    with socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW) as sock:
+        # also receive error frames (bus errors, error passive, bus off)
+        sock.setsockopt(socket.SOL_CAN_RAW, CAN_RAW_ERR_FILTER, struct.pack("=I", socket.CAN_ERR_MASK))
+        sock.bind((channel,))
+        end = monotonic() + duration
+        while True:
+            timeout = end - monotonic()
+            if timeout <= 0:
+                break
+            sock.settimeout(timeout)
+            try:
+                can_id = CAN_FRAME.unpack(sock.recv(CAN_FRAME.size))[0]
+            except socket.timeout:
+                break
+            except OSError:
+                # e.g. ENETDOWN after a bus off
+                errors += 1
+                break
+            if can_id & socket.CAN_ERR_FLAG:
+                errors += 1
+            else:
+                valid += 1
+    # bus errors are also counted by the driver, if the controller does not report error frames
+    errors = max(errors, _rx_errors(channel) - rx_errors)
+    return valid, errors
+
+
+def detect_bitrate(channel: str, bitrates: list, sample_time: float) -> int:
+    """
+    Detect the bitrate of a CAN bus in listen-only mode.
+    If valid frames are received at the configured bitrate, the interface is not touched. Otherwise the
+    candidates are tried in listen-only mode, the interface stays configured with the detected bitrate in
+    normal mode. The other settings and, if no bitrate was detected, the previous configuration are restored.
+
+    :param channel: Name of the CAN interface, e.g. can0
+    :param bitrates: Candidate bitrates in kbps
+    :param sample_time: Sampling time for each bitrate in seconds
+    :return: The detected bitrate in kbps or None
+    """
+    start = monotonic()
+    settings = get_link_settings(channel)
+    current_bitrate = None if settings is None else settings["bitrate"]
+    if settings is not None and settings["up"] and current_bitrate in bitrates:
+        # only listen on a running bus, so the other users of the interface are not disturbed
+        try:
+            valid, errors = sample_bus(channel, sample_time)
+            if valid >= MIN_VALID_FRAMES and errors <= valid:
+                logger.info(f"Receiving frames at the configured bitrate {current_bitrate} kbps on {channel}, detection skipped")
+                return current_bitrate
+        except OSError as e:
+            logger.debug(f"Autobaud {channel}: sampling at the configured bitrate failed: {e}")
+    candidates = sorted(bitrates, key=lambda bitrate: bitrate != current_bitrate)
+    detected = None
+    try:
+        for bitrate in candidates:
+            set_bitrate(channel, bitrate, listen_only=True)
+            valid, errors = sample_bus(channel, sample_time)
+            logger.debug(f"Autobaud {channel} at {bitrate} kbps: {valid} valid frames, {errors} errors")
+            if valid >= MIN_VALID_FRAMES and errors <= valid:
+                detected = bitrate
+                break
+    except (subprocess.CalledProcessError, OSError) as e:
+        logger.warning(f"Autobaud on {channel} not possible: {e}")
+
+    try:
+        if detected is not None:
+            if settings is None:
+                set_bitrate(channel, detected)
+            else:
+                restore_link_settings(channel, settings, detected)
+            logger.info(f"Detected bitrate {detected} kbps on {channel} in {monotonic() - start:.2f} s")
+        elif current_bitrate is not None:
+            restore_link_settings(channel, settings)
+            logger.info(f"No bitrate detected on {channel}, keep {current_bitrate} kbps")
+    except (subprocess.CalledProcessError, OSError) as e:
+        logger.error(f"Error while configuring {channel}: {e}")
+    return detected
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Tracing of the data age from the reception of a CAN message to the publishing on dbus.
+# Batteries with frame_time (DEYE CAN) record for each value group the kernel timestamp of the last CAN message,
+# which delivered values of this group. After each publishing the age of each group is sampled and the
+# 50th and 99th percentile of the last samples are logged periodically, e.g.:
+#   Data age can0 [ms]: measurement p50 420 p99 980, cells p50 510 p99 1020, ...
+# Optionally the age of the measurement values (voltage, current, SOC) is published on dbus:
+#   /DataAge         current age in seconds
+#   /DataAge/P50     50th percentile in milliseconds
+#   /DataAge/P99     99th percentile in milliseconds
+#
+# By asmcc@github
+
+from collections import deque
+from poll_scheduler import percentile
+from time import monotonic
+from utils import logger
+import time
+
+AGE_SAMPLES = 600  # number of samples per value group used for the percentiles
+
+
+class DataAgeTracer:
+    """
+    Samples the age of the published values of one battery.
+    """
+
+    PATH_AGE = "/DataAge"
+    PATH_P50 = "/DataAge/P50"
+    PATH_P99 = "/DataAge/P99"
+
+    def __init__(self, name: str, battery, service=None, log_interval: float = 60):
+        """
+        :param name: Name of the battery used in the log, e.g. the port
+        :param battery: Battery object with frame_time and DIRTY_GROUP_NAMES
+        :param service: VeDbusService to publish the age of the measurement values, None to disable
+        :param log_interval: Interval in seconds for logging the statistics (0 = no logging)
+        """
+        self.name = name
+        self.battery = battery
+        self.service = service
+        self.log_interval = log_interval
+        self.last_log = monotonic()
+        self.ages = {bit: deque(maxlen=AGE_SAMPLES) for bit in battery.DIRTY_GROUP_NAMES}
+        if self.service is not None:
+            self.service.add_path(self.PATH_AGE, None)
+            self.service.add_path(self.PATH_P50, None)
+            self.service.add_path(self.PATH_P99, None)
+
+    def statistics(self) -> dict:
+        """
+        Percentiles of the sampled ages.
+
+        :return: Dictionary group name -> (p50, p99) in seconds
+        """
+        return {
+            self.battery.DIRTY_GROUP_NAMES[bit]: (percentile(ages, 0.5), percentile(ages, 0.99)) for bit, ages in self.ages.items() if len(ages) > 0
+        }
+
+    def record(self) -> None:
+        """
+        Sample the age of each value group at the time of the publishing.
+
+        :return: None
+        """
+        now = time.time()
+        for bit, frame_time in self.battery.frame_time.items():
+            self.ages[bit].append(max(0, now - frame_time))
+
+        measurement = self.ages[self.battery.DIRTY_MEASUREMENT]
+        if self.service is not None and len(measurement) > 0:
+            self.service[self.PATH_AGE] = round(measurement[-1], 3)
+            self.service[self.PATH_P50] = round(percentile(measurement, 0.5) * 1000)
+            self.service[self.PATH_P99] = round(percentile(measurement, 0.99) * 1000)
+
+        if self.log_interval > 0 and monotonic() - self.last_log >= self.log_interval:
+            self.last_log = monotonic()
+            statistics = self.statistics()
+            if len(statistics) > 0:
+                logger.info(
+                    f"Data age {self.name} [ms]: "
+                    + ", ".join(f"{name} p50 {p50 * 1000:.0f} p99 {p99 * 1000:.0f}" for name, (p50, p99) in statistics.items())
+                )
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Settings for the extensions of this repository (DEYE driver, main script additions).
+# The values are read from the same config.default.ini and config.ini files as the settings in utils.py,
+# so they can be added to the [DEFAULT] section of config.ini like every other setting.
+#
+# By asmcc@github
+
+from utils import config
+
+
+def get_bool(option: str, default: bool = False) -> bool:
+    """
+    Get a boolean value from the config file.
+
+    :param option: Name of the setting in the [DEFAULT] section
+    :param default: Value used, if the setting is missing or invalid
+    :return: The boolean value
+    """
+    try:
+        return config.getboolean("DEFAULT", option, fallback=default)
+    except ValueError:
+        return default
+
+
+def get_int(option: str, default: int = 0) -> int:
+    """
+    Get an integer value from the config file.
+
+    :param option: Name of the setting in the [DEFAULT] section
+    :param default: Value used, if the setting is missing or invalid
+    :return: The integer value
+    """
+    try:
+        return config.getint("DEFAULT", option, fallback=default)
+    except ValueError:
+        return default
+
+
+def get_float(option: str, default: float = 0) -> float:
+    """
+    Get a float value from the config file.
+
+    :param option: Name of the setting in the [DEFAULT] section
+    :param default: Value used, if the setting is missing or invalid
+    :return: The float value
+    """
+    try:
+        return config.getfloat("DEFAULT", option, fallback=default)
+    except ValueError:
+        return default
+
+
+def get_str(option: str, default: str = "") -> str:
+    """
+    Get a string value from the config file. Surrounding quotes are removed.
+
+    :param option: Name of the setting in the [DEFAULT] section
+    :param default: Value used, if the setting is missing
+    :return: The string value
+    """
+    return config.get("DEFAULT", option, fallback=default).strip().strip('"')
+
+
+def get_int_list(option: str, default: list = None) -> list:
+    """
+    Get a comma separated list of integer values from the config file.
+
+    :param option: Name of the setting in the [DEFAULT] section
+    :param default: Value used, if the setting is missing or invalid
+    :return: The list of integer values
+    """
+    try:
+        return [int(value) for value in get_str(option).split(",") if value.strip() != ""] or list(default or [])
+    except ValueError:
+        return list(default or [])
+
+
+# --------- DEYE CAN ingestion process ---------
+# Decode the CAN messages in a separate process and hand over the decoded values through shared memory
+DEYE_CAN_INGEST_PROCESS = get_bool("DEYE_CAN_INGEST_PROCESS", False)
+# Maximal age of the shared memory snapshot in seconds, before the battery is reported as not responding
+DEYE_CAN_INGEST_MAX_AGE = get_float("DEYE_CAN_INGEST_MAX_AGE", 10)
+
+# --------- DEYE CAN INTERCAN interfaces ---------
+# INTERCAN interface for each PCSCAN interface as pcscan:intercan list, e.g. can0:can2,can1:can3
+# Needed in multi-port mode with more than one CAN port (without an entry no INTERCAN is used for the port), otherwise the second CAN interface is detected automatically
+DEYE_CAN_INTERCAN_PORTS = get_str("DEYE_CAN_INTERCAN_PORTS", "")
+
+# --------- DEYE CAN state export ---------
+# Export the decoded values of each battery into a memory-mapped file with a fixed layout, see bms/deye_can_state.py
+DEYE_CAN_STATE_EXPORT = get_bool("DEYE_CAN_STATE_EXPORT", False)
+# Directory of the exported state files
+DEYE_CAN_STATE_EXPORT_PATH = get_str("DEYE_CAN_STATE_EXPORT_PATH", "/run/dbus-serialbattery")
+
+# --------- Change tracked dbus publishing ---------
+# Send only changed dbus paths in one batch. Batteries with change tracking (DEYE CAN) are only published,
+# if decoded values changed or the full publishing interval elapsed
+DBUS_BATCHED_PUBLISH = get_bool("DBUS_BATCHED_PUBLISH", False)
+# Interval in seconds, after which all pending values are published even without changed decoded values
+DBUS_BATCHED_PUBLISH_FULL_INTERVAL = get_float("DBUS_BATCHED_PUBLISH_FULL_INTERVAL", 10)
+
+# --------- Compact cell values on dbus ---------
+# Publish cell voltages, balancing states and cell deviations additionally as one array-typed dbus path each
+DBUS_CELL_ARRAYS = get_bool("DBUS_CELL_ARRAYS", False)
+# Minimal interval in seconds between updates of the per-cell paths, if DBUS_CELL_ARRAYS is enabled (0 = no limit)
+DBUS_CELL_PATHS_INTERVAL = get_float("DBUS_CELL_PATHS_INTERVAL", 10)
+
+# --------- MQTT output ---------
+# Publish changed DEYE CAN values to a local MQTT broker (requires the Python module paho-mqtt)
+MQTT_PUBLISH = get_bool("MQTT_PUBLISH", False)
+MQTT_HOST = get_str("MQTT_HOST", "localhost")
+MQTT_PORT = get_int("MQTT_PORT", 1883)
+MQTT_TOPIC_PREFIX = get_str("MQTT_TOPIC_PREFIX", "dbus-serialbattery")
+# Minimal change of a value before it is published again, as field:deadband list
+MQTT_DEADBANDS = get_str(
+    "MQTT_DEADBANDS",
+    "voltage:0.01,current:0.1,soc:0.5,cell_voltages:0.002,cell_min_voltage:0.002,cell_max_voltage:0.002,"
+    + "temperature_mos:0.5,temperature_1:0.5,temperature_2:0.5,temperature_3:0.5,temperature_4:0.5",
+)
+# Maximal number of messages per second for each topic (0 = no limit)
+MQTT_MAX_RATE = get_float("MQTT_MAX_RATE", 1)
+
+# --------- CAN bitrate autodetection ---------
+# Detect the bitrate of PCSCAN and INTERCAN in listen-only mode instead of trying each bitrate with a full battery detection
+CAN_AUTOBAUD = get_bool("CAN_AUTOBAUD", False)
+# Candidate bitrates in kbps
+CAN_AUTOBAUD_BITRATES = get_int_list("CAN_AUTOBAUD_BITRATES", [250, 500])
+# Sampling time for each bitrate in seconds
+CAN_AUTOBAUD_SAMPLE_TIME = get_float("CAN_AUTOBAUD_SAMPLE_TIME", 0.3)
+
+# --------- Concurrent polling ---------
+# Refresh the batteries of different ports concurrently in a thread pool, the batteries of one port one after another, publishing stays on the main loop
+POLL_CONCURRENT = get_bool("POLL_CONCURRENT", False)
+# Deadline in seconds for the refresh of each battery, after which its data is treated as stale (0 = 90 % of the poll interval)
+POLL_CONCURRENT_DEADLINE = get_float("POLL_CONCURRENT_DEADLINE", 0)
+
+# --------- Adaptive poll interval ---------
+# Bounds in milliseconds for the poll interval of each battery, which starts with the configured interval (POLL_INTERVAL or
+# the default of the BMS), is raised if the polls take too long and lowered down to POLL_INTERVAL_MIN, if they are fast
+# (0 = the configured interval is the lower bound)
+POLL_INTERVAL_MIN = get_int("POLL_INTERVAL_MIN", 0)
+POLL_INTERVAL_MAX = get_int("POLL_INTERVAL_MAX", 60000)
+
+# --------- Data age tracing ---------
+# Trace the age of the published values from the reception of the CAN message (DEYE CAN) and log p50/p99 per value group
+DATA_AGE_TRACING = get_bool("DATA_AGE_TRACING", False)
+# Interval in seconds for logging the data age statistics (0 = no logging)
+DATA_AGE_LOG_INTERVAL = get_float("DATA_AGE_LOG_INTERVAL", 60)
+# Publish the age of the measurement values on /DataAge, /DataAge/P50 and /DataAge/P99
+DATA_AGE_DBUS = get_bool("DATA_AGE_DBUS", False)
+
+# --------- Handoff ---------
+# Hand over the CAN sockets and the decoded values to a new driver process started for the same port (restart, upgrade)
+# without a new battery detection. The old driver releases its dbus services and exits, see utils_handoff.py
+HANDOFF = get_bool("HANDOFF", False)
+
+# --------- DEYE CAN event journal ---------
+# Record the alarm and MOSFET transitions in an append-only binary journal, see bms/deye_can_journal.py
+DEYE_CAN_JOURNAL = get_bool("DEYE_CAN_JOURNAL", False)
+# Directory of the journals, one subdirectory per port. Should be on persistent storage
+DEYE_CAN_JOURNAL_PATH = get_str("DEYE_CAN_JOURNAL_PATH", "/data/dbus-serialbattery/journal")
+# Maximal time in seconds a transition is buffered, before it is written and synced (less writes to the SD card)
+DEYE_CAN_JOURNAL_FLUSH_INTERVAL = get_float("DEYE_CAN_JOURNAL_FLUSH_INTERVAL", 60)
+# Number of kept journal segments of 65536 transitions (1 MiB) each, the oldest segments are deleted
+DEYE_CAN_JOURNAL_MAX_SEGMENTS = get_int("DEYE_CAN_JOURNAL_MAX_SEGMENTS", 16)
+
+# --------- DEYE CAN archive ---------
+# Archive voltage, current, SOC, temperatures and cell voltages in a round-robin file with a fixed size, see bms/deye_can_archive.py
+DEYE_CAN_ARCHIVE = get_bool("DEYE_CAN_ARCHIVE", False)
+# Directory of the archive files. Should be on persistent storage
+DEYE_CAN_ARCHIVE_PATH = get_str("DEYE_CAN_ARCHIVE_PATH", "/data/dbus-serialbattery/archive")
+# Resolutions as step in seconds:number of buckets, default 1 s for one day, 1 min for 31 days, 1 h for 10 years (about 65 MB per port)
+DEYE_CAN_ARCHIVE_RESOLUTIONS = get_str("DEYE_CAN_ARCHIVE_RESOLUTIONS", "1:86400,60:44640,3600:87600")
+# Interval in seconds for writing the aggregated values to the archive file
+DEYE_CAN_ARCHIVE_FLUSH_INTERVAL = get_float("DEYE_CAN_ARCHIVE_FLUSH_INTERVAL", 300)
+
+# --------- DEYE CAN batch decoding ---------
+# Decode a backlog of queued CAN messages (e.g. after a stall) as one batch, see bms/deye_can_batch.py
+DEYE_CAN_BATCH_DECODE = get_bool("DEYE_CAN_BATCH_DECODE", False)
+
+# --------- DEYE CAN protocol description ---------
+# Directory of the decoders compiled from bms/deye_can.dbc, compiled again only if the DBC file changes. Empty: compile on each start
+DEYE_CAN_DBC_CACHE_PATH = get_str("DEYE_CAN_DBC_CACHE_PATH", "/data/dbus-serialbattery/cache")
+
+# --------- DEYE CAN parameter query ---------
+# Read the protection settings, counters and the battery type of the BMS with requests over INTERCAN, see bms/deye_can_parameters.py
+DEYE_CAN_PARAMETER_QUERY = get_bool("DEYE_CAN_PARAMETER_QUERY", False)
+# Minimal time in seconds between two parameter requests
+DEYE_CAN_PARAMETER_QUERY_INTERVAL = get_float("DEYE_CAN_PARAMETER_QUERY_INTERVAL", 0.1)
+# Time in seconds the read parameters are kept, before they are requested again
+DEYE_CAN_PARAMETER_TTL = get_float("DEYE_CAN_PARAMETER_TTL", 3600)
+
+# --------- DEYE CAN balancing accounting ---------
+# Account the balancing time, events and duty cycles of each cell and publish them on /Balancing/..., see bms/deye_can_balancing.py
+DEYE_CAN_BALANCING = get_bool("DEYE_CAN_BALANCING", False)
+# Directory of the counter files. Should be on persistent storage
+DEYE_CAN_BALANCING_PATH = get_str("DEYE_CAN_BALANCING_PATH", "/data/dbus-serialbattery/balancing")
+# Interval in seconds for saving the counters
+DEYE_CAN_BALANCING_SAVE_INTERVAL = get_float("DEYE_CAN_BALANCING_SAVE_INTERVAL", 300)
+
+# --------- Memory monitor ---------
+# Sample the RSS and the allocated memory blocks after each poll cycle and publish them on /Memory/..., see utils_memory.py
+MEMORY_MONITOR = get_bool("MEMORY_MONITOR", False)
+# Allowed growth of the RSS in kB over the baseline taken after the warm-up, a warning is logged if exceeded
+MEMORY_BUDGET = get_int("MEMORY_BUDGET", 4096)
+# Minimal interval in seconds between two warnings about the exceeded budget
+MEMORY_MONITOR_LOG_INTERVAL = get_float("MEMORY_MONITOR_LOG_INTERVAL", 3600)
+# Trace the allocations with tracemalloc to log the call sites of the growth (costs CPU and memory)
+MEMORY_MONITOR_TRACEMALLOC = get_bool("MEMORY_MONITOR_TRACEMALLOC", False)
+
+# --------- Profiler ---------
+# Start and stop profiling of the running driver with SIGUSR1, see utils_profiler.py
+SIGNAL_PROFILER = get_bool("SIGNAL_PROFILER", False)
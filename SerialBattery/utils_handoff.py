@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Handoff of a running driver to a new driver process (restart, upgrade) without detection and warm-up.
+# If HANDOFF is enabled, each driver listens on /run/dbus-serialbattery/handoff_<port>.sock. A new driver for the
+# same port connects to this socket before the battery detection and receives:
+#   - the open CAN socket file descriptors of all batteries (SCM_RIGHTS)
+#   - the decoded state of each battery as state record (bms/deye_can_state.py) and the data for the adoption
+# The new driver creates the batteries with the received sockets and state and sets up all dbus services and
+# settings with a deferred name registration (see defer_registration()). Then it asks the old driver to release
+# its dbus service names. The old driver stops publishing, releases the names, flushes and closes the outputs of
+# the decoded values (journal, archive, balancing counters, MQTT), confirms and exits. The new driver opens the
+# outputs and registers the dbus service names only after the confirmation, so the files are never written by both
+# drivers and the gap is only the time for the name registration instead of the complete detection.
+# If the setup of the new driver fails, the handoff is closed without release and the old driver keeps running.
+# The deferred registration needs a velib_python, whose VeDbusService registers its name with register().
+#
+# Usage: start the new driver with the same arguments while the old driver is running, e.g. from an install script.
+# Only batteries supporting the handoff (get_handoff/adopt_handoff, e.g. DEYE CAN without ingestion process) can be
+# handed over, otherwise the new driver falls back to the normal detection.
+#
+# By asmcc@github
+
+from gi.repository import GLib
+from utils import logger
+import array
+import base64
+import json
+import os
+import socket
+import struct
+import sys
+
+HANDOFF_DIR = "/run/dbus-serialbattery"
+HANDOFF_VERSION = 2  # increase with LAYOUT_VERSION of bms/deye_can_state.py, the handoff contains a state record
+HANDOFF_TIMEOUT = 5  # seconds
+MAX_FDS = 64
+LENGTH = struct.Struct("<I")
+RELEASE = b"R"
+RELEASED = b"K"
+
+
+def handoff_path(port: str) -> str:
+    return os.path.join(HANDOFF_DIR, "handoff_" + port.replace("/", "_").replace(",", "_") + ".sock")
+
+
+def registration_deferrable() -> bool:
+    # the VeDbusService of the velib_python in use registers its name with register() and not in the constructor
+    vedbus = sys.modules.get("vedbus")
+    return vedbus is not None and callable(getattr(vedbus.VeDbusService, "register", None))
+
+
+def defer_registration(service) -> None:
+    """
+    Suppress the registration of the dbus service name by DbusHelper.setup_vedbus() until register_deferred().
+
+    :param service: VeDbusService of a DbusHelper
+    :return: None
+    """
+    service.register = lambda: None
+
+
+def register_deferred(service) -> None:
+    """
+    Register the dbus service name, whose registration was deferred with defer_registration().
+
+    :param service: VeDbusService of a DbusHelper
+    :return: None
+    """
+    del service.register
+    service.register()
+
+
+def _recv_exactly(sock, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("handoff connection closed")
+        data += chunk
+    return data
+
+
+def _encode_key(key):
+    # keys are addresses or (port, address) tuples in multi-port mode
+    return list(key) if isinstance(key, tuple) else key
+
+
+def _decode_key(key):
+    return tuple(key) if isinstance(key, list) else key
+
+
+class Handoff:
+    """
+    Handoff received from the old driver on the side of the new driver.
+    """
+
+    def __init__(self, sock, message: dict, fds: list):
+        self.sock = sock
+        self.message = message
+        self.fds = fds
+
+    def create_batteries(self, get_bms_class) -> dict:
+        """
+        Create the batteries with the received CAN sockets and states.
+
+        :param get_bms_class: Function returning the BMS class for a class name (bms_registry.get_bms_class)
+        :return: Dictionary key -> battery object, None if a battery could not be adopted
+        """
+        battery = {}
+        for entry in self.message["batteries"]:
+            bms_class = get_bms_class(entry["class"])
+            if bms_class is None or not hasattr(bms_class, "adopt_handoff"):
+                logger.error(f"Handoff of BMS class {entry['class']} not supported")
+                return None
+            address = None if entry["address"] is None else bytes.fromhex(entry["address"])
+            bat = bms_class(port=entry["port"], baud=entry["baud"], address=address)
+            handoff = dict(entry["handoff"])
+            handoff["state"] = base64.b64decode(handoff["state"])
+            fds = {name: self.fds[index] for name, index in handoff["fds"].items()}
+            # the batteries duplicate the received sockets, the received file descriptors are closed by close()
+            if not bat.adopt_handoff(handoff, fds):
+                logger.error(f"Handoff of battery {entry['key']} failed")
+                for adopted in battery.values():
+                    adopted.shutdown_buses()
+                return None
+            battery[_decode_key(entry["key"])] = bat
+        return battery
+
+    def release(self) -> bool:
+        """
+        Ask the old driver to release its dbus service names and to close its outputs and wait for the confirmation.
+
+        :return: True if the old driver released its names
+        """
+        try:
+            self.sock.sendall(RELEASE)
+            released = _recv_exactly(self.sock, 1) == RELEASED
+        except OSError as e:
+            logger.error(f"Error during handoff: {e}")
+            released = False
+        self.close()
+        return released
+
+    def close(self) -> None:
+        # the old driver keeps running, if the connection is closed before release()
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+        self.sock.close()
+
+
+def receive_handoff(port: str):
+    """
+    Connect to a running driver for the same port and receive its batteries.
+
+    :param port: Port argument of the driver
+    :return: Handoff or None, if no driver is running or the handoff is not possible
+    """
+    path = handoff_path(port)
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(HANDOFF_TIMEOUT)
+    fds = []
+    try:
+        sock.connect(path)
+        data, ancdata, flags, address = sock.recvmsg(LENGTH.size, socket.CMSG_SPACE(MAX_FDS * array.array("i").itemsize))
+        for level, type, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                fd_array = array.array("i")
+                fd_array.frombytes(cmsg_data[: len(cmsg_data) - (len(cmsg_data) % fd_array.itemsize)])
+                fds.extend(fd_array)
+        data += _recv_exactly(sock, LENGTH.size - len(data))
+        message = json.loads(_recv_exactly(sock, LENGTH.unpack(data)[0]))
+    except (OSError, ValueError) as e:
+        logger.info(f"No handoff from a running driver: {e}")
+        for fd in fds:
+            os.close(fd)
+        sock.close()
+        return None
+    if message.get("version") != HANDOFF_VERSION or "error" in message:
+        logger.info(f"No handoff from the running driver: {message.get('error', 'unsupported version')}")
+        for fd in fds:
+            os.close(fd)
+        sock.close()
+        return None
+    logger.info(f"Received handoff of {len(message['batteries'])} batteries and {len(fds)} sockets from pid {message['pid']}")
+    return Handoff(sock, message, fds)
+
+
+class HandoffServer:
+    """
+    Offers the batteries of this driver to a new driver process.
+    """
+
+    def __init__(self, port: str, battery: dict, release):
+        """
+        :param port: Port argument of the driver
+        :param battery: Dictionary key -> battery object
+        :param release: Function, which stops the publishing, releases the dbus service names, closes the outputs
+                        and stops the driver
+        """
+        self.path = handoff_path(port)
+        self.battery = battery
+        self.release = release
+        self.sock = None
+        self.watch = None
+
+    def start(self) -> bool:
+        try:
+            os.makedirs(HANDOFF_DIR, exist_ok=True)
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(self.path)
+            self.sock.listen(1)
+        except OSError as e:
+            logger.error(f"Error while creating handoff socket {self.path}: {e}")
+            return False
+        self.watch = GLib.io_add_watch(self.sock.fileno(), GLib.IO_IN, self._on_connection)
+        logger.debug(f"Waiting for handoff requests on {self.path}")
+        return True
+
+    def stop(self) -> None:
+        if self.watch is not None:
+            GLib.source_remove(self.watch)
+            self.watch = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _message(self):
+        # collect the handoff of all batteries, an error if one battery does not support it
+        batteries = []
+        fds = []
+        for key, bat in self.battery.items():
+            handoff = bat.get_handoff() if hasattr(bat, "get_handoff") else None
+            if handoff is None:
+                return {"version": HANDOFF_VERSION, "error": f"battery {key} ({bat.__class__.__name__}) does not support the handoff"}, []
+            fd_index = {}
+            for name, fd in handoff["fds"].items():
+                fd_index[name] = len(fds)
+                fds.append(fd)
+            batteries.append(
+                {
+                    "key": _encode_key(key),
+                    "class": bat.__class__.__name__,
+                    "port": bat.port,
+                    "baud": bat.baud_rate,
+                    "address": None if bat.address is None else bytes(bat.address).hex(),
+                    "handoff": dict(handoff, fds=fd_index, state=base64.b64encode(handoff["state"]).decode("ascii")),
+                }
+            )
+        return {"version": HANDOFF_VERSION, "pid": os.getpid(), "batteries": batteries}, fds
+
+    def _on_connection(self, source, condition) -> bool:
+        try:
+            conn, _ = self.sock.accept()
+        except OSError:
+            return True
+        with conn:
+            conn.settimeout(HANDOFF_TIMEOUT)
+            try:
+                message, fds = self._message()
+                payload = json.dumps(message).encode("utf-8")
+                ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))] if len(fds) > 0 else []
+                conn.sendmsg([LENGTH.pack(len(payload))], ancdata)
+                conn.sendall(payload)
+                if "error" in message:
+                    logger.warning(f"Handoff request refused: {message['error']}")
+                    return True
+                logger.info(f"Handoff of {len(fds)} sockets to a new driver, waiting for the release request")
+                if _recv_exactly(conn, 1) != RELEASE:
+                    return True
+            except (OSError, ConnectionError) as e:
+                logger.warning(f"Handoff aborted, continue: {e}")
+                return True
+            # the new driver binds its own handoff socket after the release
+            self.stop()
+            self.release()
+            try:
+                conn.sendall(RELEASED)
+            except OSError:
+                pass
+        logger.info("Handoff completed, the new driver took over")
+        return False
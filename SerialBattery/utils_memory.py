@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Memory monitor of the driver process, for devices with little RAM and months of uptime.
+# If MEMORY_MONITOR is enabled, the memory is sampled after each poll cycle:
+#   - RSS of the process from /proc/self/statm and the trend over the last samples (linear regression)
+#   - net number of allocated Python memory blocks per poll cycle (sys.getallocatedblocks())
+#   - with MEMORY_MONITOR_TRACEMALLOC: the peak of the traced memory within each poll cycle, which shows the
+#     temporary allocations of a cycle (Python 3.9 and later, tracemalloc.reset_peak() is needed to measure a cycle).
+#     tracemalloc costs CPU and memory, so it is disabled by default
+# The values are published on dbus:
+#   /Memory/Rss               RSS in kB
+#   /Memory/RssTrend          RSS trend in kB per hour
+#   /Memory/BlocksPerCycle    mean net change of the allocated blocks per poll cycle
+#   /Memory/PeakPerCycle      mean peak of the traced memory within a poll cycle in kB (tracemalloc and Python 3.9+ only)
+#
+# After the warm-up the RSS and a tracemalloc snapshot are taken as baseline. If the RSS grew by more than
+# MEMORY_BUDGET kB over the baseline, a warning is logged at most once per MEMORY_MONITOR_LOG_INTERVAL seconds.
+# With tracemalloc the warning contains the call sites with the largest growth since the baseline, e.g.:
+#   Memory budget exceeded: RSS 31240 kB, +5120 kB since start, trend +210 kB/h. Top growth:
+#     bms/deye_can.py:1012: +1536 kB (+12288 blocks)
+#
+# By asmcc@github
+
+from collections import deque
+from time import monotonic
+from utils import logger
+import os
+import sys
+import tracemalloc
+
+SAMPLES = 720            # number of samples for the trend and the means
+WARMUP_CYCLES = 60       # poll cycles before the baseline is taken (imports, caches, connection setup)
+
+
+def read_rss() -> int:
+    """
+    :return: Resident set size of the process in kB, 0 if unknown
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def trend(samples) -> float:
+    """
+    Slope of the linear regression of (time, value) samples.
+
+    :param samples: Sequence of tuples (time in seconds, value)
+    :return: Change of the value per second, 0 with less than two samples
+    """
+    count = len(samples)
+    if count < 2:
+        return 0.0
+    mean_time = sum(sample[0] for sample in samples) / count
+    mean_value = sum(sample[1] for sample in samples) / count
+    variance = sum((sample[0] - mean_time) ** 2 for sample in samples)
+    if variance == 0:
+        return 0.0
+    return sum((sample[0] - mean_time) * (sample[1] - mean_value) for sample in samples) / variance
+
+
+class MemoryMonitor:
+    """
+    Samples the memory of the driver process after each poll cycle.
+    """
+
+    PATH_RSS = "/Memory/Rss"
+    PATH_RSS_TREND = "/Memory/RssTrend"
+    PATH_BLOCKS = "/Memory/BlocksPerCycle"
+    PATH_PEAK = "/Memory/PeakPerCycle"
+
+    def __init__(self, service=None, budget: int = 4096, log_interval: float = 3600, trace: bool = False, frames: int = 1, top: int = 10):
+        """
+        :param service: VeDbusService to publish the values, None to disable
+        :param budget: Allowed growth of the RSS over the baseline in kB
+        :param log_interval: Minimal interval in seconds between two warnings about the exceeded budget
+        :param trace: Trace the allocations with tracemalloc to find the call sites of the growth
+        :param frames: Number of frames stored by tracemalloc for each allocation
+        :param top: Number of logged call sites
+        """
+        self.service = service
+        self.budget = budget
+        self.log_interval = log_interval
+        self.trace = trace
+        self.top = top
+        self.cycles = 0
+        self.rss = deque(maxlen=SAMPLES)
+        self.blocks = deque(maxlen=SAMPLES)
+        self.peaks = deque(maxlen=SAMPLES)
+        self.last_blocks = sys.getallocatedblocks()
+        self.baseline_rss = None
+        self.baseline_snapshot = None
+        self.last_log = None
+        # the peak within a cycle needs tracemalloc.reset_peak() of Python 3.9, older versions only keep the overall peak
+        self.trace_peak = self.trace and hasattr(tracemalloc, "reset_peak")
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        if self.trace_peak:
+            self.last_traced = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        if self.service is not None:
+            self.service.add_path(self.PATH_RSS, None)
+            self.service.add_path(self.PATH_RSS_TREND, None)
+            self.service.add_path(self.PATH_BLOCKS, None)
+            self.service.add_path(self.PATH_PEAK, None)
+
+    def sample(self) -> None:
+        """
+        Sample the memory at the end of a poll cycle.
+
+        :return: None
+        """
+        now = monotonic()
+        rss = read_rss()
+        blocks = sys.getallocatedblocks()
+        self.cycles += 1
+        self.rss.append((now, rss))
+        self.blocks.append(blocks - self.last_blocks)
+        self.last_blocks = blocks
+        if self.trace_peak:
+            traced, peak = tracemalloc.get_traced_memory()
+            self.peaks.append(max(0, peak - self.last_traced))
+            self.last_traced = traced
+            tracemalloc.reset_peak()
+
+        if self.cycles == WARMUP_CYCLES:
+            self.baseline_rss = rss
+            if self.trace:
+                self.baseline_snapshot = self.snapshot()
+            logger.info(f"Memory monitor baseline: RSS {rss} kB")
+
+        rss_trend = trend(self.rss) * 3600
+        if self.service is not None:
+            self.service[self.PATH_RSS] = rss
+            self.service[self.PATH_RSS_TREND] = round(rss_trend)
+            self.service[self.PATH_BLOCKS] = round(sum(self.blocks) / len(self.blocks), 1)
+            if len(self.peaks) > 0:
+                self.service[self.PATH_PEAK] = round(sum(self.peaks) / len(self.peaks) / 1024, 1)
+
+        if self.baseline_rss is not None and rss - self.baseline_rss > self.budget:
+            if self.last_log is None or now - self.last_log >= self.log_interval:
+                self.last_log = now
+                self.log_growth(rss, rss_trend)
+
+    @staticmethod
+    def snapshot():
+        # the allocations of tracemalloc itself are no call sites of the driver
+        return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+    def log_growth(self, rss: int, rss_trend: float) -> None:
+        message = f"Memory budget exceeded: RSS {rss} kB, {rss - self.baseline_rss:+d} kB since start, trend {rss_trend:+.0f} kB/h."
+        if self.baseline_snapshot is None:
+            logger.warning(message + " Enable MEMORY_MONITOR_TRACEMALLOC to find the call sites of the growth")
+            return
+        statistics = self.snapshot().compare_to(self.baseline_snapshot, "lineno")
+        growth = [statistic for statistic in statistics if statistic.size_diff > 0][: self.top]
+        logger.warning(
+            message
+            + " Top growth:\n"
+            + "\n".join(f"  {statistic.traceback[0].filename}:{statistic.traceback[0].lineno}: {statistic.size_diff / 1024:+.1f} kB ({statistic.count_diff:+d} blocks)" for statistic in growth)
+        )
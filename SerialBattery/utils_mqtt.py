@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# MQTT output of the decoded DEYE CAN values for a local broker (e.g. FlashMQ/mosquitto on the GX device).
+# Each value is published on its own retained topic, but only if it changed more than its deadband and
+# at most with the configured rate per topic. After each (re)connect all current values are published once
+# as retained snapshot, additionally as one JSON message on <prefix>/snapshot.
+#
+# Topics: <prefix>/<port>/<field>, e.g. dbus-serialbattery/can0/voltage, dbus-serialbattery/can0/cell_voltages/1
+#
+# The client id contains the topic prefix (with the port), so the writers of several ports do not replace each
+# other on the broker. paho-mqtt 1.x and 2.x are supported. The callbacks run in the network thread of paho, the
+# published values are shared with write() under a lock.
+#
+# By asmcc@github
+
+from bms.deye_can_state import unpack_state
+from time import monotonic
+from utils import logger
+import json
+import math
+import os
+import threading
+
+
+def _is_nan(value) -> bool:
+    return isinstance(value, float) and math.isnan(value)
+
+
+def _failed(rc) -> bool:
+    # paho-mqtt 2.x passes a ReasonCode, 1.x an int
+    return getattr(rc, "is_failure", rc != 0)
+
+
+def parse_deadbands(value: str) -> dict:
+    """
+    Parse deadbands from the config format "field:deadband,field:deadband".
+
+    :param value: String from the config file
+    :return: Dictionary field -> deadband
+    """
+    deadbands = {}
+    for item in value.split(","):
+        if ":" not in item:
+            continue
+        field, deadband = item.split(":", 1)
+        try:
+            deadbands[field.strip()] = float(deadband)
+        except ValueError:
+            logger.error(f"Invalid MQTT deadband: {item}")
+    return deadbands
+
+
+def state_topics(state: dict):
+    """
+    Flatten an unpacked state into (topic suffix, field, value) tuples.
+
+    :param state: Dictionary returned by unpack_state()
+    :return: Generator of (topic suffix, field, value)
+    """
+    for field, value in state.items():
+        if field == "timestamp":
+            continue
+        if field == "cell_voltages":
+            for ii, voltage in enumerate(value):
+                yield field + "/" + str(ii + 1), field, voltage
+        elif isinstance(value, dict):
+            # protection levels and BMS parameters
+            for name, item in value.items():
+                yield field + "/" + name, field, item
+        elif isinstance(value, bytes):
+            yield field, field, value.hex()
+        else:
+            yield field, field, value
+
+
+class MqttStateWriter:
+    """
+    State writer (see Deye_Can.state_writers), which publishes the changed values of a state record over MQTT.
+    The MQTT client is created on the first write, so that the writer also works in the ingestion process.
+    """
+
+    def __init__(self, topic_prefix: str, deadbands: dict, max_rate: float, host: str = "localhost", port: int = 1883, client=None):
+        """
+        :param topic_prefix: Prefix of all topics, e.g. dbus-serialbattery/can0
+        :param deadbands: Minimal change of a value for each field before it is published again
+        :param max_rate: Maximal number of messages per second and topic (0 = no limit)
+        :param host: Host name of the MQTT broker
+        :param port: Port of the MQTT broker
+        :param client: MQTT client with a paho compatible publish() method, created automatically if None
+        """
+        self.topic_prefix = topic_prefix
+        self.deadbands = deadbands
+        self.min_interval = 1 / max_rate if max_rate > 0 else 0
+        self.host = host
+        self.port = port
+        self.client = client
+        self.client_pid = os.getpid() if client is not None else None
+        self.connected = client is not None
+        # topic -> last published value
+        self.published = {}
+        # topic -> time of the last publishing
+        self.published_time = {}
+        # topic -> current value, used for the snapshot after a (re)connect
+        self.current = {}
+        # published, published_time and current are shared with the callbacks in the network thread of paho
+        self.lock = threading.Lock()
+        self.own_client = False
+
+    def client_id(self) -> str:
+        # unique for each writer, the broker disconnects an older client with the same id
+        return "dbus-serialbattery-" + self.topic_prefix.replace("/", "-") + "-" + str(os.getpid())
+
+    def _create_client(self) -> None:
+        try:
+            import paho.mqtt.client as mqtt
+        except ImportError:
+            logger.error("MQTT publishing is enabled, but the Python module paho-mqtt is not installed")
+            self.client_pid = os.getpid()
+            return
+        self.connected = False
+        if hasattr(mqtt, "CallbackAPIVersion"):
+            # paho-mqtt >= 2.0
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=self.client_id())
+            self.client.on_connect = lambda client, userdata, flags, rc, properties=None: self.on_connect(client, userdata, flags, rc)
+            self.client.on_disconnect = lambda client, userdata, flags, rc, properties=None: self.on_disconnect(client, userdata, rc)
+        else:
+            self.client = mqtt.Client(client_id=self.client_id())
+            self.client.on_connect = self.on_connect
+            self.client.on_disconnect = self.on_disconnect
+        self.own_client = True
+        self.client.connect_async(self.host, self.port)
+        self.client.loop_start()
+        self.client_pid = os.getpid()
+
+    def close(self) -> None:
+        """
+        Stop the network thread and disconnect the client created by this writer.
+
+        :return: None
+        """
+        if self.own_client and self.client is not None and self.client_pid == os.getpid():
+            self.client.loop_stop()
+            self.client.disconnect()
+        self.client = None
+        self.own_client = False
+        self.connected = False
+
+    def on_connect(self, client, userdata=None, flags=None, rc=0) -> None:
+        """
+        Publish all current values as retained snapshot after a (re)connect.
+        """
+        if _failed(rc):
+            logger.error(f"Connection to MQTT broker {self.host}:{self.port} failed with code {rc}")
+            return
+        logger.info(f"Connected to MQTT broker {self.host}:{self.port}")
+        with self.lock:
+            self.connected = True
+            current = dict(self.current)
+            now = monotonic()
+            for topic, value in current.items():
+                self._publish(topic, value, now)
+        snapshot = {topic[len(self.topic_prefix) + 1:]: None if _is_nan(value) else value for topic, value in current.items()}
+        client.publish(self.topic_prefix + "/snapshot", json.dumps(snapshot), 0, True)
+
+    def on_disconnect(self, client, userdata=None, rc=0) -> None:
+        self.connected = False
+        if _failed(rc):
+            logger.warning(f"Connection to MQTT broker {self.host}:{self.port} lost, reconnecting")
+
+    def _changed(self, field: str, topic: str, value) -> bool:
+        if topic not in self.published:
+            return True
+        last = self.published[topic]
+        if isinstance(value, float) and isinstance(last, float):
+            if math.isnan(value) or math.isnan(last):
+                return math.isnan(value) != math.isnan(last)
+            return abs(value - last) > self.deadbands.get(field, 0)
+        return value != last
+
+    def _publish(self, topic: str, value, now: float) -> None:
+        payload = "null" if value is None or _is_nan(value) else str(value)
+        self.client.publish(topic, payload, 0, True)
+        self.published[topic] = value
+        self.published_time[topic] = now
+
+    def write(self, record: bytes) -> None:
+        """
+        Publish the values of a state record, which changed more than their deadband.
+        Values blocked by the rate limit are compared again with the next record.
+
+        :param record: State record as bytes
+        :return: None
+        """
+        if self.client_pid != os.getpid():
+            self._create_client()
+        if self.client is None:
+            return
+        now = monotonic()
+        with self.lock:
+            for suffix, field, value in state_topics(unpack_state(record)):
+                topic = self.topic_prefix + "/" + suffix
+                self.current[topic] = value
+                if not self.connected or not self._changed(field, topic, value):
+                    continue
+                if now - self.published_time.get(topic, 0) < self.min_interval:
+                    continue
+                self._publish(topic, value, now)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Readiness check of a serial port before the BMS detection. On Venus OS the serial-starter probes other
+# services (e.g. VE.Direct, GPS) on a new port before dbus-serialbattery is started, so the port can
+# still be open in another process or not yet be configurable. Instead of a fixed delay the port is
+# checked until it exists, can be opened and configured and no other process holds it open.
+#
+# By asmcc@github
+
+from utils import logger
+from time import monotonic, sleep
+import os
+import termios
+
+
+def _open_by_other_process(device: str) -> bool:
+    # look for file descriptors of other processes pointing to the device
+    own_pid = str(os.getpid())
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit() or pid == own_pid:
+            continue
+        fd_dir = f"/proc/{pid}/fd"
+        try:
+            for fd in os.listdir(fd_dir):
+                if os.path.realpath(os.path.join(fd_dir, fd)) == device:
+                    return True
+        except OSError:
+            # process ended or no permission
+            continue
+    return False
+
+
+def serial_port_ready(port: str) -> bool:
+    """
+    Check if a serial port can be used for the BMS detection.
+
+    :param port: The serial port, e.g. /dev/ttyUSB0
+    :return: True if the port exists, can be opened and configured and is not open in another process
+    """
+    device = os.path.realpath(port)
+    if not os.path.exists(device):
+        return False
+    try:
+        fd = os.open(device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    except OSError:
+        return False
+    try:
+        termios.tcgetattr(fd)
+    except termios.error:
+        return False
+    finally:
+        os.close(fd)
+    return not _open_by_other_process(device)
+
+
+def wait_for_serial_port(port: str, timeout: float = 16, interval: float = 0.25) -> bool:
+    """
+    Wait until a serial port is ready for the BMS detection.
+
+    :param port: The serial port, e.g. /dev/ttyUSB0
+    :param timeout: Maximal waiting time in seconds
+    :param interval: Interval between two checks in seconds
+    :return: True if the port is ready, False if the timeout elapsed
+    """
+    start = monotonic()
+    while True:
+        if serial_port_ready(port):
+            logger.info(f"Serial port {port} ready after {monotonic() - start:.2f} s")
+            return True
+        if monotonic() - start >= timeout:
+            logger.warning(f"Serial port {port} not ready after {timeout:.0f} s, continue anyway")
+            return False
+        sleep(interval)
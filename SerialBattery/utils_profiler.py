@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Profiling of the running driver, controlled by a signal if SIGNAL_PROFILER is enabled:
+#   kill -USR1 <pid of dbus-serialbattery.py>    start profiling
+#   kill -USR1 <pid of dbus-serialbattery.py>    stop profiling and write the profile
+#
+# While profiling is active, the main thread (GLib main loop, dbus publishing) is profiled with cProfile and
+# all threads (main loop, CanReceiverThreads, concurrent refresh threads) are sampled with sys._current_frames().
+# The signal is forwarded to the child processes (e.g. the DEYE CAN ingestion process), which write their own profiles.
+# Written files in /data/log:
+#   dbus-serialbattery_profile_<pid>_<timestamp>.pstats      cProfile statistics, e.g. python3 -m pstats <file>
+#   dbus-serialbattery_profile_<pid>_<timestamp>.collapsed   collapsed stacks of the sampler, e.g. for flamegraph.pl
+#
+# While profiling is off, only the signal handler is installed, so there are no costs.
+# The signal handler only requests the start or stop. The profiling is started or stopped on the GLib main loop of
+# the driver (like the config reload with SIGHUP) and after the current poll in the ingestion process, so no file
+# I/O and no thread join happen within the signal handler.
+#
+# By asmcc@github
+
+from collections import Counter
+from datetime import datetime
+from utils import logger
+import cProfile
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+
+PROFILE_DIR = "/data/log"
+SAMPLE_INTERVAL = 0.01  # sampling interval in seconds
+
+
+class SignalProfiler:
+    """
+    Starts and stops the profiling with each received signal.
+    """
+
+    def __init__(self, directory: str = PROFILE_DIR, sample_interval: float = SAMPLE_INTERVAL):
+        self.directory = directory
+        self.sample_interval = sample_interval
+        self.profile = None
+        self.sampler = None
+        self.stop_event = None
+        self.stacks = Counter()
+        self.start_time = None
+        self.signum = signal.SIGUSR1
+        self.requested = False
+
+    def install(self, signum: int = signal.SIGUSR1, schedule=None) -> None:
+        """
+        Install the signal handler. Must be called from the main thread.
+
+        :param signum: Signal used to start and stop the profiling
+        :param schedule: Function to run toggle() outside of the signal handler (e.g. GLib.idle_add),
+                         if None toggle() is run by the next call of poll()
+        :return: None
+        """
+        self.signum = signum
+        if schedule is None:
+            signal.signal(signum, lambda sig, frame: setattr(self, "requested", True))
+        else:
+            signal.signal(signum, lambda sig, frame: schedule(self.toggle))
+
+    def poll(self) -> None:
+        """
+        Start or stop the profiling, if requested by the signal since the last call.
+
+        :return: None
+        """
+        if self.requested:
+            self.requested = False
+            self.toggle()
+
+    def toggle(self) -> bool:
+        """
+        Start the profiling if it is off, stop it otherwise.
+
+        :return: False, so it runs only once as idle callback
+        """
+        # forward the signal to the child processes, each of them profiles itself
+        for child in multiprocessing.active_children():
+            try:
+                os.kill(child.pid, self.signum)
+            except OSError:
+                pass
+        if self.profile is None:
+            self.start()
+        else:
+            self.stop()
+        return False
+
+    def start(self) -> None:
+        """
+        Start the profiling of the calling thread and the sampling of all threads.
+
+        :return: None
+        """
+        self.stacks = Counter()
+        self.start_time = datetime.now()
+        self.stop_event = threading.Event()
+        self.sampler = threading.Thread(target=self._sample, name="profiler-sampler", daemon=True)
+        self.sampler.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        logger.info(f"Profiling started in process {os.getpid()}")
+
+    def stop(self) -> None:
+        """
+        Stop the profiling and write the profile files.
+
+        :return: None
+        """
+        self.profile.disable()
+        self.stop_event.set()
+        self.sampler.join()
+        profile, self.profile = self.profile, None
+        duration = (datetime.now() - self.start_time).total_seconds()
+
+        directory = self.directory if os.path.isdir(self.directory) else "/tmp"
+        path = os.path.join(directory, f"dbus-serialbattery_profile_{os.getpid()}_{self.start_time.strftime('%Y%m%d_%H%M%S')}")
+        try:
+            profile.dump_stats(path + ".pstats")
+            with open(path + ".collapsed", "w") as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write(f"{stack} {count}\n")
+            logger.info(f"Profiling stopped after {duration:.1f} s, written {path}.pstats and {path}.collapsed")
+        except OSError as e:
+            logger.error(f"Error while writing the profile: {e}")
+
+    def _sample(self) -> None:
+        names = {}
+        own_ident = threading.get_ident()
+        while not self.stop_event.wait(self.sample_interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
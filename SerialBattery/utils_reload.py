@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Reload of config.ini without a restart of the driver:
+#   kill -HUP <pid of dbus-serialbattery.py>
+#
+# The config files are read again and compared with the settings in use. Changed settings, which are safe to change
+# while the driver is running (LIVE_SETTINGS), are parsed and replaced in all modules of the driver, which imported
+# them, so the batteries use them with the next poll. Settings with a side effect (logging level, poll intervals)
+# are additionally applied through the appliers of the main script. All other changed settings are logged as
+# settings that need a restart, e.g.:
+#   Config reloaded, applied: POLL_INTERVAL, SOC_LOW_WARNING
+#   Config reloaded, restart required for: BMS_TYPE, MAX_BATTERY_CHARGE_CURRENT
+#
+# Only settings, which are read from the module globals on each use, are live. Settings, which are copied at the
+# setup, need a restart, because replacing the globals does not change the copies, e.g.:
+#   MAX_BATTERY_CHARGE_CURRENT, MAX_BATTERY_DISCHARGE_CURRENT    copied into the battery by get_settings()
+#   TEMPERATURE_1_NAME ... TEMPERATURE_4_NAME                     copied into the dbus paths by setup_vedbus()
+#
+# By asmcc@github
+
+from configparser import ConfigParser
+from utils import config, logger
+import logging
+import os
+import sys
+
+
+def _bool(value: str) -> bool:
+    if value.lower() not in ConfigParser.BOOLEAN_STATES:
+        raise ValueError(f"not a boolean: {value}")
+    return ConfigParser.BOOLEAN_STATES[value.lower()]
+
+
+def _poll_interval(value: str):
+    # POLL_INTERVAL is configured in seconds and used in milliseconds, empty for the default of the BMS
+    return float(value) * 1000 if value != "" else None
+
+
+# settings, which can be changed while the driver is running: name -> (parser, default if missing in the config files)
+# settings copied at the setup must not be added, see NOTES
+LIVE_SETTINGS = {
+    "LOGGING": (str.upper, "INFO"),
+    "POLL_INTERVAL": (_poll_interval, None),
+    "SOC_LOW_WARNING": (float, None),
+    "SOC_LOW_ALARM": (float, None),
+    "LINEAR_LIMITATION_ENABLE": (_bool, None),
+    "CCCM_CV_ENABLE": (_bool, None),
+    "DCCM_CV_ENABLE": (_bool, None),
+    "CCCM_T_ENABLE": (_bool, None),
+    "DCCM_T_ENABLE": (_bool, None),
+    "CCCM_SOC_ENABLE": (_bool, None),
+    "DCCM_SOC_ENABLE": (_bool, None),
+    "POLL_INTERVAL_MIN": (int, 0),
+    "POLL_INTERVAL_MAX": (int, 60000),
+    "DATA_AGE_LOG_INTERVAL": (float, 60),
+}
+
+
+def set_logging_level(level: str) -> None:
+    logger.setLevel(getattr(logging, level, logging.INFO))
+
+
+def read_config_files() -> ConfigParser:
+    # the same files as read by utils.py
+    path = os.path.dirname(os.path.abspath(sys.modules["utils"].__file__))
+    new_config = ConfigParser()
+    new_config.read([os.path.join(path, "config.default.ini"), os.path.join(path, "config.ini")])
+    return new_config
+
+
+def replace_setting(name: str, value) -> int:
+    """
+    Replace a setting in all modules of the driver, which bound it with "from utils import ...".
+
+    :param name: Name of the setting
+    :param value: New value
+    :return: Number of modules, in which the setting was replaced
+    """
+    base = os.path.dirname(os.path.abspath(sys.modules["utils"].__file__))
+    replaced = 0
+    for module in list(sys.modules.values()):
+        file = getattr(module, "__file__", None)
+        if file is None or not os.path.abspath(file).startswith(base) or name not in module.__dict__:
+            continue
+        setattr(module, name, value)
+        replaced += 1
+    return replaced
+
+
+def reload_config(appliers: dict = None):
+    """
+    Read the config files again and apply the changed settings, which are safe to change while running.
+
+    :param appliers: Dictionary setting name -> function called with the new value for settings with a side effect
+    :return: Tuple (list of applied settings, list of changed settings, which need a restart)
+    """
+    appliers = {} if appliers is None else appliers
+    new_config = read_config_files()
+    old = dict(config["DEFAULT"])
+    new = dict(new_config["DEFAULT"])
+    changed = sorted(option.upper() for option in set(old) | set(new) if old.get(option) != new.get(option))
+
+    applied = []
+    restart = []
+    invalid = []
+    for name in changed:
+        if name not in LIVE_SETTINGS:
+            restart.append(name)
+            continue
+        parser, default = LIVE_SETTINGS[name]
+        raw = new.get(name.lower())
+        try:
+            if raw is None:
+                if default is None:
+                    raise ValueError("missing in the config files")
+                value = default
+            else:
+                value = parser(raw.strip())
+        except ValueError as e:
+            logger.error(f"Config reload: invalid value for {name}, keep the current value: {e}")
+            invalid.append(name)
+            continue
+        replace_setting(name, value)
+        if name in appliers:
+            appliers[name](value)
+        applied.append(name)
+
+    # update the parsed config with the applied settings, so that the next reload compares with the values in use
+    # settings, which need a restart or are invalid, keep their current value and are reported again
+    keep = set(restart) | set(invalid)
+    for option in set(old) - set(new):
+        if option.upper() not in keep:
+            config.remove_option("DEFAULT", option)
+    config.read_dict({"DEFAULT": {option: value for option, value in new.items() if option.upper() not in keep}})
+
+    if len(applied) > 0:
+        logger.info("Config reloaded, applied: " + ", ".join(applied))
+    if len(restart) > 0:
+        logger.warning("Config reloaded, restart required for: " + ", ".join(restart))
+    if len(changed) == 0:
+        logger.info("Config reloaded, no changed settings")
+    return applied, restart
@@ -0,0 +1,462 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Offline analysis of recorded PCSCAN and INTERCAN traffic of DEYE batteries (candump logs), e.g. months of
+# captures of a stack, without replaying them on a bus.
+#
+# The frames are decoded with the decoders compiled from SerialBattery/bms/deye_can.dbc (see deye_can_dbc.py),
+# which are pure functions of the frame data with the same values as bms/deye_can.py.
+#
+# The capture files are memory-mapped and split into chunks at line boundaries. The chunks are analyzed by a pool
+# of processes (one per core by default) and the aggregates of the chunks are merged in the order of the files.
+# Statistics:
+#   cell drift      spread between the highest and the lowest cell of each pack per day (INTER_HIGH_LOW) and
+#                   how often each cell was the highest or the lowest cell
+#   alarms          number of activations and active time of each alarm bit of the stack (0x359) and the
+#                   master pack (0x110)
+#   IR              internal resistance of the master pack per day, estimated from the voltage change at
+#                   current steps of at least IR_MIN_CURRENT_STEP A between two 0x150 frames
+#   energy          charged and discharged energy from the energy counters (0x550) and integrated from voltage
+#                   and current (0x150)
+# Each chunk keeps its first and last frames of the analyzed messages, so the frame pairs spanning two chunks are
+# accounted when the chunks are merged and the result does not depend on the number of chunks.
+# Only the frames of the analyzed messages are decoded, the others are skipped by their id.
+#
+# Supported formats (uncompressed, with absolute timestamps):
+#   candump -l / -L:    (1760860800.123456) can0 351#E402E803E803D001
+#   candump -ta:        (1760860800.123456)  can0  351   [8]  E4 02 E8 03 E8 03 D0 01
+#
+# Examples:
+#   python3 deye_can_analyze.py candump-2026-*.log
+#   python3 deye_can_analyze.py --jobs 8 --chunk-size 128 --json captures/*.log > statistics.json
+#
+# By asmcc@github
+
+from datetime import datetime, timezone
+from multiprocessing import Pool
+import argparse
+import binascii
+import json
+import mmap
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SerialBattery", "bms"))
+
+from deye_can_dbc import load_decoders  # noqa: E402
+
+DBC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SerialBattery", "bms", "deye_can.dbc")
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__")
+
+PATTERNS = {
+    "log": re.compile(rb"^\((\d+\.\d+)\) +\S+ +([0-9A-Fa-f]{3,8})#([0-9A-Fa-f]*)", re.M),
+    "ascii": re.compile(rb"^ *\((\d+\.\d+)\) +\S+ +([0-9A-Fa-f]{3,8}) +\[\d\] +((?:[0-9A-Fa-f]{2} ?)*)", re.M),
+}
+
+ALARM_MESSAGES = {0x359: "stack", 0x110: "pack"}  # alarm bits of the stack and of the master pack
+ALARM_SIGNALS = ("warning_0", "warning_error_1", "error_2", "error_3", "alarm_4", "alarm_5", "system_error_6")
+HIGH_LOW_ID = 0x2098001       # INTER_HIGH_LOW of pack 1, the low byte of the INTERCAN ids is the pack
+VOLTAGE_CURRENT_ID = 0x150    # BAT_VOLT_CURR_SOC_SOH of the master pack
+ENERGY_ID = 0x550             # BAT_ENERGY of the master pack
+MAX_GAP = 10                  # seconds, longer gaps between two 0x150 frames are not integrated
+IR_MIN_CURRENT_STEP = 5       # A, minimal current step for an IR estimate
+IR_MAX_INTERVAL = 5           # seconds, maximal time between the two frames of an IR estimate
+DAY = 86400
+
+_decoders = None
+
+
+def _init_worker(dbc_path: str, cache_path: str) -> None:
+    # the decoders are compiled only if the DBC file changed, the workers load the cached module
+    global _decoders
+    _decoders = load_decoders(dbc_path, cache_path=cache_path)
+
+
+def _day(day: int) -> str:
+    return datetime.fromtimestamp(day * DAY, timezone.utc).date().isoformat()
+
+
+def _slope(points: list) -> float:
+    # slope of the linear regression of (x, y) points, 0 with less than two points
+    if len(points) < 2:
+        return 0.0
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if variance == 0:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+
+def _alarm_transition(state: dict, mask: int, elapsed: float) -> None:
+    # the time since the last frame is accounted to the bits active in the last frame
+    active = state["last"]
+    while active:
+        bit = (active & -active).bit_length() - 1
+        state["active"][bit] = state["active"].get(bit, 0.0) + elapsed
+        active &= active - 1
+    started = mask & ~state["last"]
+    while started:
+        bit = (started & -started).bit_length() - 1
+        state["activations"][bit] = state["activations"].get(bit, 0) + 1
+        started &= started - 1
+    state["last"] = mask
+
+
+def _voltage_current_pair(statistics: "Statistics", last: tuple, sample: tuple) -> None:
+    # energy and IR estimate of two following 0x150 frames (time, voltage, current)
+    elapsed = sample[0] - last[0]
+    if not 0 < elapsed <= MAX_GAP:
+        return
+    # trapezoidal integration, positive current = charging
+    power = (sample[1] * sample[2] + last[1] * last[2]) / 2
+    ampere = (sample[2] + last[2]) / 2
+    if power >= 0:
+        statistics.energy[0] += power * elapsed / 3600000
+    else:
+        statistics.energy[1] -= power * elapsed / 3600000
+    if ampere >= 0:
+        statistics.energy[2] += ampere * elapsed / 3600
+    else:
+        statistics.energy[3] -= ampere * elapsed / 3600
+    step = sample[2] - last[2]
+    if elapsed <= IR_MAX_INTERVAL and abs(step) >= IR_MIN_CURRENT_STEP:
+        resistance = (sample[1] - last[1]) / step
+        if resistance > 0:
+            ir = statistics.ir.get(int(sample[0] // DAY))
+            if ir is None:
+                ir = statistics.ir[int(sample[0] // DAY)] = [0.0, 0]
+            ir[0] += resistance
+            ir[1] += 1
+
+
+class Statistics:
+    """
+    Mergeable aggregates of a part of the captures.
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.decoded = 0
+        self.first_time = None
+        self.last_time = None
+        self.drift = {}           # pack -> {"days": {day: [sum, count, max]}, "highest": {cell: n}, "lowest": {cell: n}}
+        self.alarms = {}          # source -> {"first": mask, "last": mask, "first_time": s, "last_time": s, "activations": {bit: n}, "active": {bit: s}}
+        self.first_sample = None  # first and last 0x150 frame (time, voltage, current)
+        self.last_sample = None
+        self.ir = {}              # day -> [sum in ohm, count]
+        self.energy_counters = None  # [first charged, first discharged, last charged, last discharged, charged, discharged]
+        self.energy = [0.0, 0.0, 0.0, 0.0]  # charged kWh, discharged kWh, charged Ah, discharged Ah
+
+    def merge(self, other: "Statistics") -> None:
+        """
+        Take over the aggregates of the following part of the captures.
+
+        :param other: Statistics of the part following this one
+        :return: None
+        """
+        self.frames += other.frames
+        self.decoded += other.decoded
+        if self.first_time is None:
+            self.first_time = other.first_time
+        if other.last_time is not None:
+            self.last_time = other.last_time
+
+        for pack, drift in other.drift.items():
+            own = self.drift.setdefault(pack, {"days": {}, "highest": {}, "lowest": {}})
+            for day, (total, count, maximum) in drift["days"].items():
+                values = own["days"].setdefault(day, [0.0, 0, 0.0])
+                values[0] += total
+                values[1] += count
+                values[2] = max(values[2], maximum)
+            for key in ("highest", "lowest"):
+                for cell, count in drift[key].items():
+                    own[key][cell] = own[key].get(cell, 0) + count
+
+        for source, alarms in other.alarms.items():
+            own = self.alarms.get(source)
+            if own is None:
+                self.alarms[source] = alarms
+                continue
+            # transition from the last frame of this part to the first frame of the other part
+            _alarm_transition(own, alarms["first"], min(alarms["first_time"] - own["last_time"], MAX_GAP))
+            for bit, count in alarms["activations"].items():
+                own["activations"][bit] = own["activations"].get(bit, 0) + count
+            for bit, seconds in alarms["active"].items():
+                own["active"][bit] = own["active"].get(bit, 0.0) + seconds
+            own["last"] = alarms["last"]
+            own["last_time"] = alarms["last_time"]
+
+        if self.last_sample is not None and other.first_sample is not None:
+            _voltage_current_pair(self, self.last_sample, other.first_sample)
+        if self.first_sample is None:
+            self.first_sample = other.first_sample
+        if other.last_sample is not None:
+            self.last_sample = other.last_sample
+
+        for day, (total, count) in other.ir.items():
+            values = self.ir.setdefault(day, [0.0, 0])
+            values[0] += total
+            values[1] += count
+
+        if other.energy_counters is not None:
+            if self.energy_counters is None:
+                self.energy_counters = list(other.energy_counters)
+            else:
+                own = self.energy_counters
+                # delta at the boundary, counters going back (reset, other battery) are not counted
+                own[4] += other.energy_counters[4] + max(0.0, other.energy_counters[0] - own[2])
+                own[5] += other.energy_counters[5] + max(0.0, other.energy_counters[1] - own[3])
+                own[2], own[3] = other.energy_counters[2], other.energy_counters[3]
+        self.energy = [own + value for own, value in zip(self.energy, other.energy)]
+
+    def report(self) -> dict:
+        """
+        :return: Statistics as dictionary for the output
+        """
+        duration = 0 if self.first_time is None else self.last_time - self.first_time
+        report = {
+            "frames": self.frames,
+            "decoded": self.decoded,
+            "from": None if self.first_time is None else datetime.fromtimestamp(self.first_time, timezone.utc).isoformat(),
+            "to": None if self.last_time is None else datetime.fromtimestamp(self.last_time, timezone.utc).isoformat(),
+            "days": round(duration / DAY, 2),
+            "cell_drift": {},
+            "alarms": {},
+            "ir": {},
+            "energy": {},
+        }
+        for pack, drift in sorted(self.drift.items()):
+            days = {_day(day): {"mean_spread": round(total / count, 4), "max_spread": round(maximum, 3)} for day, (total, count, maximum) in sorted(drift["days"].items())}
+            points = [(day, total / count) for day, (total, count, _) in drift["days"].items()]
+            report["cell_drift"][pack] = {
+                "spread_trend_mv_per_30_days": round(_slope(points) * 30 * 1000, 2),
+                "highest": {cell: count for cell, count in sorted(drift["highest"].items())},
+                "lowest": {cell: count for cell, count in sorted(drift["lowest"].items())},
+                "days": days,
+            }
+        for source, alarms in sorted(self.alarms.items()):
+            bits = {}
+            for bit in sorted(set(alarms["activations"]) | set(alarms["active"])):
+                activations = alarms["activations"].get(bit, 0)
+                bits[f"{ALARM_SIGNALS[bit // 8]}.{bit % 8}"] = {
+                    "activations": activations,
+                    "per_day": round(activations / (duration / DAY), 3) if duration > 0 else None,
+                    "active_hours": round(alarms["active"].get(bit, 0.0) / 3600, 3),
+                }
+            report["alarms"][source] = bits
+        if len(self.ir) > 0:
+            points = [(day, total / count) for day, (total, count) in self.ir.items()]
+            report["ir"] = {
+                "trend_mohm_per_30_days": round(_slope(points) * 30 * 1000, 3),
+                "days": {_day(day): {"mohm": round(total / count * 1000, 2), "estimates": count} for day, (total, count) in sorted(self.ir.items())},
+            }
+        if self.energy_counters is not None:
+            report["energy"]["counter_charged_kwh"] = round(self.energy_counters[4], 3)
+            report["energy"]["counter_discharged_kwh"] = round(self.energy_counters[5], 3)
+        report["energy"]["integrated_charged_kwh"] = round(self.energy[0], 3)
+        report["energy"]["integrated_discharged_kwh"] = round(self.energy[1], 3)
+        report["energy"]["integrated_charged_ah"] = round(self.energy[2], 2)
+        report["energy"]["integrated_discharged_ah"] = round(self.energy[3], 2)
+        return report
+
+
+def analyze_chunk(chunk: tuple) -> Statistics:
+    """
+    Analyze a chunk of a capture file, executed by the processes of the pool.
+
+    :param chunk: Tuple (path, format, start offset, end offset), the offsets are at line boundaries
+    :return: Statistics of the chunk
+    """
+    path, fmt, start, end = chunk
+    decoders = _decoders.DECODERS
+    lengths = _decoders.MESSAGE_LENGTHS
+    statistics = Statistics()
+    ascii_format = fmt == "ascii"
+    analyzed = {HIGH_LOW_ID, VOLTAGE_CURRENT_ID, ENERGY_ID, *ALARM_MESSAGES}
+    ids = {}                  # id as in the capture -> (arbitration id of the decoder, pack) or None if not analyzed
+    alarms = {}
+    last_sample = None
+    unhexlify = binascii.unhexlify
+    frames = decoded = 0
+    timestamp = first_time = None
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for match in PATTERNS[fmt].finditer(mm, start, end):
+            frames += 1
+            raw_id, raw_data = match.group(2, 3)
+            if raw_id not in ids:
+                arbitration_id = int(raw_id, 16)
+                pack = 0
+                if len(raw_id) > 3:
+                    # INTERCAN: the decoders are compiled for pack 1
+                    pack = arbitration_id & 0xFF
+                    arbitration_id = arbitration_id & ~0xFF | 1
+                ids[raw_id] = (arbitration_id, pack) if arbitration_id in analyzed and arbitration_id in decoders else None
+            if ids[raw_id] is None:
+                continue
+            arbitration_id, pack = ids[raw_id]
+            data = unhexlify(raw_data.replace(b" ", b"") if ascii_format else raw_data)
+            if len(data) < lengths[arbitration_id]:
+                continue
+            values = decoders[arbitration_id](data)
+            decoded += 1
+            timestamp = float(match.group(1))
+            if first_time is None:
+                first_time = timestamp
+
+            if arbitration_id == HIGH_LOW_ID:
+                drift = statistics.drift.get(pack)
+                if drift is None:
+                    drift = statistics.drift[pack] = {"days": {}, "highest": {}, "lowest": {}}
+                spread = values["cell_max_voltage"] - values["cell_min_voltage"]
+                day = drift["days"].get(int(timestamp // DAY))
+                if day is None:
+                    day = drift["days"][int(timestamp // DAY)] = [0.0, 0, 0.0]
+                day[0] += spread
+                day[1] += 1
+                if spread > day[2]:
+                    day[2] = spread
+                drift["highest"][values["cell_max_no"]] = drift["highest"].get(values["cell_max_no"], 0) + 1
+                drift["lowest"][values["cell_min_no"]] = drift["lowest"].get(values["cell_min_no"], 0) + 1
+
+            elif arbitration_id in ALARM_MESSAGES:
+                source = ALARM_MESSAGES[arbitration_id]
+                mask = 0
+                for shift, name in enumerate(ALARM_SIGNALS):
+                    mask |= values[name] << (shift * 8)
+                state = alarms.get(source)
+                if state is None:
+                    alarms[source] = {"first": mask, "last": mask, "first_time": timestamp, "last_time": timestamp, "activations": {}, "active": {}}
+                else:
+                    if mask != state["last"] or state["last"]:
+                        _alarm_transition(state, mask, min(timestamp - state["last_time"], MAX_GAP))
+                    state["last_time"] = timestamp
+
+            elif arbitration_id == VOLTAGE_CURRENT_ID:
+                sample = (timestamp, values["voltage"], values["current"])
+                if last_sample is None:
+                    statistics.first_sample = sample
+                else:
+                    _voltage_current_pair(statistics, last_sample, sample)
+                last_sample = sample
+
+            elif arbitration_id == ENERGY_ID:
+                charged, discharged = values["charged_energy"], values["discharged_energy"]
+                counters = statistics.energy_counters
+                if counters is None:
+                    statistics.energy_counters = [charged, discharged, charged, discharged, 0.0, 0.0]
+                else:
+                    counters[4] += max(0.0, charged - counters[2])
+                    counters[5] += max(0.0, discharged - counters[3])
+                    counters[2], counters[3] = charged, discharged
+
+    statistics.frames = frames
+    statistics.decoded = decoded
+    statistics.first_time = first_time
+    statistics.last_time = timestamp
+    statistics.alarms = alarms
+    statistics.last_sample = last_sample
+    return statistics
+
+
+def detect_format(path: str) -> str:
+    """
+    :param path: Capture file
+    :return: Key of PATTERNS matching the first frames of the file
+    """
+    with open(path, "rb") as f:
+        head = f.read(65536)
+    for fmt, pattern in PATTERNS.items():
+        if pattern.search(head) is not None:
+            return fmt
+    raise ValueError(f"{path}: unknown format, expected candump -l or -ta with absolute timestamps")
+
+
+def split_chunks(path: str, fmt: str, chunk_size: int) -> list:
+    """
+    Split a capture file into chunks ending at line boundaries.
+
+    :param path: Capture file
+    :param fmt: Key of PATTERNS
+    :param chunk_size: Nominal size of a chunk in bytes
+    :return: List of (path, format, start offset, end offset)
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    chunks = []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            end = mm.find(b"\n", min(start + chunk_size, size - 1))
+            end = size if end < 0 else end + 1
+            chunks.append((path, fmt, start, end))
+            start = end
+    return chunks
+
+
+def print_report(report: dict) -> None:
+    print(f"Frames: {report['frames']}, decoded: {report['decoded']}, {report['from']} - {report['to']} ({report['days']} days)")
+    for pack, drift in report["cell_drift"].items():
+        print(f"\nCell drift of pack {pack}: spread trend {drift['spread_trend_mv_per_30_days']:+.2f} mV / 30 days")
+        print("  highest cell: " + ", ".join(f"#{cell} {count}x" for cell, count in sorted(drift["highest"].items(), key=lambda item: -item[1])[:5]))
+        print("  lowest cell:  " + ", ".join(f"#{cell} {count}x" for cell, count in sorted(drift["lowest"].items(), key=lambda item: -item[1])[:5]))
+        for day, values in drift["days"].items():
+            print(f"  {day}  mean {values['mean_spread'] * 1000:6.1f} mV  max {values['max_spread'] * 1000:6.1f} mV")
+    for source, bits in report["alarms"].items():
+        print(f"\nAlarms of the {source}:" + ("" if len(bits) > 0 else " none"))
+        for name, values in bits.items():
+            per_day = "-" if values["per_day"] is None else f"{values['per_day']:.3f}"
+            print(f"  {name:20s} {values['activations']:6d} activations  {per_day:>8s} / day  {values['active_hours']:8.2f} h active")
+    if len(report["ir"]) > 0:
+        print(f"\nInternal resistance: trend {report['ir']['trend_mohm_per_30_days']:+.3f} mOhm / 30 days")
+        for day, values in report["ir"]["days"].items():
+            print(f"  {day}  {values['mohm']:7.2f} mOhm  ({values['estimates']} estimates)")
+    print("\nEnergy:")
+    for name, value in report["energy"].items():
+        print(f"  {name:26s} {value:12.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Statistics of recorded DEYE CAN traffic (candump logs)")
+    parser.add_argument("files", nargs="+", help="candump log files in chronological order")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="number of processes, default number of cores")
+    parser.add_argument("--chunk-size", type=int, default=64, help="size of a chunk in MiB")
+    parser.add_argument("--dbc", default=DBC_PATH, help="DBC file, default SerialBattery/bms/deye_can.dbc")
+    parser.add_argument("--cache", default=CACHE_PATH, help="directory of the compiled decoders, empty: compile in memory, default tools/__pycache__")
+    parser.add_argument("--json", action="store_true", help="output as JSON")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    chunks = []
+    size = 0
+    for path in args.files:
+        chunks.extend(split_chunks(path, detect_format(path), args.chunk_size * 1024 * 1024))
+        size += os.path.getsize(path)
+
+    statistics = Statistics()
+    if args.jobs <= 1:
+        _init_worker(args.dbc, args.cache)
+        for chunk in chunks:
+            statistics.merge(analyze_chunk(chunk))
+    else:
+        with Pool(args.jobs, initializer=_init_worker, initargs=(args.dbc, args.cache)) as pool:
+            # imap keeps the order of the chunks, which is needed to merge the boundaries
+            for result in pool.imap(analyze_chunk, chunks):
+                statistics.merge(result)
+
+    report = statistics.report()
+    elapsed = time.monotonic() - start
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    print(f"Analyzed {size / 1024 / 1024:.1f} MiB in {len(chunks)} chunks in {elapsed:.1f} s ({size / 1024 / 1024 / max(elapsed, 1e-6):.1f} MiB/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
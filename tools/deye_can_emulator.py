@@ -0,0 +1,285 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Emulator of the PCSCAN and INTERCAN traffic of a DEYE battery stack for load and soak tests of
+# bms/deye_can.py without hardware. It generates the frame set decoded by Deye_Can for N packs with
+# M cells on a vcan interface or a python-can virtual bus.
+#
+# Setup of the virtual interfaces:
+#   ip link add dev vcan0 type vcan && ip link set up vcan0
+#   ip link add dev vcan1 type vcan && ip link set up vcan1
+#
+# Examples:
+#   python3 deye_can_emulator.py --pcscan vcan0 --intercan vcan1 --packs 4 --cells 16
+#   python3 deye_can_emulator.py --pcscan vcan0 --intercan vcan1 --rate 10 --scenario scenario.json
+#
+# A scenario is a JSON list of timed events, the time "at" is given in seconds after the start:
+#   [
+#     {"at": 10, "event": "current", "value": -80},              current of each pack in A (positive = charging)
+#     {"at": 20, "event": "alarm", "byte": 4, "bit": 0},         set alarm bit in 0x359 and 0x110
+#     {"at": 30, "event": "clear_alarms"},                       clear all alarm bits
+#     {"at": 40, "event": "intercan_silent", "duration": 150},   no frames on INTERCAN
+#     {"at": 60, "event": "bus_off", "duration": 5},             no frames on both buses
+#     {"at": 70, "event": "balance", "pack": 1, "mask": 5},      balancing bitmask of a pack (bit 0 = cell 1)
+#     {"at": 80, "event": "cell", "pack": 1, "cell": 3, "value": 3.65}
+#   ]
+#
+# By asmcc@github
+
+from struct import pack
+import argparse
+import json
+import random
+import sys
+import time
+
+PCSCAN_PERIOD = 1.0     # transmission period of the PCSCAN frames in seconds
+INTERCAN_PERIOD = 1.0   # transmission period of the INTERCAN frames in seconds
+
+BATTERY_TYPES = {"EVE 100Ah": 3}
+CELL_VOLTAGE_MAX = 65.535  # V, largest cell voltage of the 16 bit INTERCAN fields
+
+
+def saturate(value: float, low: int, high: int) -> int:
+    # round a value into the range of a CAN field instead of raising struct.error
+    return min(high, max(low, round(value)))
+
+
+def int16(value: float) -> int:
+    return saturate(value, -0x8000, 0x7FFF)
+
+
+def uint16(value: float) -> int:
+    return saturate(value, 0, 0xFFFF)
+
+
+class DeyePack:
+    """
+    State of one emulated battery pack.
+    """
+
+    def __init__(self, number: int, cells: int, capacity: float = 100):
+        self.number = number
+        self.cell_voltages = [3.300 + random.uniform(-0.005, 0.005) for _ in range(cells)]
+        self.current = 0.0
+        self.soc = 70
+        self.soh = 100
+        self.capacity = capacity
+        self.temperature = 21.0
+        self.temperature_mos = 24.0
+        self.temperature_heating = 20.0
+        self.balance_mask = 0
+        self.alarms = bytearray(8)
+        self.charge_cycles = 123
+        self.charged_energy = 4567000        # Wh
+        self.discharged_energy = 4321000     # Wh
+        self.serial_number = f"DYEMU{number:011d}"
+
+    @property
+    def voltage(self) -> float:
+        return sum(self.cell_voltages)
+
+    def mode(self) -> int:
+        if self.current > 0.5:
+            return 1  # charging
+        if self.current < -0.5:
+            return 2  # discharging
+        return 0  # idle
+
+    def step(self, dt: float) -> None:
+        # follow the current with SOC, energy counters and cell voltages
+        self.soc = min(100, max(0, self.soc + self.current * dt / 3600 / self.capacity * 100))
+        energy = abs(self.current * self.voltage * dt / 3600)
+        if self.current > 0:
+            self.charged_energy += energy
+        else:
+            self.discharged_energy += energy
+        for ii in range(len(self.cell_voltages)):
+            voltage = self.cell_voltages[ii] + self.current * dt * 0.000002 + random.uniform(-0.0005, 0.0005)
+            # a sustained current must not drive the voltages out of the range of the frames
+            self.cell_voltages[ii] = min(CELL_VOLTAGE_MAX, max(0.0, voltage))
+
+
+class DeyeStackEmulator:
+    """
+    Generator of the CAN frames of a DEYE battery stack.
+    frames() returns (bus, arbitration_id, is_extended_id, data) tuples, bus is "pcscan" or "intercan".
+    """
+
+    def __init__(self, packs: int = 1, cells: int = 16, rate: float = 1.0, scenario: list = None):
+        self.packs = [DeyePack(number + 1, cells) for number in range(packs)]
+        self.rate = rate
+        self.scenario = sorted(scenario or [], key=lambda event: event["at"])
+        self.start = None
+        self.last_step = None
+        self.intercan_silent_until = 0
+        self.bus_off_until = 0
+
+    # --------- PCSCAN frames, aggregated values of the master pack ---------
+
+    def pcscan_frames(self):
+        master = self.packs[0]
+        voltage = sum(p.voltage for p in self.packs) / len(self.packs)
+        current = sum(p.current for p in self.packs)
+        cells = [v for p in self.packs for v in p.cell_voltages]
+        alarms = bytearray(8)
+        for p in self.packs:
+            alarms = bytearray(a | b for a, b in zip(alarms, p.alarms))
+        yield 0x351, pack("<HhhH", 576, int16(100 * len(self.packs) * 10), int16(100 * len(self.packs) * 10), 464)
+        yield 0x355, pack("<HH4x", saturate(sum(p.soc for p in self.packs) / len(self.packs), 0, 100), master.soh)
+        yield 0x356, pack("<hhh2x", int16(voltage * 100), int16(-current * 10), int16(master.temperature * 10))
+        yield 0x359, bytes(alarms)
+        yield 0x35C, pack("<B7x", 0xC0)
+        yield 0x35E, b"DY001" + pack("<BH", BATTERY_TYPES["EVE 100Ah"], uint16(sum(p.capacity for p in self.packs) * 10))
+        yield 0x361, pack("<HHhh", uint16(max(cells) * 1000), uint16(min(cells) * 1000), round((master.temperature + 1) * 10), round((master.temperature - 1) * 10))
+        yield 0x363, bytes([0x01, 0x17, 0x01, 0x00, 0, 0, 0, 0])
+        yield 0x364, bytes([len(self.packs), 0, 0, 0, len(self.packs), 0, 0, 0])
+        # individual values of the master pack
+        yield 0x110, bytes(master.alarms[:7]) + bytes([0x18 if master.mode() else 0x00])
+        yield 0x150, pack("<HhHH", uint16(master.voltage * 100), int16(master.current * 10), saturate(master.soc, 0, 100), master.soh)
+        yield 0x200, pack("<HHhh", uint16(max(master.cell_voltages) * 1000), uint16(min(master.cell_voltages) * 1000), round((master.temperature + 1) * 10), round((master.temperature - 1) * 10))
+        yield 0x250, pack("<hhHH", round(master.temperature_mos * 10), round(master.temperature_heating * 10), 1000, 1000)
+        yield 0x400, pack("<BBH", master.mode(), 0, master.charge_cycles) + pack(">H", master.balance_mask) + pack("<B1x", 0)
+        yield 0x500, bytes([0x21, 0x08, 0xAA]) + b"B1.05"
+        yield 0x550, pack("<LL", round(master.charged_energy), round(master.discharged_energy))
+        yield 0x600, master.serial_number[:8].encode("ascii")
+        yield 0x650, master.serial_number[8:16].encode("ascii")
+        yield 0x700, pack("<HHHH", 2, 1, 0, 0)
+        yield 0x750, pack("<HHHH", 0, 0, 0, 0)
+
+    # --------- INTERCAN frames, one set for each pack ---------
+
+    def intercan_frames(self, p: DeyePack):
+        voltages = p.cell_voltages
+        max_no = voltages.index(max(voltages)) + 1
+        min_no = voltages.index(min(voltages)) + 1
+        yield 0x2098000 + p.number, pack(">HBHB2x", uint16(max(voltages) * 1000), max_no, uint16(min(voltages) * 1000), min_no)
+        for group in range((len(voltages) + 3) // 4):
+            values = [uint16(v * 1000) for v in voltages[group * 4:group * 4 + 4]]
+            values += [0] * (4 - len(values))
+            yield 0x4008000 + (group << 16) + p.number, pack(">HHHH", *values)
+
+    # --------- scenario ---------
+
+    def apply_event(self, event: dict, now: float) -> None:
+        name = event["event"]
+        packs = self.packs if "pack" not in event else [self.packs[event["pack"] - 1]]
+        if name == "current":
+            for p in packs:
+                p.current = float(event["value"])
+        elif name == "alarm":
+            for p in packs:
+                p.alarms[event["byte"]] |= 1 << event["bit"]
+        elif name == "clear_alarms":
+            for p in packs:
+                p.alarms = bytearray(8)
+        elif name == "intercan_silent":
+            self.intercan_silent_until = now + event["duration"]
+        elif name == "bus_off":
+            self.bus_off_until = now + event["duration"]
+        elif name == "balance":
+            for p in packs:
+                p.balance_mask = event["mask"]
+        elif name == "cell":
+            for p in packs:
+                p.cell_voltages[event["cell"] - 1] = float(event["value"])
+        else:
+            raise ValueError(f"Unknown scenario event {name}")
+        print(f"{now:8.1f} s: {json.dumps(event)}", file=sys.stderr)
+
+    def frames(self, now: float):
+        """
+        Frames of one transmission period at the time now (seconds since the start).
+
+        :param now: Time in seconds since the start of the emulation
+        :return: Generator of (bus, arbitration_id, is_extended_id, data)
+        """
+        if self.last_step is not None:
+            for p in self.packs:
+                p.step(now - self.last_step)
+        self.last_step = now
+        while len(self.scenario) > 0 and self.scenario[0]["at"] <= now:
+            self.apply_event(self.scenario.pop(0), now)
+        if now < self.bus_off_until:
+            return
+        for arbitration_id, data in self.pcscan_frames():
+            yield "pcscan", arbitration_id, False, data
+        if now < self.intercan_silent_until:
+            return
+        for p in self.packs:
+            for arbitration_id, data in self.intercan_frames(p):
+                yield "intercan", arbitration_id, True, data
+
+    def run(self, buses: dict, duration: float = 0) -> int:
+        """
+        Send the frames on python-can buses with the configured rate.
+
+        :param buses: Dictionary with the buses for "pcscan" and "intercan" (None = not sent)
+        :param duration: Duration in seconds (0 = endless)
+        :return: Number of sent frames
+        """
+        import can
+
+        period = PCSCAN_PERIOD / self.rate
+        start = time.monotonic()
+        next_period = start
+        sent = 0
+        while duration == 0 or time.monotonic() - start < duration:
+            for bus_name, arbitration_id, is_extended_id, data in self.frames(time.monotonic() - start):
+                bus = buses.get(bus_name)
+                if bus is None:
+                    continue
+                try:
+                    bus.send(can.Message(arbitration_id=arbitration_id, is_extended_id=is_extended_id, data=data))
+                    sent += 1
+                except can.CanError as e:
+                    print(f"Error while sending 0x{arbitration_id:X}: {e}", file=sys.stderr)
+            # fixed rate without drift
+            next_period += period
+            time.sleep(max(0, next_period - time.monotonic()))
+        return sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulator of the PCSCAN and INTERCAN traffic of a DEYE battery stack")
+    parser.add_argument("--interface", default="socketcan", help="python-can interface, e.g. socketcan or virtual")
+    parser.add_argument("--pcscan", default="vcan0", help="channel for PCSCAN")
+    parser.add_argument("--intercan", default="vcan1", help="channel for INTERCAN, empty to disable")
+    parser.add_argument("--packs", type=int, default=1, help="number of packs")
+    parser.add_argument("--cells", type=int, default=16, help="number of cells per pack")
+    parser.add_argument("--rate", type=float, default=1.0, help="factor for the transmission rate (1 = real battery)")
+    parser.add_argument("--duration", type=float, default=0, help="duration in seconds (0 = endless)")
+    parser.add_argument("--scenario", help="JSON file with scenario events")
+    parser.add_argument("--seed", type=int, help="seed of the random cell voltages, for reproducible runs")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    import can
+
+    scenario = []
+    if args.scenario:
+        with open(args.scenario, "r") as f:
+            scenario = json.load(f)
+
+    buses = {"pcscan": can.Bus(interface=args.interface, channel=args.pcscan)}
+    if args.intercan:
+        buses["intercan"] = can.Bus(interface=args.interface, channel=args.intercan)
+
+    emulator = DeyeStackEmulator(args.packs, args.cells, args.rate, scenario)
+    start = time.monotonic()
+    sent = 0
+    try:
+        sent = emulator.run(buses, args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for bus in buses.values():
+            bus.shutdown()
+    print(f"Sent {sent} frames in {time.monotonic() - start:.1f} s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
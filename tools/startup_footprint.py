@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# NOTES
+# Measurement of the startup time and the memory (RSS) of dbus-serialbattery for the import of the BMS classes.
+# Each measurement runs in a fresh Python process, which imports the modules of the driver like
+# dbus-serialbattery.py and then the BMS classes of the selected case:
+#   lazy:   only the classes selected by BMS_TYPE for the transport (bms_registry.expected_bms_types)
+#   eager:  all registered serial and CAN classes, like the former imports at the top of dbus-serialbattery.py
+#
+# Run it on the GX device or Raspberry Pi in the folder of the driver, e.g.:
+#   python3 tools/startup_footprint.py --driver /data/etc/dbus-serialbattery --repeat 5
+#
+# By asmcc@github
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+CASES = [
+    # name, transport, BMS_TYPE
+    ("CAN-only", "can", ["Deye_Can"]),
+    ("serial-only", "serial", ["Jkbms"]),
+    ("serial-all", "serial", []),
+]
+
+# executed in the child process: argv = driver folder, mode, transport, BMS_TYPE (comma separated)
+CHILD = r"""
+import os, sys, time
+start = time.perf_counter()
+driver, mode, transport, bms_type = sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4]
+sys.path.insert(0, driver)
+sys.path.insert(1, os.path.join(driver, "ext"))
+import bms_registry
+import utils  # noqa: F401
+import dbushelper  # noqa: F401
+bms_type = [name for name in bms_type.split(",") if name != ""]
+failed = []
+if mode == "lazy":
+    entries = [e for e in bms_registry.BMS_REGISTRY if e.transport == transport and (e.class_name in bms_type or len(bms_type) == 0) and not e.opt_in]
+else:
+    entries = [e for e in bms_registry.BMS_REGISTRY if e.transport in (bms_registry.SERIAL, bms_registry.CAN) and not e.opt_in]
+for entry in entries:
+    try:
+        entry.load()
+    except Exception as e:
+        failed.append(entry.class_name + ": " + repr(e))
+elapsed = time.perf_counter() - start
+status = {}
+with open("/proc/self/status") as f:
+    for line in f:
+        key, value = line.split(":", 1)
+        status[key] = value.strip()
+import json
+print(json.dumps({
+    "time": elapsed,
+    "rss_kb": int(status["VmRSS"].split()[0]),
+    "hwm_kb": int(status["VmHWM"].split()[0]),
+    "modules": len(sys.modules),
+    "failed": failed,
+}))
+"""
+
+
+def measure(driver: str, mode: str, transport: str, bms_type: list) -> dict:
+    out = subprocess.run(
+        [sys.executable, "-c", CHILD, driver, mode, transport, ",".join(bms_type)],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=driver,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time and RSS of dbus-serialbattery for the import of the BMS classes")
+    parser.add_argument(
+        "--driver",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SerialBattery"),
+        help="folder of dbus-serialbattery.py",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="number of measurements per case")
+    args = parser.parse_args()
+    driver = os.path.abspath(args.driver)
+
+    print(f"{'case':<12} {'mode':<6} {'time [ms]':>10} {'RSS [kB]':>10} {'peak [kB]':>10} {'modules':>8}")
+    for name, transport, bms_type in CASES:
+        for mode in ("eager", "lazy"):
+            results = [measure(driver, mode, transport, bms_type) for _ in range(args.repeat)]
+            print(
+                f"{name:<12} {mode:<6}"
+                + f" {statistics.median(r['time'] for r in results) * 1000:>10.1f}"
+                + f" {statistics.median(r['rss_kb'] for r in results):>10.0f}"
+                + f" {statistics.median(r['hwm_kb'] for r in results):>10.0f}"
+                + f" {results[0]['modules']:>8}"
+            )
+            for failed in results[0]["failed"]:
+                print(f"  import failed: {failed}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()